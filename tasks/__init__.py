@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import importlib
+import importlib.abc
+import importlib.util
+
+'''
+ASTRO5160 tasks, importable as a library
+-----------------
+-The tasks import each other as weekN.module (with this directory on the
+   PYTHONPATH); importing 'tasks' puts it there if needed, so that from the
+   repository root, 'import tasks' is all it takes
+-tasks.week9, tasks.week9.color_cuts, ... are the very same modules as
+   week9, week9.color_cuts, ... (never imported twice), and are only
+   imported on first access
+-Heavy packages (astropy, healpy, matplotlib, pandas, pymangle, dustmaps) are
+   imported by each module only when first used (see utils/lazy.py), so e.g.
+   'from tasks.week9.photometric_transforms import transform_colors' only
+   needs numpy
+-----------------
+'''
+
+_HERE = os.path.dirname( os.path.abspath( __file__ ) )
+if _HERE not in sys.path:
+    sys.path.append( _HERE )
+
+# Subpackages, by name
+SUBPACKAGES = [ 'week{:d}'.format( k ) for k in range( 1, 10 ) ] + [ 'utils', 'benchmarks' ]
+
+
+
+class _Alias( importlib.abc.MetaPathFinder, importlib.abc.Loader ):
+    # Import finder making 'tasks.X.Y' another name for the module 'X.Y'
+
+    def find_spec( self, fullname, path=None, target=None ):
+        if fullname.startswith( __name__ +'.' ) and fullname.split( '.' )[1] in SUBPACKAGES:
+            return importlib.util.spec_from_loader( fullname, self )
+        return None
+
+    def create_module( self, spec ):
+        return importlib.import_module( spec.name[ len(__name__)+1: ] )
+
+    def exec_module( self, module ):
+        # Already executed, under its own name
+        pass
+
+
+
+if not any( isinstance( f, _Alias ) for f in sys.meta_path ):
+    sys.meta_path.insert( 0, _Alias() )
+
+
+
+def __getattr__( name ):
+    # tasks.weekN: imported on first access
+    if name in SUBPACKAGES:
+        return importlib.import_module( __name__ +'.' +name )
+    raise AttributeError( "module '{}' has no attribute '{}'".format( __name__, name ) )
+
+
+
+def __dir__():
+    return sorted( set( SUBPACKAGES ) | set( globals() ) )
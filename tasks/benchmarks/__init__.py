@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import benchmarks; benchmarks.run_benchmarks (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['run_benchmarks', 'synthetic'] )
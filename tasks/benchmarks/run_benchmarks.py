@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from benchmarks.synthetic import rng_for, random_sphere, perturb, synthetic_sweep, write_sweep, \
+                                 synthetic_mask, write_mask, synthetic_ebv_map
+
+'''
+ASTRO5160 Benchmarks: Throughput of the core kernels
+-----------------
+-Times the kernels the week 4-9 tasks spend their time in, on synthetic data
+   (see synthetic.py), at sizes from 10^3 up to 10^8 rows:
+   cross-matching (spatial index and search_around_sky), ang2pix + counting,
+   mask membership (cap_geometry and pymangle), dust E(B-V) lookup,
+   flux -> magnitude conversion, sweep FITS reads and .ply write/read
+-Each (benchmark, size) is set up once (untimed) from its own seeded
+   generator, then run --repeat times; the best time is kept, and reported
+   as rows per second
+-Every run is appended as one JSON line to a history file; --save-baseline
+   keeps a run to compare later runs against, and --compare exits with
+   status 1 if any throughput falls more than --tolerance below the baseline
+-Runs entirely offline
+-----------------
+*Example, gating a change on throughput:
+   python run_benchmarks.py --save-baseline base.json       (before)
+   python run_benchmarks.py --compare base.json             (after)
+'''
+
+# Sizes run by default (rows); --sizes goes up to 1e8
+SIZES = [ 10**3, 10**4, 10**5, 10**6 ]
+
+# Default history file, one JSON line per run
+HISTORY_FILE = 'benchmark_history.jsonl'
+
+# Registered benchmarks, by name: setup function, largest sensible size and
+#   a description; setup( n, rng, tmpdir ) does any untimed preparation and
+#   returns the function to time
+BENCHMARKS = {}
+
+
+
+def benchmark( name, max_size=10**8, description='' ):
+    # Decorator registering a benchmark's setup function
+    def wrap( setup ):
+        BENCHMARKS[name] = { 'setup': setup, 'max_size': max_size, 'description': description }
+        return setup
+    return wrap
+
+
+
+@benchmark( 'crossmatch_index', max_size=10**7,
+            description='make_index + query_cones: n catalog rows, n/100 cones of 1 arcsec' )
+def _crossmatch_index( n, rng, tmpdir ):
+    from week9.spatial_index import make_index, query_cones
+    ras, decs = random_sphere( n, rng )
+    ncone = max( n // 100, 10 )
+    qras, qdecs = perturb( ras[:ncone], decs[:ncone], 0.2/3600, rng )
+    return lambda: query_cones( make_index( ras, decs ), qras, qdecs, 1./3600 )
+
+
+
+@benchmark( 'crossmatch_astropy', max_size=10**6,
+            description='SkyCoord + search_around_sky: n x n rows, 1 arcsec' )
+def _crossmatch_astropy( n, rng, tmpdir ):
+    from astropy.coordinates import SkyCoord, search_around_sky
+    from astropy import units
+    ras, decs = random_sphere( n, rng )
+    qras, qdecs = perturb( ras, decs, 0.2/3600, rng )
+
+    def run():
+        c1 = SkyCoord( qras*units.degree, qdecs*units.degree )
+        c2 = SkyCoord( ras*units.degree, decs*units.degree )
+        return search_around_sky( c1, c2, seplimit=1.*units.arcsec )
+    return run
+
+
+
+@benchmark( 'ang2pix_count', description='ang2pix + bincount at Nside=256' )
+def _ang2pix_count( n, rng, tmpdir ):
+    from week4.sky_density import healpix_density
+    ras, decs = random_sphere( n, rng )
+    return lambda: healpix_density( ras, decs, 256 )
+
+
+
+@benchmark( 'mask_membership', max_size=10**7,
+            description='in_polygon of n points against each of 100 rectangles' )
+def _mask_membership( n, rng, tmpdir ):
+    from week6.cap_geometry import radec_to_xyz, in_polygon
+    polys, _ = synthetic_mask( 100, rng )
+    xyz = radec_to_xyz( *random_sphere( n, rng ) )
+
+    def run():
+        ids = np.full( n, -1 )
+        for i in range( len(polys)-1, -1, -1 ):
+            # Lowest-numbered polygon wins where they overlap, as in pymangle
+            ids[ in_polygon( polys[i], xyz ) ] = i
+        return ids
+    return run
+
+
+
+@benchmark( 'mask_pymangle', max_size=10**7,
+            description='pymangle polyid of n points in a .ply of 100 rectangles' )
+def _mask_pymangle( n, rng, tmpdir ):
+    import pymangle
+    fname = os.path.join( tmpdir, 'bench_mask.ply' )
+    write_mask( fname, 100, rng )
+    mask = pymangle.Mangle( fname )
+    ras, decs = random_sphere( n, rng )
+    return lambda: mask.polyid( ras, decs )
+
+
+
+@benchmark( 'randoms_union', description='sphere_randoms draw_points over 2 overlapping caps and a wrapping box' )
+def _randoms_union( n, rng, tmpdir ):
+    from week4.sphere_randoms import box, cap, draw_points
+    regions = [ cap( 180., 30., 3. ), cap( 182., 30., 3. ), box( 350., 10., -5., 5. ) ]
+    return lambda: draw_points( regions, n, rng )
+
+
+
+@benchmark( 'dust_lookup', description='E(B-V) from a synthetic Nside=512 map, interpolated' )
+def _dust_lookup( n, rng, tmpdir ):
+    import healpy as hp
+    ebv = synthetic_ebv_map( 512, rng )
+    ras, decs = random_sphere( n, rng )
+    return lambda: hp.get_interp_val( ebv, ras, decs, lonlat=True )
+
+
+
+@benchmark( 'dust_sfd', max_size=10**6, description='find_reddening (needs dustmaps and the SFD maps)' )
+def _dust_sfd( n, rng, tmpdir ):
+    from week3.dust_correction import find_reddening
+    ras, decs = random_sphere( n, rng )
+    find_reddening( ras[:1], decs[:1] )  # Fails here (skipped) without the maps
+    return lambda: find_reddening( ras, decs )
+
+
+
+@benchmark( 'frame_galactic', description='ICRS -> galactic with the cached rotation (frame_transforms.py)' )
+def _frame_galactic( n, rng, tmpdir ):
+    from week3.frame_transforms import transform_lonlat
+    ras, decs = random_sphere( n, rng )
+    transform_lonlat( ras[:1], decs[:1], 'icrs', 'galactic' )  # Matrix worked out once, untimed
+    return lambda: transform_lonlat( ras, decs, 'icrs', 'galactic' )
+
+
+
+@benchmark( 'flux_to_mag', description='fluxes_to_mags for g, r, z, W1, W2' )
+def _flux_to_mag( n, rng, tmpdir ):
+    from week9.color_cuts import fluxes_to_mags
+    data = synthetic_sweep( n, rng )
+    return lambda: fluxes_to_mags( data )
+
+
+
+@benchmark( 'sweep_read', max_size=10**7, description='read_fits_columns of RA, DEC and 5 fluxes' )
+def _sweep_read( n, rng, tmpdir ):
+    from week9.sweep_store import read_fits_columns
+    fname = write_sweep( tmpdir, n, rng )
+    columns = ['RA', 'DEC', 'FLUX_G', 'FLUX_R', 'FLUX_Z', 'FLUX_W1', 'FLUX_W2']
+    return lambda: read_fits_columns( fname, columns )
+
+
+
+@benchmark( 'fits_query', max_size=10**7,
+            description='query of RA, DEC where FLUX_G > 1 and MW_TRANSMISSION_G > 0.9 from a sweep' )
+def _fits_query( n, rng, tmpdir ):
+    from week2.fits_query import query
+    fname = write_sweep( tmpdir, n, rng )
+    return lambda: query( fname, ['RA', 'DEC'], where='(FLUX_G > 1) & (MW_TRANSMISSION_G > 0.9)' )
+
+
+
+@benchmark( 'ply_io', max_size=10**5, description='write_to_mangle_file + read_mangle_file of n polygons' )
+def _ply_io( n, rng, tmpdir ):
+    from week6.general_masking import write_to_mangle_file, read_mangle_file
+    polys, sters = synthetic_mask( n, rng )
+    fname = os.path.join( tmpdir, 'bench_io.ply' )
+
+    def run():
+        write_to_mangle_file( *polys, fname=fname, sters=sters )
+        return read_mangle_file( fname )
+    return run
+
+
+
+@benchmark( 'paircount_auto', max_size=10**5,
+            description='angular_correlation pair_counts of n points in a 20x20 deg box, 0.01-1 deg, 8 jackknife regions' )
+def _paircount_auto( n, rng, tmpdir ):
+    from benchmarks.synthetic import random_box
+    from week5.angular_correlation import jackknife_regions, prepare_catalog, pair_counts, DEFAULT_EDGES
+    ras, decs = random_box( (180., 200., 20., 40.), n, rng )
+    cat = prepare_catalog( ras, decs, regions=jackknife_regions( ras, decs, 8 ) )
+    return lambda: pair_counts( cat, cat, DEFAULT_EDGES )
+
+
+
+@benchmark( 'balkanize', max_size=10**4,
+            description='mask_operations balkanize of n overlapping 0.5-2 deg rectangles (cell-index pruned)' )
+def _balkanize( n, rng, tmpdir ):
+    from week6.mask_operations import balkanize
+    polys, _ = synthetic_mask( n, rng, size=(0.5, 2.) )
+    return lambda: balkanize( polys )
+
+
+
+@benchmark( 'pixel_coverage', max_size=10**4,
+            description='pixel_coverage of n rectangles at Nside 256 (inside/boundary pixels, cache cleared)' )
+def _pixel_coverage( n, rng, tmpdir ):
+    from week6 import pixel_coverage
+    polys, _ = synthetic_mask( n, rng )
+
+    def run():
+        pixel_coverage.clear_cache()
+        return pixel_coverage.pixel_coverage( polys, [256], cache_dir=None )
+    return run
+
+
+
+@benchmark( 'visibility_night', max_size=10**6,
+            description='observable_time of n targets over one night at 5-minute cadence, from Laramie' )
+def _visibility_night( n, rng, tmpdir ):
+    from astropy.time import Time
+    from astropy import units as U
+    from week3.visibility import observable_time, epoch_terms
+    ras, decs = random_sphere( n, rng )
+    times = Time( '2026-01-15T00:00' ) + np.arange( 288 ) / 288. * U.day
+    location = ( -105.5911, 41.3114, 2184. )
+    epoch_terms( times, location )  # Daily terms cached once, untimed
+    return lambda: observable_time( ras, decs, times, location )
+
+
+
+def run_one( name, n, seed=1, repeat=3, tmpdir=None ):
+    # Set up and time one benchmark at one size; returns a result dict
+    #   ('skipped' gives the reason if it can't run here, e.g. a missing module)
+    result = { 'bench': name, 'size': int( n ) }
+    try:
+        run = BENCHMARKS[name]['setup']( int( n ), rng_for( seed, name, int( n ) ), tmpdir )
+    except (ImportError, OSError, ValueError) as e:
+        result['skipped'] = '{}: {}'.format( type(e).__name__, e )
+        return result
+    times = []
+    for _ in range( repeat ):
+        t0 = time.perf_counter()
+        run()
+        times.append( time.perf_counter() - t0 )
+    result['seconds']    = min( times )
+    result['rows_per_s'] = n / min( times )
+    return result
+
+
+
+def environment():
+    # What the numbers were measured on, saved with each run
+    import healpy
+    import astropy
+    try:
+        commit = subprocess.run( ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                 cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return { 'time': time.strftime( '%Y-%m-%dT%H:%M:%S' ), 'commit': commit, 'host': platform.node(),
+             'machine': platform.machine(), 'python': platform.python_version(),
+             'numpy': np.__version__, 'healpy': healpy.__version__, 'astropy': astropy.__version__ }
+
+
+
+def run_suite( names=None, sizes=SIZES, seed=1, repeat=3, verbose=True ):
+    # Run every (benchmark, size) up to each benchmark's max_size; returns a
+    #   run record: {'env': environment(), 'seed', 'repeat', 'results': [...]}
+    names = names or list( BENCHMARKS )
+    unknown = [ n for n in names if n not in BENCHMARKS ]
+    if len(unknown) > 0:
+        raise ValueError( "Unknown benchmarks {}; choose from {}".format( unknown, list( BENCHMARKS ) ) )
+    record = { 'env': environment(), 'seed': seed, 'repeat': repeat, 'results': [] }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in names:
+            for n in sizes:
+                if n > BENCHMARKS[name]['max_size']:
+                    continue
+                result = run_one( name, n, seed, repeat, tmpdir )
+                record['results'].append( result )
+                if verbose:
+                    print( format_result( result ) )
+                    sys.stdout.flush()
+                if 'skipped' in result:
+                    break
+    return record
+
+
+
+def format_result( result, baseline=None ):
+    # One line of the results table, with the ratio to a baseline if given
+    head = '{:<20s} {:>11,d}'.format( result['bench'], result['size'] )
+    if 'skipped' in result:
+        return head +'   skipped ({})'.format( result['skipped'] )
+    line = head +' {:>11.4f} s {:>14,.0f} rows/s'.format( result['seconds'], result['rows_per_s'] )
+    if baseline is not None:
+        line += '   x{:.2f}'.format( result['rows_per_s'] / baseline['rows_per_s'] )
+    return line
+
+
+
+def append_history( record, fname=HISTORY_FILE ):
+    # Add a run record to the history file (one JSON object per line)
+    with open( fname, 'a' ) as f:
+        f.write( json.dumps( record ) +'\n' )
+
+
+
+def load_history( fname=HISTORY_FILE ):
+    # All run records in a history file, oldest first
+    with open( fname ) as f:
+        return [ json.loads( line ) for line in f if line.strip() ]
+
+
+
+def compare( record, baseline, tolerance=0.2 ):
+    # Compare a run against a baseline run, (benchmark, size) by (benchmark, size)
+    #   Returns a list of (result, baseline result, ratio, regressed), where
+    #   ratio is the throughput relative to the baseline, and regressed is
+    #   True if it fell by more than the tolerance (a fraction)
+    base = { (r['bench'], r['size']): r for r in baseline['results'] if 'skipped' not in r }
+    rows = []
+    for r in record['results']:
+        b = base.get( (r['bench'], r['size']) )
+        if b is None or 'skipped' in r:
+            continue
+        ratio = r['rows_per_s'] / b['rows_per_s']
+        rows.append( (r, b, ratio, ratio < 1. - tolerance) )
+    return rows
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    ap = ArgumentParser( description='Benchmark the core kernels on synthetic data (offline)' )
+    ap.add_argument( "--only", nargs='+', default=None, help='Benchmarks to run (default all): '
+                     +', '.join( BENCHMARKS ) )
+    ap.add_argument( "--sizes", nargs='+', type=float, default=SIZES, help='Rows per benchmark, e.g. 1e3 1e6 1e8' )
+    ap.add_argument( "--repeat", type=int, default=3, help='Timed runs per size (the best is kept)' )
+    ap.add_argument( "--seed", type=int, default=1, help='Seed for the synthetic data' )
+    ap.add_argument( "--history", default=HISTORY_FILE, help='History file to append this run to' )
+    ap.add_argument( "--no-history", action='store_true', help="Don't record this run" )
+    ap.add_argument( "--save-baseline", default=None, help='Also save this run as a baseline file' )
+    ap.add_argument( "--compare", default=None, help='Baseline file to compare this run against' )
+    ap.add_argument( "--tolerance", type=float, default=0.2,
+                     help='Fractional slow-down counted as a regression (default 0.2)' )
+    ap.add_argument( "--list", action='store_true', help='List the benchmarks and exit' )
+    ns = ap.parse_args()
+
+    if ns.list:
+        for name, b in BENCHMARKS.items():
+            print( '{:<20s} (up to {:.0e})  {}'.format( name, b['max_size'], b['description'] ) )
+        sys.exit( 0 )
+
+    record = run_suite( ns.only, [ int( n ) for n in ns.sizes ], ns.seed, ns.repeat )
+    if not ns.no_history:
+        append_history( record, ns.history )
+    if ns.save_baseline is not None:
+        with open( ns.save_baseline, 'w' ) as f:
+            json.dump( record, f, indent=1 )
+
+    if ns.compare is not None:
+        with open( ns.compare ) as f:
+            baseline = json.load( f )
+        rows = compare( record, baseline, ns.tolerance )
+        print( '\nCompared with baseline from {} ({}):'.format( baseline['env']['time'], baseline['env']['commit'] ) )
+        for r, b, ratio, regressed in rows:
+            print( format_result( r, b ) +( '   REGRESSION' if regressed else '' ) )
+        nbad = sum( regressed for *_, regressed in rows )
+        if nbad > 0:
+            print( '{:d} of {:d} benchmarks slower than the baseline by more than {:.0%}'.format(
+                   nbad, len(rows), ns.tolerance ) )
+            sys.exit( 1 )
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from week9.color_cuts import BANDS
+from utils.lazy import lazy_import
+Table = lazy_import( 'astropy.table', 'Table' )
+
+'''
+ASTRO5160 Benchmarks: Synthetic data generators
+-----------------
+-Random positions uniform on the sphere (RA uniform, Dec as arcsin, as in
+   map_projections.py/healpix.py) or in an RA/Dec box (as gen_random_w_bounds
+   in find_matching_sources.py, but uniform in area)
+-Sweep-like catalogs (RA, DEC, FLUX_*, MW_TRANSMISSION_*) and sweep-named
+   FITS files, lat-long rectangle masks and .ply files, and a smooth E(B-V) map
+-Everything is drawn from a numpy Generator, so the same seed always gives
+   the same data, with no network or /d/scratch access needed
+-----------------
+'''
+
+pi = np.pi
+
+# Rows generated at a time, to bound memory use for the largest sizes
+CHUNK_ROWS = 2**22
+
+
+
+def rng_for( seed, *keys ):
+    # Independent, reproducible Generator for each (seed, key, ...) so that
+    #   e.g. every (benchmark, size) gets the same data on every run
+    #   Keys may be strings or integers
+    words = [ k if isinstance( k, int ) else int.from_bytes( str( k ).encode(), 'little' ) % 2**63
+              for k in keys ]
+    return np.random.default_rng( [seed] + words )
+
+
+
+def random_sphere( num, rng ):
+    # RA, Dec (degrees) distributed uniformly over the whole sphere
+    ras  = 360. * rng.random( num )
+    decs = 180./pi * np.arcsin( 1. - rng.random( num )*2. )
+    return ras, decs
+
+
+
+def random_box( radecbox, num, rng ):
+    # RA, Dec (degrees) uniform in area inside [ramin, ramax, decmin, decmax]
+    ramin, ramax, decmin, decmax = radecbox
+    ras  = ramin + (ramax - ramin) * rng.random( num )
+    zmin, zmax = np.sin( np.radians( decmin ) ), np.sin( np.radians( decmax ) )
+    decs = np.degrees( np.arcsin( zmin + (zmax - zmin) * rng.random( num ) ) )
+    return ras, decs
+
+
+
+def perturb( ras, decs, sigma, rng ):
+    # Counterparts of the given positions, each offset in a random direction
+    #   by a (2D) Gaussian of sigma (degrees) per axis
+    dra  = sigma * rng.standard_normal( len(ras) ) / np.maximum( np.cos( np.radians( decs ) ), 1e-6 )
+    ddec = sigma * rng.standard_normal( len(ras) )
+    return ( ras + dra ) % 360., np.clip( decs + ddec, -90., 90. )
+
+
+
+def synthetic_sweep( num, rng, radecbox=None, bands=BANDS ):
+    # Dict of sweep-like columns: RA, DEC, and FLUX_/MW_TRANSMISSION_ for each
+    #   band (fluxes in nanomaggies, log-normal, with ~2% non-positive as in
+    #   the real sweeps)
+    if radecbox is None:
+        ras, decs = random_sphere( num, rng )
+    else:
+        ras, decs = random_box( radecbox, num, rng )
+    data = { 'RA': ras, 'DEC': decs }
+    base = rng.normal( 0.5, 1.0, num )
+    for k, band in enumerate( bands ):
+        flux = 10**( base + 0.1*k + rng.normal( 0, 0.3, num ) )
+        flux[ rng.random( num ) < 0.02 ] *= -1
+        data['FLUX_' +band.upper()] = flux.astype( np.float32 )
+        data['MW_TRANSMISSION_' +band.upper()] = rng.uniform( 0.8, 1.0, num ).astype( np.float32 )
+    return data
+
+
+
+def sweep_name( radecbox ):
+    # Legacy Survey sweep file name for an RA/Dec box (see decode_sweep_name)
+    ramin, ramax, decmin, decmax = radecbox
+    sign = lambda d: 'm' if d < 0 else 'p'
+    return 'sweep-{:03.0f}{}{:03.0f}-{:03.0f}{}{:03.0f}.fits'.format(
+           ramin, sign( decmin ), abs( decmin ), ramax, sign( decmax ), abs( decmax ) )
+
+
+
+def write_sweep( outdir, num, rng, radecbox=(180., 190., 25., 35.), bands=BANDS ):
+    # Write a sweep-like FITS file of num rows inside radecbox, named as the
+    #   real sweeps are; returns its path
+    # Columns are built CHUNK_ROWS rows at a time, then written in one go
+    parts = [ synthetic_sweep( min( CHUNK_ROWS, num-lo ), rng, radecbox, bands )
+              for lo in range( 0, max( num, 1 ), CHUNK_ROWS ) ]
+    data = { col: np.concatenate( [ p[col] for p in parts ] ) for col in parts[0] }
+    fname = os.path.join( outdir, sweep_name( radecbox ) )
+    Table( data ).write( fname, format='fits', overwrite=True )
+    return fname
+
+
+
+def rectangle_caps( ramin, ramax, decmin, decmax ):
+    # The 4 caps of a lat-long rectangle (degrees, ramax - ramin <= 180):
+    #   two great circles through the poles and two caps around the north pole,
+    #   the upper one complemented
+    r1, r2 = np.radians( ramin ), np.radians( ramax )
+    return np.array( [ [ -np.sin( r1 ),  np.cos( r1 ), 0., 1. ],
+                       [  np.sin( r2 ), -np.cos( r2 ), 0., 1. ],
+                       [ 0., 0., 1.,    1. - np.sin( np.radians( decmin ) )   ],
+                       [ 0., 0., 1., -( 1. - np.sin( np.radians( decmax ) ) ) ] ] )
+
+
+
+def rectangle_area( ramin, ramax, decmin, decmax ):
+    # Area (steradians) of a lat-long rectangle (degrees)
+    return np.radians( ramax - ramin ) * ( np.sin( np.radians( decmax ) ) - np.sin( np.radians( decmin ) ) )
+
+
+
+def synthetic_mask( npoly, rng, size=(2., 10.) ):
+    # npoly random lat-long rectangles, each side between size[0] and size[1]
+    #   degrees (so they sometimes overlap); returns (polys, sters)
+    width  = rng.uniform( *size, npoly )
+    height = rng.uniform( *size, npoly )
+    ramin  = rng.uniform( 0., 360. - width )
+    decmin = rng.uniform( -80., 80. - height )
+    boxes  = np.stack( [ ramin, ramin+width, decmin, decmin+height ], axis=1 )
+    polys  = [ rectangle_caps( *b ) for b in boxes ]
+    return polys, np.array( [ rectangle_area( *b ) for b in boxes ] )
+
+
+
+def write_mask( fname, npoly, rng ):
+    # Write a .ply file of npoly random rectangles; returns (polys, sters)
+    from week6.general_masking import write_to_mangle_file
+    polys, sters = synthetic_mask( npoly, rng )
+    write_to_mangle_file( *polys, fname=fname, sters=sters )
+    return polys, sters
+
+
+
+def synthetic_ebv_map( nside, rng ):
+    # Smooth, positive E(B-V) HEALPix map (RING) rising toward the galactic
+    #   plane (here just the equator), with some structure on top
+    import healpy as hp
+    _, lat = hp.pix2ang( nside, np.arange( hp.nside2npix( nside ) ), lonlat=True )
+    clumps = rng.lognormal( 0., 0.5, len(lat) )
+    return ( 0.02 + 0.5*np.exp( -np.abs( lat )/5. ) * clumps ).astype( np.float32 )
@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import utils; utils.instrument (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['instrument', 'lazy', 'prefetch', 'shared_catalog'] )
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+'''
+ASTRO5160 Utilities: Instrumentation and profiling hooks
+-----------------
+-Named stages are timed with timer('stage') (a context manager) or
+   @timed('stage') (a decorator); counters (rows, bytes, HTTP requests, ...)
+   are added to with count('name', n)
+-While enabled, a background thread samples the resident memory, and each
+   stage records the peak seen while it was running
+-report() prints a per-stage table, report_json() writes the same as JSON
+-profiling() wraps a run in cProfile and/or tracemalloc
+-Disabled by default: timer() then returns a shared do-nothing context and
+   count() returns at once, so the hooks can stay in hot paths
+-Enable with enable(), or by setting the environment variable
+   ASTRO5160_INSTRUMENT=1 (also picked up by worker processes)
+-Stages and counters are per process
+-----------------
+'''
+
+# Environment variable which turns instrumentation on at import
+ENV_VAR = 'ASTRO5160_INSTRUMENT'
+
+# Seconds between memory samples
+SAMPLE_INTERVAL = 0.05
+
+_ENABLED = os.environ.get( ENV_VAR, '' ) not in ( '', '0' )
+_NULL    = nullcontext()
+_LOCK    = threading.Lock()
+_LOCAL   = threading.local()
+
+# Per stage: calls, total and self seconds, peak resident bytes; and named counters
+_STAGES   = {}
+_COUNTERS = {}
+# Stages currently running in any thread, and the memory sampler
+_ACTIVE   = []
+_SAMPLER  = None
+
+
+
+def enable( sample_memory=True ):
+    # Turn instrumentation on (and start the memory sampler)
+    global _ENABLED
+    _ENABLED = True
+    if sample_memory:
+        _start_sampler()
+
+
+
+def disable():
+    # Turn instrumentation off; anything recorded so far is kept
+    global _ENABLED
+    _ENABLED = False
+    _stop_sampler()
+
+
+
+def enabled():
+    # True if instrumentation is on
+    return _ENABLED
+
+
+
+def reset():
+    # Forget all recorded stages and counters
+    with _LOCK:
+        _STAGES.clear()
+        _COUNTERS.clear()
+
+
+
+def rss_bytes():
+    # Current resident memory of this process, in bytes
+    #   (from /proc on Linux, otherwise the peak so far from resource)
+    try:
+        with open( '/proc/self/statm' ) as f:
+            return int( f.read().split()[1] ) * os.sysconf( 'SC_PAGE_SIZE' )
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+        # ru_maxrss is in kB on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak*1024
+
+
+
+def _stage( name ):
+    # Record for a stage, created on first use (call with _LOCK held)
+    if name not in _STAGES:
+        _STAGES[name] = { 'calls': 0, 'seconds': 0., 'self_seconds': 0., 'peak_rss': 0 }
+    return _STAGES[name]
+
+
+
+def _stack():
+    # This thread's stack of running stages, as [name, seconds in children]
+    if not hasattr( _LOCAL, 'stack' ):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+
+def _note_memory( rss ):
+    # Raise the peak memory of every running stage to rss
+    with _LOCK:
+        for name in _ACTIVE:
+            s = _stage( name )
+            s['peak_rss'] = max( s['peak_rss'], rss )
+
+
+
+def _sample_loop( stop ):
+    # Body of the memory sampler thread
+    while not stop.wait( SAMPLE_INTERVAL ):
+        if _ACTIVE:
+            _note_memory( rss_bytes() )
+
+
+
+def _start_sampler():
+    global _SAMPLER
+    if _SAMPLER is None:
+        stop = threading.Event()
+        thread = threading.Thread( target=_sample_loop, args=(stop,), daemon=True )
+        thread.start()
+        _SAMPLER = (thread, stop)
+
+
+
+def _stop_sampler():
+    global _SAMPLER
+    if _SAMPLER is not None:
+        thread, stop = _SAMPLER
+        stop.set()
+        thread.join()
+        _SAMPLER = None
+
+
+
+@contextmanager
+def _timer( name ):
+    # Time spent in stages nested inside this one is recorded against them,
+    #   and subtracted from this stage's 'self' time
+    stack = _stack()
+    with _LOCK:
+        _ACTIVE.append( name )
+    _note_memory( rss_bytes() )
+    frame = [ name, 0. ]
+    stack.append( frame )
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        stack.pop()
+        if stack:
+            stack[-1][1] += dt
+        rss = rss_bytes()
+        with _LOCK:
+            _ACTIVE.remove( name )
+            s = _stage( name )
+            s['calls']   += 1
+            s['seconds'] += dt
+            s['self_seconds'] += dt - frame[1]
+            s['peak_rss'] = max( s['peak_rss'], rss )
+
+
+
+def timer( name ):
+    # Context manager timing a stage:  with timer( 'read_sweep' ): ...
+    #   A stage's total time includes any stages nested in it, its self time
+    #   doesn't (so self times add up to the time spent in all stages)
+    if not _ENABLED:
+        return _NULL
+    return _timer( name )
+
+
+
+def timed( name ):
+    # Decorator timing every call of a function as a stage
+    #   Generators are timed while they run, not while their consumer does
+    def wrap( func ):
+        import functools
+        import inspect
+        if inspect.isgeneratorfunction( func ):
+            @functools.wraps( func )
+            def gen( *args, **kwargs ):
+                it = func( *args, **kwargs )
+                while True:
+                    with timer( name ):
+                        try:
+                            item = next( it )
+                        except StopIteration:
+                            return
+                    yield item
+            return gen
+
+        @functools.wraps( func )
+        def call( *args, **kwargs ):
+            if not _ENABLED:
+                return func( *args, **kwargs )
+            with _timer( name ):
+                return func( *args, **kwargs )
+        return call
+    return wrap
+
+
+
+def count( name, n=1 ):
+    # Add n to a named counter (e.g. 'rows', 'bytes_read', 'http_requests')
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get( name, 0 ) + n
+
+
+
+def stats():
+    # Copy of everything recorded: {'stages': {...}, 'counters': {...}}
+    with _LOCK:
+        return { 'stages': { k: dict( v ) for k, v in _STAGES.items() },
+                 'counters': dict( _COUNTERS ),
+                 'peak_rss': max( [ s['peak_rss'] for s in _STAGES.values() ] + [0] ) }
+
+
+
+def merge_stats( other ):
+    # Add stats() from another process (e.g. a pool worker) to this one's
+    with _LOCK:
+        for name, o in other['stages'].items():
+            s = _stage( name )
+            s['calls']   += o['calls']
+            s['seconds'] += o['seconds']
+            s['self_seconds'] += o['self_seconds']
+            s['peak_rss'] = max( s['peak_rss'], o['peak_rss'] )
+        for name, n in other['counters'].items():
+            _COUNTERS[name] = _COUNTERS.get( name, 0 ) + n
+
+
+
+def report( file=None ):
+    # Print a table of the stages (most self time first) and the counters
+    file = file or sys.stdout
+    s = stats()
+    if len( s['stages'] ) == 0 and len( s['counters'] ) == 0:
+        print( 'No instrumentation recorded (is it enabled?)', file=file )
+        return
+    print( '{:<24s} {:>8s} {:>11s} {:>11s} {:>11s} {:>10s}'.format(
+           'Stage', 'Calls', 'Total (s)', 'Self (s)', 'Mean (ms)', 'Peak (MB)' ), file=file )
+    for name, st in sorted( s['stages'].items(), key=lambda kv: -kv[1]['self_seconds'] ):
+        print( '{:<24s} {:>8d} {:>11.3f} {:>11.3f} {:>11.3f} {:>10.1f}'.format(
+               name, st['calls'], st['seconds'], st['self_seconds'],
+               1e3*st['seconds']/max( st['calls'], 1 ), st['peak_rss']/2**20 ), file=file )
+    for name, n in sorted( s['counters'].items() ):
+        print( '{:<24s} {:>12,d}'.format( name, n ), file=file )
+
+
+
+def report_json( fname=None ):
+    # The stages and counters as JSON, also written to fname if given
+    text = json.dumps( stats(), indent=2, sort_keys=True )
+    if fname is not None:
+        with open( fname, 'w' ) as f:
+            f.write( text )
+    return text
+
+
+
+@contextmanager
+def profiling( cprofile_out=None, tracemalloc_top=0, sort='cumulative', lines=25 ):
+    # Wrap a run in cProfile and/or tracemalloc, and enable() for its duration
+    #   cprofile_out: file for the raw profile (open with pstats/snakeviz);
+    #                 '-' prints the top 'lines' functions instead
+    #   tracemalloc_top: print this many of the biggest allocation sites
+    was_enabled = _ENABLED
+    enable()
+    prof = None
+    if cprofile_out is not None:
+        import cProfile
+        prof = cProfile.Profile()
+    if tracemalloc_top > 0:
+        import tracemalloc
+        tracemalloc.start()
+    if prof is not None:
+        prof.enable()
+    try:
+        yield
+    finally:
+        if prof is not None:
+            prof.disable()
+            if cprofile_out == '-':
+                import pstats
+                pstats.Stats( prof ).sort_stats( sort ).print_stats( lines )
+            else:
+                prof.dump_stats( cprofile_out )
+        if tracemalloc_top > 0:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print( 'Top {:d} allocation sites:'.format( tracemalloc_top ) )
+            for stat in snapshot.statistics( 'lineno' )[:tracemalloc_top]:
+                print( '  ' +str( stat ) )
+        if not was_enabled:
+            disable()
+
+
+
+def _after_fork():
+    # A forked child (e.g. a pool worker) has no sampler thread: start its own
+    #   (and a new lock, in case another thread held it at the fork)
+    global _SAMPLER, _LOCK
+    _SAMPLER = None
+    _LOCK = threading.Lock()
+    _ACTIVE.clear()
+    if _ENABLED:
+        _start_sampler()
+
+
+
+# Started here (rather than lazily) when enabled through the environment
+if _ENABLED:
+    _start_sampler()
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( after_in_child=_after_fork )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import importlib
+
+'''
+ASTRO5160 Utilities: Lazy imports
+-----------------
+-healpy, astropy, matplotlib, pandas and pymangle each take from a few
+   hundred ms to ~2 s to import, so a module importing them all at the top
+   makes every command that touches it slow to start, even when the command
+   never uses them
+-lazy_import('healpy') stands in for the module (or, with a second
+   argument, one name from it, e.g. lazy_import('astropy.table', 'Table')),
+   and only imports it the first time it is used; module-level code can
+   keep the usual 'hp.ang2pix(...)', 'plt.figure()', 'Table.read(...)' forms
+-lazy_submodules() gives a package a module-level __getattr__ that imports
+   its submodules on first access (import week9; week9.color_cuts.apply_cut)
+-----------------
+'''
+
+
+
+class LazyObject:
+    # Stand-in for a module, or a name in a module, imported on first use
+    __slots__ = ( '_module', '_attr', '_target' )
+
+    def __init__( self, module, attr=None ):
+        object.__setattr__( self, '_module', module )
+        object.__setattr__( self, '_attr', attr )
+        object.__setattr__( self, '_target', None )
+
+    def _load( self ):
+        target = object.__getattribute__( self, '_target' )
+        if target is None:
+            target = importlib.import_module( self._module )
+            if self._attr is not None:
+                target = getattr( target, self._attr )
+            object.__setattr__( self, '_target', target )
+        return target
+
+    def __getattr__( self, name ):
+        return getattr( self._load(), name )
+
+    def __setattr__( self, name, value ):
+        setattr( self._load(), name, value )
+
+    def __call__( self, *args, **kwargs ):
+        return self._load()( *args, **kwargs )
+
+    def __getitem__( self, key ):
+        return self._load()[key]
+
+    def __dir__( self ):
+        return dir( self._load() )
+
+    def __repr__( self ):
+        name = self._module + ( '.' +self._attr if self._attr else '' )
+        if object.__getattribute__( self, '_target' ) is None:
+            return '<lazy {} (not yet imported)>'.format( name )
+        return repr( self._load() )
+
+    def __reduce__( self ):
+        # Pickle (e.g. for worker processes) as the real object
+        return ( _resolve, ( self._module, self._attr ) )
+
+
+
+def _resolve( module, attr ):
+    target = importlib.import_module( module )
+    return target if attr is None else getattr( target, attr )
+
+
+
+def lazy_import( module, attr=None ):
+    # Module (or attribute of a module) imported on first use; if it has
+    #   already been imported elsewhere, it is returned directly
+    if module in sys.modules:
+        return _resolve( module, attr )
+    return LazyObject( module, attr )
+
+
+
+def lazy_submodules( package, names ):
+    # Module-level (__getattr__, __dir__) for a package, importing each of
+    #   the named submodules the first time it is accessed as an attribute
+    #   Use in the package's __init__.py:
+    #     __getattr__, __dir__ = lazy_submodules( __name__, ['mod1', 'mod2'] )
+    names = list( names )
+
+    def __getattr__( name ):
+        if name in names:
+            return importlib.import_module( package +'.' +name )
+        raise AttributeError( "module '{}' has no attribute '{}'".format( package, name ) )
+
+    def __dir__():
+        return sorted( set( names ) | set( vars( sys.modules[package] ) ) )
+    return __getattr__, __dir__
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+ThreadPoolExecutor = lazy_import( 'concurrent.futures', 'ThreadPoolExecutor' )
+
+'''
+ASTRO5160 Utilities: Background prefetching
+-----------------
+-prefetch( read_chunks( f, columns ) ) runs a generator (of sweep chunks,
+   whole tables, ...) on a background thread, which reads up to 'depth' items
+   ahead into a buffer while the caller works on the current one
+-prefetch_map( Table.read, files ) reads a list of files the same way, in
+   order, optionally on several threads (for high-latency filesystems)
+-max_bytes caps the memory held in read-ahead items: no further read starts
+   while the items waiting in the buffer add up to more than this (so at most
+   max_bytes plus one item, plus whatever is being read)
+-File reads (and numpy copies out of memory-mapped files) release the GIL,
+   so the reading really does overlap with the caller's numpy work
+-Errors in the reader are raised in the caller, at the item where they
+   happened; stopping early (break, or closing the iterator) stops the reader
+-With instrumentation on, 'prefetch_wait' is the time the caller spent
+   waiting for data, i.e. the I/O which was not hidden
+-----------------
+'''
+
+# Items read ahead by default
+DEPTH = 2
+
+
+
+def nbytes( item ):
+    # Approximate memory held by an item: arrays (and astropy columns), and
+    #   dicts, lists, tuples or Tables of them; 0 for anything else
+    if hasattr( item, 'itercols' ):
+        # astropy Table
+        return sum( nbytes( col ) for col in item.itercols() )
+    if hasattr( item, 'nbytes' ):
+        return int( item.nbytes )
+    if isinstance( item, dict ):
+        return sum( nbytes( v ) for v in item.values() )
+    if isinstance( item, ( list, tuple ) ):
+        return sum( nbytes( v ) for v in item )
+    return 0
+
+
+
+def prefetch( iterable, depth=DEPTH, max_bytes=None ):
+    # Iterate over iterable, with its items produced on a background thread
+    #   up to depth items ahead (depth < 1 just iterates, in this thread)
+    #   max_bytes: pause reading ahead while the buffered items hold more
+    #              than this (see nbytes); None for no limit
+    if depth < 1:
+        yield from iterable
+        return
+
+    buffer = deque()
+    state = { 'bytes': 0, 'done': False, 'error': None, 'stop': False }
+    cond = threading.Condition()
+
+    def full():
+        return len(buffer) >= depth or \
+               ( max_bytes is not None and len(buffer) > 0 and state['bytes'] >= max_bytes )
+
+    def reader():
+        try:
+            for item in iterable:
+                size = nbytes( item )
+                with cond:
+                    if state['stop']:
+                        return
+                    buffer.append( ( item, size ) )
+                    state['bytes'] += size
+                    cond.notify_all()
+                    while full() and not state['stop']:
+                        cond.wait()
+                    if state['stop']:
+                        return
+        except BaseException as e:
+            with cond:
+                state['error'] = e
+        finally:
+            if hasattr( iterable, 'close' ):
+                # e.g. closes the file a generator has open, on this thread
+                iterable.close()
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread( target=reader, name='prefetch', daemon=True )
+    thread.start()
+    try:
+        while True:
+            with cond:
+                if len(buffer) == 0 and not state['done']:
+                    count( 'prefetch_stalls' )
+                    with timer( 'prefetch_wait' ):
+                        while len(buffer) == 0 and not state['done']:
+                            cond.wait()
+                if len(buffer) == 0:
+                    # Reader finished: all items delivered (or it failed)
+                    if state['error'] is not None:
+                        raise state['error']
+                    return
+                item, size = buffer.popleft()
+                state['bytes'] -= size
+                cond.notify_all()
+            yield item
+    finally:
+        with cond:
+            state['stop'] = True
+            buffer.clear()
+            cond.notify_all()
+
+
+
+def prefetch_map( func, items, depth=DEPTH, max_bytes=None, nthreads=1 ):
+    # Yield func( item ) for each of items, in order, with up to depth calls
+    #   made ahead of the caller on background threads
+    #   nthreads > 1 runs that many calls at once (at most depth of them),
+    #   which helps when each read mostly waits on a slow filesystem
+    #   max_bytes: as for prefetch(); with several threads it is checked
+    #              against finished results whenever a new call would start
+    if nthreads <= 1 or depth < 1:
+        yield from prefetch( ( func( item ) for item in items ), depth, max_bytes )
+        return
+
+    pending = deque()
+    items = iter( items )
+    exhausted = False
+    with ThreadPoolExecutor( max_workers=min( nthreads, depth ) ) as pool:
+        try:
+            while True:
+                # Start reads until depth are outstanding or the cap is reached
+                while not exhausted and len(pending) < depth + 1 and ( max_bytes is None or len(pending) == 0
+                        or sum( nbytes( f.result() ) for f in pending
+                                   if f.done() and f.exception() is None ) < max_bytes ):
+                    try:
+                        pending.append( pool.submit( func, next( items ) ) )
+                    except StopIteration:
+                        exhausted = True
+                if len(pending) == 0:
+                    return
+                future = pending.popleft()
+                if not future.done():
+                    count( 'prefetch_stalls' )
+                    with timer( 'prefetch_wait' ):
+                        result = future.result()
+                else:
+                    result = future.result()
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import atexit
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from utils.lazy import lazy_import
+shared_memory = lazy_import( 'multiprocessing.shared_memory' )
+
+'''
+ASTRO5160 Utilities: Shared-memory catalogs for worker processes
+-----------------
+-Arguments sent to worker processes are pickled and copied into every
+   worker, so passing a multi-GB catalog to N workers costs N copies (and
+   the time to pickle and unpickle them)
+-share( catalog ) copies the catalog's columns once into one block of
+   shared memory (multiprocessing.shared_memory, or a memory-mapped file
+   with backing='mmap', e.g. for catalogs larger than /dev/shm) and returns
+   a descriptor: a small dict of the block's name and each column's dtype,
+   shape and offset, which is cheap to pickle and send with every task
+-attach( descriptor ), in a worker, gives back the catalog as numpy views of
+   the shared block, without copying; attachments are kept per process, so
+   the second and later tasks in a worker attach for free
+-release( descriptor ) (or leaving a 'with shared( catalog ) as desc:'
+   block) frees the block; anything still shared is released at exit, and
+   blocks of a crashed process are removed by multiprocessing's resource
+   tracker (shm backing; an mmap directory would be left in the temp dir)
+-Catalogs are dicts of arrays (other values, e.g. numbers, are passed
+   along in the descriptor), astropy Tables or structured arrays
+-----------------
+'''
+
+# Column offsets in the shared block are multiples of this (bytes)
+ALIGN = 64
+
+# Blocks created by this process: name -> (pid, handle, directory or None)
+_OWNED = {}
+# Blocks attached in this process: (name, writeable) -> (handle, arrays)
+_ATTACHED = {}
+
+
+
+def _columns( catalog ):
+    # Split a catalog into ({name: array}, {name: other value})
+    if hasattr( catalog, 'colnames' ):
+        # astropy Table
+        return { c: np.asarray( catalog[c] ) for c in catalog.colnames }, {}
+    if isinstance( catalog, np.ndarray ) and catalog.dtype.names is not None:
+        return { c: np.asarray( catalog[c] ) for c in catalog.dtype.names }, {}
+    arrays = { c: v for c, v in catalog.items() if isinstance( v, np.ndarray ) }
+    values = { c: v for c, v in catalog.items() if not isinstance( v, np.ndarray ) }
+    return arrays, values
+
+
+
+def _open_block( name, size, backing, path=None, create=False, writeable=True ):
+    # A handle on a shared block, and a writable/read-only buffer over it
+    if backing == 'shm':
+        handle = shared_memory.SharedMemory( name=None if create else name, create=create, size=size )
+        return handle, handle.buf
+    with open( path, 'w+b' if create else ( 'r+b' if writeable else 'rb' ) ) as f:
+        if create:
+            f.truncate( size )
+        handle = mmap.mmap( f.fileno(), size, access=mmap.ACCESS_WRITE if writeable else mmap.ACCESS_READ )
+    return handle, memoryview( handle )
+
+
+
+def _views( buf, descriptor, writeable ):
+    # numpy views of each column of a shared block
+    arrays = {}
+    for col, ( dtype, shape, offset ) in descriptor['columns'].items():
+        arrays[col] = np.ndarray( tuple( shape ), dtype=np.dtype( dtype ), buffer=buf, offset=offset )
+        if not writeable:
+            arrays[col].flags.writeable = False
+    return arrays
+
+
+
+def share( catalog, backing='shm', directory=None ):
+    # Copy a catalog's columns into a new shared block; returns its descriptor
+    #   backing: 'shm' (shared memory) or 'mmap' (a file in a new temporary
+    #            directory, under 'directory' if given)
+    if backing not in ( 'shm', 'mmap' ):
+        raise ValueError( "backing must be 'shm' or 'mmap', not '{}'".format( backing ) )
+    arrays, values = _columns( catalog )
+    columns, size = {}, 0
+    for col, values_ in arrays.items():
+        if values_.dtype.hasobject:
+            raise ValueError( "Column '{}' holds Python objects, which can't be shared".format( col ) )
+        columns[col] = [ values_.dtype.str, list( values_.shape ), size ]
+        size += -( -values_.nbytes // ALIGN ) * ALIGN
+
+    path, tmpdir = None, None
+    if backing == 'mmap':
+        tmpdir = tempfile.mkdtemp( prefix='shared_catalog_', dir=directory )
+        path = os.path.join( tmpdir, 'catalog.bin' )
+    handle, buf = _open_block( None, max( size, 1 ), backing, path, create=True )
+    name = handle.name if backing == 'shm' else tmpdir
+    descriptor = { 'name': name, 'backing': backing, 'path': path, 'size': max( size, 1 ),
+                   'columns': columns, 'values': values }
+    for col, view in _views( buf, descriptor, True ).items():
+        view[...] = arrays[col]
+    _OWNED[name] = ( os.getpid(), handle, tmpdir )
+    return descriptor
+
+
+
+def attach( descriptor, writeable=False ):
+    # The catalog of a descriptor from share(), as a dict of numpy views of
+    #   the shared block (read-only unless writeable), plus its other values
+    key = ( descriptor['name'], writeable )
+    if key not in _ATTACHED:
+        handle, buf = _open_block( descriptor['name'], descriptor['size'], descriptor['backing'],
+                                   descriptor['path'], writeable=writeable )
+        _ATTACHED[key] = ( handle, _views( buf, descriptor, writeable ) )
+    arrays = dict( _ATTACHED[key][1] )
+    arrays.update( descriptor['values'] )
+    return arrays
+
+
+
+def _close( handle ):
+    # Close a handle on a block; if views of it are still in use, leave it
+    #   mapped (the memory goes once the views do) rather than fail
+    try:
+        handle.close()
+    except BufferError:
+        if not isinstance( handle, mmap.mmap ):
+            # SharedMemory would try (and fail) again when garbage collected
+            handle.close = lambda: None
+
+
+
+def detach( descriptor ):
+    # Drop this process's attachments to a block
+    for writeable in ( False, True ):
+        entry = _ATTACHED.pop( ( descriptor['name'], writeable ), None )
+        if entry is not None:
+            _close( entry[0] )
+
+
+
+def release( descriptor ):
+    # Free a block made by share() in this process (views of it must not be
+    #   used afterwards)
+    detach( descriptor )
+    entry = _OWNED.pop( descriptor['name'], None )
+    if entry is None:
+        return
+    pid, handle, tmpdir = entry
+    _close( handle )
+    if tmpdir is not None:
+        shutil.rmtree( tmpdir, ignore_errors=True )
+    else:
+        handle.unlink()
+
+
+
+@atexit.register
+def release_all():
+    # Free every block this process made (forked workers inherit the list,
+    #   but only the process which made a block frees it)
+    for name, ( pid, _, _ ) in list( _OWNED.items() ):
+        if pid == os.getpid():
+            release( { 'name': name } )
+
+
+
+@contextmanager
+def shared( catalog, backing='shm', directory=None ):
+    # with shared( catalog ) as descriptor: ... ; released on leaving
+    descriptor = share( catalog, backing, directory )
+    try:
+        yield descriptor
+    finally:
+        release( descriptor )
@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week2; week2.extinction_plotting (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['extinction_plotting', 'fits_query', 'sky_coord_converter'] )
@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import os
-from astropy.table import Table
-import matplotlib.pyplot as plt
+from week2.fits_query import query, source_columns
+from utils.lazy import lazy_import
+plt = lazy_import( 'matplotlib.pyplot' )
 
 # Set up path and file structure
 home = os.getenv("HOME")
@@ -14,11 +15,12 @@ class_path  = home +'/Documents/Classes/TechniquesII/'
 # Read in table 
 def read_table():
     
-    # Read in file as a Table
+    # Print the column names (read from the header only)
     table_fname = class_path +'struc.fits' 
-    objs = Table.read( table_fname )
-    # Print the column names
-    print( objs.colnames )
+    print( source_columns( table_fname ) )
+    
+    # Read only the RA and Dec columns (chunk by chunk, memory-mapped)
+    objs = query( table_fname, ['RA', 'DEC'] )
     
     # Plot RA vs Dec for all sources
     plt.scatter( objs['RA'], objs['DEC'], marker ='+', c='b', alpha=0.5, \
@@ -27,11 +29,12 @@ def read_table():
     plt.ylabel('Declination (degs)')
 
 
-    # Boolean indexing: identify only sources with higher extinction    
-    reddened = objs['EXTINCTION'][:,0] > 0.22
+    # Identify only sources with higher extinction: the cut is applied as
+    #   the file is read, so only those rows are kept (see fits_query.py)
+    reddened = query( table_fname, ['RA', 'DEC'], where='EXTINCTION[0] > 0.22' )
     
     # Overplot these sources in red
-    plt.scatter( objs[reddened]['RA'], objs[reddened]['DEC'], \
+    plt.scatter( reddened['RA'], reddened['DEC'], \
                  marker ='+', c='r', alpha=0.5, label='High extinction' )
     plt.legend()
     # Save figure as PNG
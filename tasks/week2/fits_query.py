@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import ast
+import glob
+import numpy as np
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+fits = lazy_import( 'astropy.io.fits' )
+Table = lazy_import( 'astropy.table', 'Table' )
+
+'''
+ASTRO5160 Week 2: Chunked queries over FITS and columnar catalogs
+-----------------
+-query( source, columns, where ) returns only the matching rows of the
+   requested columns, as a dict of arrays, e.g.
+     query( 'struc.fits', ['RA', 'DEC'], where='EXTINCTION[0] > 0.22' )
+-The source is memory-mapped and scanned chunk_rows rows at a time: the
+   filter is evaluated on each chunk, and only the matching rows of the
+   requested columns are copied out, so memory use follows the size of the
+   result (plus one chunk), not the size of the catalog
+-Sources: a FITS file (first table HDU), a directory of one .npy file per
+   column (query_cache.py caches, sweep_store.py partitions), a dict of
+   arrays, or a list/glob pattern of any of these (results concatenated)
+-Columns and filters are expressions over column names: arithmetic,
+   comparisons, & | ~ (or and/or/not), element access into vector columns
+   (EXTINCTION[0], FLUX_IVAR[-1]) and a few numpy functions (log10, abs, ...)
+-Expressions are parsed (never eval'd), so only the above is accepted
+-----------------
+*Note: run 'python fits_query.py struc.fits --where "EXTINCTION[0] > 0.22" --columns RA DEC'
+'''
+
+# Rows scanned at a time
+CHUNK_ROWS = 2**20
+
+# Functions allowed in expressions
+FUNCTIONS = { 'abs': np.abs, 'sqrt': np.sqrt, 'log10': np.log10, 'log': np.log, 'exp': np.exp,
+              'isfinite': np.isfinite, 'isnan': np.isnan, 'minimum': np.minimum,
+              'maximum': np.maximum }
+
+_BINARY = { ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+            ast.Div: np.true_divide, ast.Pow: np.power, ast.Mod: np.mod,
+            ast.BitAnd: np.logical_and, ast.BitOr: np.logical_or }
+_COMPARE = { ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater,
+             ast.GtE: np.greater_equal, ast.Eq: np.equal, ast.NotEq: np.not_equal }
+_UNARY = { ast.USub: np.negative, ast.UAdd: np.positive, ast.Invert: np.logical_not,
+           ast.Not: np.logical_not }
+
+
+
+def _compile_node( node, columns ):
+    # Turn one node of a parsed expression into a function of a chunk
+    #   (mapping of column name -> array), adding the columns used to columns
+    if isinstance( node, ast.Constant ) and isinstance( node.value, ( int, float, str, bool ) ):
+        value = node.value
+        return lambda data: value
+    if isinstance( node, ast.Name ):
+        name = node.id
+        columns.append( name )
+        return lambda data: data[name]
+    if isinstance( node, ast.Subscript ):
+        # Element of a vector column, e.g. EXTINCTION[0]
+        index = node.slice
+        if not isinstance( node.value, ast.Name ):
+            raise ValueError( "Only columns can be indexed, e.g. EXTINCTION[0]" )
+        try:
+            index = ast.literal_eval( index )
+        except ValueError:
+            raise ValueError( "Column index must be an integer, e.g. EXTINCTION[0]" )
+        if not isinstance( index, int ):
+            raise ValueError( "Column index must be an integer, e.g. EXTINCTION[0]" )
+        name = node.value.id
+        columns.append( name )
+        return lambda data: data[name][:, index]
+    if isinstance( node, ast.BinOp ) and type( node.op ) in _BINARY:
+        f, left, right = _BINARY[ type( node.op ) ], _compile_node( node.left, columns ), \
+                         _compile_node( node.right, columns )
+        return lambda data: f( left( data ), right( data ) )
+    if isinstance( node, ast.UnaryOp ) and type( node.op ) in _UNARY:
+        f, operand = _UNARY[ type( node.op ) ], _compile_node( node.operand, columns )
+        return lambda data: f( operand( data ) )
+    if isinstance( node, ast.BoolOp ):
+        f = np.logical_and if isinstance( node.op, ast.And ) else np.logical_or
+        values = [ _compile_node( v, columns ) for v in node.values ]
+        return lambda data: f.reduce( [ v( data ) for v in values ] )
+    if isinstance( node, ast.Compare ) and all( type( op ) in _COMPARE for op in node.ops ):
+        # Chained comparisons (0.1 < EXTINCTION[0] < 0.3) are and-ed pairs
+        terms = [ _compile_node( v, columns ) for v in [node.left] + node.comparators ]
+        ops = [ _COMPARE[ type( op ) ] for op in node.ops ]
+
+        def compare( data ):
+            values = [ t( data ) for t in terms ]
+            out = ops[0]( values[0], values[1] )
+            for k in range( 1, len(ops) ):
+                out = out & ops[k]( values[k], values[k+1] )
+            return out
+        return compare
+    if isinstance( node, ast.Call ) and isinstance( node.func, ast.Name ) \
+            and node.func.id in FUNCTIONS and not node.keywords:
+        f, args = FUNCTIONS[ node.func.id ], [ _compile_node( a, columns ) for a in node.args ]
+        return lambda data: f( *[ a( data ) for a in args ] )
+    raise ValueError( "Unsupported expression: '{}'".format( ast.unparse( node ) ) )
+
+
+
+def compile_expression( expr ):
+    # Parse an expression over column names (see header); returns
+    #   (function of a chunk, list of the columns it uses)
+    try:
+        tree = ast.parse( expr.strip(), mode='eval' )
+    except SyntaxError as e:
+        raise ValueError( "Can't parse expression '{}': {}".format( expr, e.msg ) )
+    columns = []
+    f = _compile_node( tree.body, columns )
+    return f, list( dict.fromkeys( columns ) )
+
+
+
+def expand_sources( source ):
+    # List of single sources: glob patterns are expanded, lists flattened
+    if isinstance( source, ( list, tuple ) ):
+        return [ s for src in source for s in expand_sources( src ) ]
+    if isinstance( source, str ) and not os.path.exists( source ):
+        files = sorted( glob.glob( source ) )
+        if len(files) == 0:
+            raise ValueError( "No such file or directory: '{}'".format( source ) )
+        return files
+    return [ source ]
+
+
+
+def source_columns( source ):
+    # Column names of a single source, without reading any data
+    if isinstance( source, dict ):
+        return list( source )
+    if os.path.isdir( source ):
+        return sorted( os.path.splitext( f )[0] for f in os.listdir( source ) if f.endswith( '.npy' ) )
+    with fits.open( source, memmap=True ) as hdul:
+        return list( hdul[1].columns.names )
+
+
+
+def iter_chunks( source, chunk_rows=CHUNK_ROWS ):
+    # Yield (mapping of column name -> memory-mapped array view, number of
+    #   rows) for each chunk of a single source; nothing is read until a
+    #   column of a chunk is used
+    if isinstance( source, dict ) or os.path.isdir( source ):
+        if isinstance( source, dict ):
+            data = source
+        else:
+            data = { col: np.load( os.path.join( source, col +'.npy' ), mmap_mode='r' )
+                     for col in source_columns( source ) }
+        nrows = len( next( iter( data.values() ) ) ) if len(data) > 0 else 0
+        for lo in range( 0, nrows, chunk_rows ):
+            hi = min( lo+chunk_rows, nrows )
+            yield { col: values[lo:hi] for col, values in data.items() }, hi-lo
+        return
+    with fits.open( source, memmap=True ) as hdul:
+        data = hdul[1].data
+        nrows = 0 if data is None else len(data)
+        for lo in range( 0, nrows, chunk_rows ):
+            # A FITS_rec slice: columns are views of the memory-mapped file
+            chunk = data[lo:lo+chunk_rows]
+            yield chunk, len(chunk)
+
+
+
+def _native( values ):
+    # Copy of an array in native byte order (FITS data are big-endian)
+    values = np.asarray( values )
+    return values.astype( values.dtype.newbyteorder( '=' ) )
+
+
+
+def iter_query( source, columns=None, where=None, chunk_rows=CHUNK_ROWS ):
+    # Yield the matching rows of each chunk as a dict {column: array}
+    #   columns: names or expressions (default: all columns); keys of the
+    #            output are the strings as given
+    #   where:   filter expression, a function of a chunk returning a boolean
+    #            mask (as for sweep_store.read_partitions), or None for all rows
+    sources = expand_sources( source )
+    if columns is None:
+        columns = source_columns( sources[0] )
+    if isinstance( columns, str ):
+        columns = [columns]
+    compiled = [ compile_expression( c ) for c in columns ]
+    getters = [ f for f, _ in compiled ]
+    if isinstance( where, str ):
+        compiled.append( compile_expression( where ) )
+        where = compiled[-1][0]
+    # Check every column used exists (FITS column names are case-insensitive)
+    names = [ n.upper() for n in source_columns( sources[0] ) ]
+    missing = [ c for _, used in compiled for c in used if c.upper() not in names ]
+    if len(missing) > 0:
+        raise ValueError( "Columns not in {}: {}".format( sources[0], sorted( set( missing ) ) ) )
+    for src in sources:
+        for chunk, nrows in iter_chunks( src, chunk_rows ):
+            with timer( 'query' ):
+                if where is None:
+                    rows = slice( None )
+                else:
+                    keep = np.broadcast_to( np.asarray( where( chunk ), dtype=bool ), (nrows,) )
+                    rows = np.flatnonzero( keep )
+                out = {}
+                for col, get in zip( columns, getters ):
+                    values = get( chunk )
+                    if np.ndim( values ) == 0:
+                        # Constant expression
+                        values = np.full( nrows, values )
+                    out[col] = _native( values[rows] )
+            count( 'rows_scanned', nrows )
+            count( 'rows_returned', len( next( iter( out.values() ) ) ) if len(out) > 0 else 0 )
+            yield out
+
+
+
+def query( source, columns=None, where=None, chunk_rows=CHUNK_ROWS, limit=None ):
+    # All matching rows as one dict {column: array} (see iter_query); limit
+    #   stops the scan once that many rows have been found
+    pieces, found = [], 0
+    for out in iter_query( source, columns, where, chunk_rows ):
+        if limit is not None:
+            out = { c: v[:limit-found] for c, v in out.items() }
+        pieces.append( out )
+        found += len( next( iter( out.values() ) ) ) if len(out) > 0 else 0
+        if limit is not None and found >= limit:
+            break
+    if len(pieces) == 0:
+        return { c: np.zeros( 0 ) for c in ( columns or [] ) }
+    return { c: np.concatenate( [ p[c] for p in pieces ] ) for c in pieces[0] }
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    ap = ArgumentParser( description='Select rows and columns of FITS or columnar catalogs' )
+    ap.add_argument( "sources", nargs='+', help='FITS files, .npy column directories or glob patterns' )
+    ap.add_argument( "--columns", nargs='+', default=None,
+                     help='Columns or expressions to return, e.g. RA DEC "EXTINCTION[0]" (default all)' )
+    ap.add_argument( "--where", default=None, help='Filter, e.g. "EXTINCTION[0] > 0.22"' )
+    ap.add_argument( "--limit", type=int, default=None, help='Stop after this many rows' )
+    ap.add_argument( "--chunk-rows", type=int, default=CHUNK_ROWS, help='Rows scanned at a time' )
+    ap.add_argument( "--out", default=None, help='Write the result to this FITS file' )
+    ns = ap.parse_args()
+
+    result = query( ns.sources, ns.columns, ns.where, chunk_rows=ns.chunk_rows, limit=ns.limit )
+    nrows = len( next( iter( result.values() ) ) ) if len(result) > 0 else 0
+    print( '{:d} rows selected'.format( nrows ) )
+    if ns.out is not None:
+        Table( result ).write( ns.out, format='fits', overwrite=True )
+    else:
+        print( Table( result ) )
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from astropy import units as u
-from astropy.coordinates import SkyCoord
-from astropy.time import Time
 import numpy as np
+from utils.lazy import lazy_import
+u = lazy_import( 'astropy.units' )
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+Time = lazy_import( 'astropy.time', 'Time' )
 
 
 # Retrieve and print coordinates for a given object
@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week3; week3.dust_correction (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['dust_correction', 'frame_transforms', 'visibility', 'wcs_coord_transforms'] )
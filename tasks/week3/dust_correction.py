@@ -1,34 +1,50 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from astropy.coordinates import SkyCoord
-from astropy import units as U
-import dustmaps
-from dustmaps.sfd import SFDQuery
-from dustmaps.config import config
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 import warnings
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+from week3.frame_transforms import transform_lonlat
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+U = lazy_import( 'astropy.units' )
+plt = lazy_import( 'matplotlib.pyplot' )
 warnings.filterwarnings("ignore")
 
+# SFD query, set up on first use (loading the maps is slow, so it's kept)
+_SFD = None
+
 
 
 def setup_sfd():
-    # Set up the SFD dust query
+    # Set up the SFD dust query, once per session
+    #   (dustmaps is only needed here, so it's imported here)
+    global _SFD
+    if _SFD is not None:
+        return _SFD
+    from dustmaps.sfd import SFDQuery
+    from dustmaps.config import config
     home = os.getenv("HOME")
     dust_dir = os.path.join( home, 'Documents', 'Classes', 'Techniques_II', 'dust_maps' )
     config["data_dir"] = dust_dir
-    sfd = SFDQuery()
+    _SFD = SFDQuery()
     
-    return sfd
+    return _SFD
 
 
 def find_reddening( ra, dec ):    
     # Obtain reddening
-    c = SkyCoord( ra*U.degree, dec*U.degree )
-    sfd = setup_sfd() 
-    ebv = sfd(c)
+    #   The SFD maps are in galactic coordinates, so positions are passed
+    #   already converted (with the cached rotation, see frame_transforms.py)
+    #   rather than leaving SFDQuery to run astropy's ICRS->galactic transform
+    with timer( 'skycoord' ):
+        l, b = transform_lonlat( ra, dec, 'icrs', 'galactic' )
+        c = SkyCoord( l*U.degree, b*U.degree, frame='galactic' )
+    with timer( 'dust_query' ):
+        sfd = setup_sfd() 
+        ebv = sfd(c)
+    count( 'dust_positions', np.size( ebv ) )
 
     return ebv
 
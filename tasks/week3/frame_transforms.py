@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 2025
+@author: Tony weinbeck@alum.mit.edu
+
+Cached sky-frame conversions: between 'static' frames (ICRS, FK5 at any
+equinox, Galactic, Supergalactic, barycentric mean ecliptic) a change of
+frame is just a fixed rotation of the unit vector of each position, so the
+3x3 matrix is worked out once (by putting the three axes through astropy's
+own transform) and then applied to whole catalogs as one matrix product,
+with no astropy frame-graph search per call.
+
+Frames which depend on the time and place of observation (AltAz, GCRS,
+CIRS, ...) also involve aberration, refraction etc. and are not a fixed
+rotation; those go through astropy's transform_to, in a single vectorized
+call, and only as far as ICRS when the other frame is static.
+"""
+
+import numpy as np
+from utils.lazy import lazy_import
+coordinates = lazy_import( 'astropy.coordinates' )
+U = lazy_import( 'astropy.units' )
+Time = lazy_import( 'astropy.time', 'Time' )
+
+# Frames which are a fixed rotation of each other, and the default equinox
+#   of those which have one
+STATIC_FRAMES = { 'icrs': None, 'fk5': 'J2000', 'galactic': None, 'supergalactic': None,
+                  'barycentricmeanecliptic': 'J2000' }
+
+# Rotation matrices worked out so far, by (from frame key, to frame key)
+_MATRICES = {}
+
+
+
+def frame_key( frame ):
+    # (name, equinox) identifying a static frame, or None for any other frame;
+    #   the equinox is kept exactly, as the (jd1, jd2) of its TT Julian date
+    #   frame: a name ('fk5'), a (name, equinox) pair (('fk5', 'J1975')), or
+    #          an astropy frame class or instance
+    if isinstance( frame, str ):
+        name, equinox = frame.lower(), None
+    elif isinstance( frame, tuple ):
+        name, equinox = frame[0].lower(), frame[1]
+    elif isinstance( frame, type ):
+        name, equinox = frame.name, None
+    else:
+        name, equinox = frame.name, getattr( frame, 'equinox', None )
+    if name not in STATIC_FRAMES:
+        return None
+    if STATIC_FRAMES[name] is None:
+        return ( name, None )
+    if equinox is None:
+        equinox = STATIC_FRAMES[name]
+    # e.g. 'J1975', 'J1975.0' and Time('J1975') are all the same key, while
+    #   'B1950' and 'J1950' (about 0.9 days apart) are not
+    tt = Time( equinox ).tt
+    return ( name, ( float( tt.jd1 ), float( tt.jd2 ) ) )
+
+
+
+def key_frame( key ):
+    # The frame (as accepted by astropy_frame) for a key from frame_key
+    if key[1] is None:
+        return key[0]
+    return ( key[0], Time( key[1][0], key[1][1], format='jd', scale='tt' ) )
+
+
+
+def astropy_frame( frame ):
+    # An astropy frame instance for any frame accepted by frame_key (or a
+    #   frame instance, returned as it is)
+    if isinstance( frame, str ):
+        return coordinates.frame_transform_graph.lookup_name( frame.lower() )()
+    if isinstance( frame, tuple ):
+        cls = coordinates.frame_transform_graph.lookup_name( frame[0].lower() )
+        return cls( equinox=Time( frame[1] ) )
+    if isinstance( frame, type ):
+        return frame()
+    return frame
+
+
+
+def rotation_matrix( from_frame, to_frame ):
+    # 3x3 matrix R taking unit vectors in from_frame to to_frame (x' = R x),
+    #   for two static frames; worked out once per pair, then cached
+    key = ( frame_key( from_frame ), frame_key( to_frame ) )
+    if key[0] is None or key[1] is None:
+        raise ValueError( "Only static frames {} are fixed rotations of each other".format(
+                          list( STATIC_FRAMES ) ) )
+    if key not in _MATRICES:
+        if key[0] == key[1]:
+            _MATRICES[key] = np.eye( 3 )
+        else:
+            # Images of the x, y and z axes are the columns of the matrix
+            axes = coordinates.SkyCoord( [0., 90., 0.]*U.degree, [0., 0., 90.]*U.degree,
+                                         frame=astropy_frame( key_frame( key[0] ) ) )
+            out  = axes.transform_to( astropy_frame( key_frame( key[1] ) ) )
+            R = out.cartesian.xyz.value
+            # Remove rounding errors, so R stays exactly orthonormal
+            u, _, vt = np.linalg.svd( R )
+            _MATRICES[key] = u @ vt
+            _MATRICES[ key[::-1] ] = ( u @ vt ).T
+    return _MATRICES[key]
+
+
+
+def transform_xyz( xyz, from_frame, to_frame ):
+    # Rotate an (N,3) array of unit vectors from one static frame to another
+    return np.atleast_2d( xyz ) @ rotation_matrix( from_frame, to_frame ).T
+
+
+
+def rotate_lonlat( lon, lat, R ):
+    # Apply rotation matrix R to longitudes/latitudes (degrees); the three
+    #   components are kept as separate arrays (rather than an (N,3) stack as
+    #   radec_to_xyz/xyz_to_radec use) and each output is a 3-term sum, which
+    #   is most of the saving over astropy for large catalogs
+    lon = np.radians( np.asarray( lon, dtype=float ) )
+    lat = np.radians( np.asarray( lat, dtype=float ) )
+    cos_lat = np.cos( lat )
+    x, y, z = cos_lat*np.cos( lon ), cos_lat*np.sin( lon ), np.sin( lat )
+    xr = R[0,0]*x + R[0,1]*y + R[0,2]*z
+    yr = R[1,0]*x + R[1,1]*y + R[1,2]*z
+    zr = R[2,0]*x + R[2,1]*y + R[2,2]*z
+    lon_out = np.degrees( np.arctan2( yr, xr ) ) % 360.
+    lat_out = np.degrees( np.arctan2( zr, np.hypot( xr, yr ) ) )
+    return lon_out, lat_out
+
+
+
+def _astropy_lonlat( lon, lat, from_frame, to_frame ):
+    # transform_lonlat through astropy's frame graph, in one vectorized call
+    c = coordinates.SkyCoord( np.asarray( lon )*U.degree, np.asarray( lat )*U.degree,
+                              frame=astropy_frame( from_frame ) )
+    out = c.transform_to( astropy_frame( to_frame ) ).spherical
+    return out.lon.to_value( U.degree ) % 360., out.lat.to_value( U.degree )
+
+
+
+def transform_lonlat( lon, lat, from_frame, to_frame ):
+    # Convert longitudes/latitudes (degrees: RA/Dec, l/b, ...) from one frame
+    #   to another; returns (lon, lat) arrays in degrees, lon in [0, 360)
+    # Static frames use the cached rotation; any other frame (which may then
+    #   be an astropy frame instance, e.g. AltAz with an array of obstimes)
+    #   goes through astropy, but only as far as ICRS if the other is static
+    from_key, to_key = frame_key( from_frame ), frame_key( to_frame )
+    if from_key is not None and to_key is not None:
+        return rotate_lonlat( lon, lat, rotation_matrix( from_frame, to_frame ) )
+    if to_key is not None:
+        lon, lat = _astropy_lonlat( lon, lat, from_frame, 'icrs' )
+        return rotate_lonlat( lon, lat, rotation_matrix( 'icrs', to_frame ) )
+    if from_key is not None:
+        lon, lat = rotate_lonlat( lon, lat, rotation_matrix( from_frame, 'icrs' ) )
+        from_frame = 'icrs'
+    return _astropy_lonlat( lon, lat, from_frame, to_frame )
+
+
+
+def transform_coord( coord, to_frame ):
+    # SkyCoord.transform_to, using the cached rotation whenever both frames
+    #   are static and the coordinates are directions only (no distances or
+    #   velocities); otherwise astropy's own transform_to
+    static = frame_key( coord.frame ) is not None and frame_key( to_frame ) is not None
+    if not static or 's' in coord.data.differentials \
+            or not isinstance( coord.data, coordinates.UnitSphericalRepresentation ):
+        return coord.transform_to( astropy_frame( to_frame ) )
+    sph = coord.spherical
+    lon, lat = transform_lonlat( sph.lon.to_value( U.degree ), sph.lat.to_value( U.degree ),
+                                 coord.frame, to_frame )
+    frame = astropy_frame( to_frame )
+    return coordinates.SkyCoord( frame.realize_frame(
+                coordinates.UnitSphericalRepresentation( lon*U.degree, lat*U.degree ) ) )
+
+
+
+
+if __name__ == '__main__':
+
+    # Compare against astropy on a random catalog (matrices worked out
+    #   before timing, as they are once per session)
+    import time
+    num = 1000000
+    ras  = 360. * np.random.random( num )
+    decs = np.degrees( np.arcsin( 1 - 2*np.random.random( num ) ) )
+    for frame in ['galactic', 'fk5', ('fk5', 'J1950'), 'supergalactic', 'barycentricmeanecliptic']:
+        rotation_matrix( 'icrs', frame )
+        t0 = time.time()
+        l, b = transform_lonlat( ras, decs, 'icrs', frame )
+        t1 = time.time()
+        c = coordinates.SkyCoord( ras*U.degree, decs*U.degree ).transform_to( astropy_frame( frame ) )
+        t2 = time.time()
+        sep = coordinates.angular_separation( l*U.degree, b*U.degree, c.spherical.lon, c.spherical.lat )
+        print( '{:>30s}: cached {:.3f} s, astropy {:.3f} s, max difference {:.2e} arcsec'.format(
+               str( frame ), t1-t0, t2-t1, sep.to_value( U.arcsec ).max() ) )
+
+    # Single positions, as in a loop over sources: here the frame-graph
+    #   search astropy does on every call dominates
+    reps = 1000
+    t0 = time.time()
+    for i in range( reps ):
+        transform_lonlat( ras[i], decs[i], 'icrs', 'galactic' )
+    t1 = time.time()
+    for i in range( reps ):
+        coordinates.SkyCoord( ras[i]*U.degree, decs[i]*U.degree ).transform_to( 'galactic' )
+    t2 = time.time()
+    print( '{:>30s}: cached {:.1f} us, astropy {:.1f} us per call'.format(
+           'single positions', (t1-t0)/reps*1e6, (t2-t1)/reps*1e6 ) )
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 2025
+@author: Tony weinbeck@alum.mit.edu
+
+Target visibility for observation planning: altitude, azimuth, airmass and
+hour angle of many targets at many times, as (times x targets) arrays.
+
+Everything which depends only on the time is worked out once per time, not
+per target: the precession-nutation matrix (GCRS to CIRS, IAU 2006/2000A),
+the equation of the origins and the Earth's velocity change slowly, so they
+are computed (with erfa, as astropy does) once per day, kept in a cache, and
+interpolated to each time; the Earth rotation angle is computed exactly for
+each time. Together with the observer's longitude and latitude they make one
+3x3 matrix per time, from ICRS directions to the local horizon, so the
+whole grid is a single matrix product of the (times x 3) rows with the
+(3 x targets) unit vectors, plus annual and diurnal aberration.
+
+Altitudes are geometric (no refraction, like astropy's AltAz with the
+default pressure of 0); polar motion and light deflection are ignored,
+which keeps positions within ~0.5" of astropy's AltAz. The airmass is sec(z)
+(NaN below the horizon). Grids larger than max_bytes are worked out (and
+can be reduced, as observable_time does) a chunk of times at a time.
+
+The grid is float32 by default (half the memory, and faster): ~0.01" in
+positions, except altitudes within a degree or so of the zenith (up to
+~10", from the arcsin); ask for dtype=np.float64 to avoid that.
+"""
+
+import numpy as np
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+erfa = lazy_import( 'erfa' )
+EarthLocation = lazy_import( 'astropy.coordinates', 'EarthLocation' )
+U = lazy_import( 'astropy.units' )
+Time = lazy_import( 'astropy.time', 'Time' )
+
+# Quantities a grid can hold (degrees, except airmass: sec(z), ha: hours, and
+#   sinalt: sin(alt), the cheapest, with no trigonometry, for thresholds)
+QUANTITIES = ['alt', 'az', 'airmass', 'ha', 'sinalt']
+
+# Memory for the arrays of one chunk of times (bytes)
+CHUNK_BYTES = 2**28
+
+# Earth's rotation rate (rad/s)
+OMEGA_EARTH = 7.292115e-5
+
+# Slowly varying terms by TT day (integer MJD): GCRS->CIRS matrix, equation
+#   of the origins, barycentric velocity of the Earth / c, geocentric Sun
+_EPOCHS = {}
+
+
+
+def _location( location ):
+    # (longitude, latitude) in radians and distance from the Earth's axis
+    #   (m) of an EarthLocation, or of a (longitude, latitude[, height])
+    #   tuple in degrees (and m)
+    if not hasattr( location, 'geodetic' ):
+        location = EarthLocation.from_geodetic( *location )
+    lon = location.geodetic.lon.to_value( U.radian )
+    lat = location.geodetic.lat.to_value( U.radian )
+    axis = np.hypot( location.x.to_value( U.m ), location.y.to_value( U.m ) )
+    return float( lon ), float( lat ), float( axis )
+
+
+
+def _day_terms( days ):
+    # Slowly varying terms for integer TT MJDs, as stacked arrays; days not
+    #   in the cache are worked out together, in one call of each erfa routine
+    missing = sorted( set( days.tolist() ) - set( _EPOCHS ) )
+    if len(missing) > 0:
+        jd = np.array( missing, dtype=float ) + 2400000.5
+        zero = np.zeros( len(jd) )
+        c2i = erfa.c2i06a( jd, zero )
+        eo  = erfa.eo06a( jd, zero )
+        pvh, pvb = erfa.epv00( jd, zero )
+        beta = pvb['v'] * erfa.DAU / erfa.DAYSEC / erfa.CMPS
+        sun  = -pvh['p'] / np.linalg.norm( pvh['p'], axis=1 )[:,None]
+        for k, day in enumerate( missing ):
+            _EPOCHS[day] = ( c2i[k], eo[k], beta[k], sun[k] )
+        count( 'visibility_days', len(missing) )
+    terms = [ _EPOCHS[day] for day in days.tolist() ]
+    return [ np.array( t ) for t in zip( *terms ) ]
+
+
+
+def _ut1( times ):
+    # UT1 of the times (UTC if IERS tables don't cover them: <0.9 s off)
+    try:
+        return times.ut1
+    except Exception:
+        return times.utc
+
+
+
+def epoch_terms( times, location ):
+    # Everything the grid needs which depends only on the time, for each
+    #   time: 'M' (T,3,3) rotation from ICRS to the local (north, east, up)
+    #   axes, 'beta' (T,3) the observer's velocity / c in ICRS axes, 'lst'
+    #   local apparent sidereal time (hours) and 'sun_alt' (degrees)
+    times = Time( times )
+    lon, lat, axis = _location( location )
+    tt = np.atleast_1d( times.tt.mjd )
+    days = np.floor( tt ).astype( np.int64 )
+    frac = ( tt - days )[:,None]
+    with timer( 'visibility_epochs' ):
+        # Interpolate the daily terms linearly to each time
+        uniq, inv = np.unique( np.concatenate( [days, days+1] ), return_inverse=True )
+        c2i, eo, beta, sun = _day_terms( uniq )
+        lo, hi = inv[:len(days)], inv[len(days):]
+        c2i  = c2i[lo] + frac[:,:,None]*( c2i[hi] - c2i[lo] )
+        eo   = eo[lo] + frac[:,0]*( eo[hi] - eo[lo] )
+        beta = beta[lo] + frac*( beta[hi] - beta[lo] )
+        sun  = sun[lo] + frac*( sun[hi] - sun[lo] )
+
+        # Local angle of the Earth's rotation, then rotate about the pole by
+        #   it and tilt the pole to the zenith (rows: north, east, up axes)
+        ut1 = _ut1( times )
+        theta = erfa.era00( np.atleast_1d( ut1.jd1 ), np.atleast_1d( ut1.jd2 ) ) + lon
+        c, s = np.cos( theta ), np.sin( theta )
+        z, o = np.zeros( len(theta) ), np.ones( len(theta) )
+        spin = np.stack( [ np.stack( [c, s, z], -1 ), np.stack( [-s, c, z], -1 ),
+                           np.stack( [z, z, o], -1 ) ], 1 )
+        tilt = np.array( [ [ -np.sin( lat ), 0., np.cos( lat ) ], [ 0., 1., 0. ],
+                           [ np.cos( lat ), 0., np.sin( lat ) ] ] )
+        M = tilt @ spin @ c2i
+
+        # Diurnal aberration: the observer moves east at OMEGA_EARTH * axis
+        #   (the east axis in ICRS is the second row of M)
+        beta = beta + M[:,1,:] * ( OMEGA_EARTH*axis/erfa.CMPS )
+        lst = np.degrees( theta - eo ) / 15. % 24.
+        sun_up = np.einsum( 'tj,tj->t', M[:,2,:], sun )
+        sun_alt = np.degrees( np.arcsin( np.clip( sun_up, -1., 1. ) ) )
+    return { 'M': M, 'beta': beta, 'lst': lst, 'sun_alt': sun_alt }
+
+
+
+def unit_vectors( ra, dec, dtype=np.float64 ):
+    # (3, N) ICRS unit vectors of RA/Dec (degrees)
+    ra  = np.radians( np.atleast_1d( np.asarray( ra, dtype=float ) ) )
+    dec = np.radians( np.atleast_1d( np.asarray( dec, dtype=float ) ) )
+    return np.stack( [ np.cos( dec )*np.cos( ra ), np.cos( dec )*np.sin( ra ), np.sin( dec ) ] ).astype( dtype )
+
+
+
+def _rows_needed( quantities ):
+    # Local axes (0: north, 1: east, 2: up) the quantities need
+    rows = set()
+    for q in quantities:
+        if q not in QUANTITIES:
+            raise ValueError( "Unknown quantity '{}' (choose from {})".format( q, QUANTITIES ) )
+        rows.update( { 'alt': [2], 'airmass': [2], 'sinalt': [2], 'az': [0, 1], 'ha': [0, 1, 2] }[q] )
+    return sorted( rows )
+
+
+
+def grid_chunk( u, terms, sl, quantities, lat, dtype=np.float32 ):
+    # Quantities for the times terms[...][sl] and all targets (unit vectors
+    #   u, (3,N)), as (times x targets) arrays of dtype
+    rows = _rows_needed( quantities )
+    M, beta = terms['M'][sl], terms['beta'][sl]
+    # One matrix product for every needed axis and the aberration dot product
+    A = np.concatenate( [ M[:,rows,:], beta[:,None,:] ], axis=1 )
+    prod = ( A.reshape( -1, 3 ).astype( dtype ) @ u ).reshape( len(A), len(rows)+1, -1 )
+    local = {}
+    beta_local = np.einsum( 'tij,tj->ti', M, beta )
+    for k, row in enumerate( rows ):
+        local[row] = prod[:,k,:] + beta_local[:,row,None].astype( dtype )
+    # Apparent direction: (u + beta) / |u + beta|
+    norm = np.sqrt( 1 + 2*prod[:,-1,:] + ( beta**2 ).sum( 1 )[:,None].astype( dtype ) )
+
+    out = {}
+    if 'alt' in quantities or 'airmass' in quantities or 'sinalt' in quantities:
+        up = local[2] / norm
+        if 'sinalt' in quantities:
+            out['sinalt'] = up
+        if 'alt' in quantities:
+            out['alt'] = np.degrees( np.arcsin( np.clip( up, -1, 1 ) ) )
+        if 'airmass' in quantities:
+            with np.errstate( divide='ignore' ):
+                out['airmass'] = np.where( up > 0, 1 / up, np.nan ).astype( dtype )
+    if 'az' in quantities:
+        out['az'] = np.degrees( np.arctan2( local[1], local[0] ) ) % 360
+    if 'ha' in quantities:
+        # Hour angle: westward from the meridian, in the plane of the equator
+        meridian = np.cos( lat )*local[2] - np.sin( lat )*local[0]
+        out['ha'] = np.degrees( np.arctan2( -local[1], meridian ) ) / 15
+    return out
+
+
+
+def visibility_chunks( ra, dec, times, location, quantities=QUANTITIES, dtype=np.float32,
+                       max_bytes=CHUNK_BYTES ):
+    # Yield (slice of times, {quantity: (times in slice x targets) array,
+    #   'lst': ..., 'sun_alt': ...}) for consecutive chunks of times, each
+    #   chunk's arrays taking about max_bytes at most
+    yield from _chunks( unit_vectors( ra, dec, dtype ), epoch_terms( times, location ),
+                        _location( location )[1], quantities, dtype, max_bytes )
+
+
+
+def _chunks( u, terms, lat, quantities, dtype, max_bytes ):
+    # visibility_chunks, for unit vectors and epoch terms already worked out
+    ntimes, ntargets = len( terms['lst'] ), u.shape[1]
+    # Per time: the matrix product, its sums and the outputs
+    row_bytes = ntargets * np.dtype( dtype ).itemsize * ( len( _rows_needed( quantities ) ) + 3 + len(quantities) )
+    step = max( 1, int( max_bytes // max( row_bytes, 1 ) ) )
+    for start in range( 0, ntimes, step ):
+        sl = slice( start, min( start+step, ntimes ) )
+        with timer( 'visibility_grid' ):
+            out = grid_chunk( u, terms, sl, quantities, lat, dtype )
+        out['lst'], out['sun_alt'] = terms['lst'][sl], terms['sun_alt'][sl]
+        count( 'visibility_chunks' )
+        yield sl, out
+
+
+
+def visibility( ra, dec, times, location, quantities=QUANTITIES, dtype=np.float32,
+                max_bytes=CHUNK_BYTES ):
+    # The whole grid: {quantity: (times x targets) array, 'lst': (times,),
+    #   'sun_alt': (times,)}, filled in chunks (see visibility_chunks)
+    grid = None
+    for sl, out in visibility_chunks( ra, dec, times, location, quantities, dtype, max_bytes ):
+        if grid is None:
+            ntimes = len( np.atleast_1d( Time( times ).jd ) )
+            grid = { q: np.empty( ( ntimes, ) + out[q].shape[1:], dtype=out[q].dtype ) for q in out }
+        for q, values in out.items():
+            grid[q][sl] = values
+    return grid
+
+
+
+def observable_time( ra, dec, times, location, min_alt=30., max_airmass=None, sun_alt=-12.,
+                     max_bytes=CHUNK_BYTES ):
+    # For each target, over times when the Sun is below sun_alt (degrees):
+    #   'hours' spent above min_alt (and below max_airmass, if given), with
+    #   each time counting for the median spacing of the times, 'min_airmass'
+    #   and 'best_time' (index into times of that minimum; NaN and -1 if the
+    #   target is never above the horizon then)
+    # Only dark times are worked out, only sin(alt), and never the whole grid
+    lowest = np.sin( np.radians( min_alt ) )
+    if max_airmass is not None:
+        lowest = max( lowest, 1 / max_airmass )
+    jd = np.atleast_1d( Time( times ).jd )
+    step = float( np.median( np.diff( jd ) ) ) * 24. if len(jd) > 1 else 0.
+    terms = epoch_terms( times, location )
+    dark = np.flatnonzero( terms['sun_alt'] < sun_alt )
+    terms = { k: v[dark] for k, v in terms.items() }
+
+    u = unit_vectors( ra, dec, np.float32 )
+    samples = np.zeros( u.shape[1], dtype=np.int64 )
+    best = np.zeros( u.shape[1] )
+    best_time = np.full( u.shape[1], -1, dtype=np.int64 )
+    for sl, out in _chunks( u, terms, _location( location )[1], ['sinalt'], np.float32, max_bytes ):
+        up = out['sinalt']
+        samples += np.count_nonzero( up >= lowest, axis=0 )
+        k = np.argmax( up, axis=0 )
+        highest = up[ k, np.arange( u.shape[1] ) ]
+        better = highest > best
+        best[better], best_time[better] = highest[better], dark[ k[better] + sl.start ]
+    with np.errstate( divide='ignore' ):
+        min_airmass = np.where( best > 0, 1 / best, np.nan )
+    return { 'hours': samples * step, 'min_airmass': min_airmass, 'best_time': best_time }
+
+
+
+
+if __name__ == '__main__':
+
+    # Check against astropy's AltAz, then time a semester plan
+    import time
+    from astropy.coordinates import SkyCoord, AltAz
+    laramie = EarthLocation.from_geodetic( -105.5911, 41.3114, 2184. )
+    rng = np.random.default_rng( 5160 )
+    num = 200
+    ras  = 360. * rng.random( num )
+    decs = np.degrees( np.arcsin( 1 - 2*rng.random( num ) ) )
+    times = Time( '2025-11-01T03:00' ) + np.linspace( 0., 30., 50 )*U.day
+
+    grid = visibility( ras, decs, times, laramie, dtype=np.float64 )
+    t0 = time.time()
+    frame = AltAz( location=laramie, obstime=times[:,None] )
+    altaz = SkyCoord( ras*U.degree, decs*U.degree )[None,:].transform_to( frame )
+    t1 = time.time()
+    from astropy.coordinates import angular_separation
+    sep = angular_separation( grid['az']*U.degree, grid['alt']*U.degree, altaz.az, altaz.alt )
+    print( 'Max difference from AltAz: {:.3f} arcsec (astropy {:.2f} s for {:d} positions)'.format(
+           sep.to_value( U.arcsec ).max(), t1-t0, sep.size ) )
+    high = altaz.alt.degree > 10
+    print( 'Max airmass difference above 10 deg: {:.2e}'.format(
+           np.abs( grid['airmass'][high] - altaz.secz.value[high] ).max() ) )
+    lst = times.sidereal_time( 'apparent', longitude=laramie.lon ).hour
+    print( 'Max LST difference: {:.3f} s'.format( np.abs( ( grid['lst'] - lst + 12 ) % 24 - 12 ).max()*3600 ) )
+
+    # Semester: 1e4 targets every 5 minutes for 182 days
+    num = 10000
+    ras  = 360. * rng.random( num )
+    decs = np.degrees( np.arcsin( 1 - 2*rng.random( num ) ) )
+    times = Time( '2026-01-01' ) + np.arange( 0., 182., 5./1440 )*U.day
+    t0 = time.time()
+    plan = observable_time( ras, decs, times, laramie, min_alt=30., sun_alt=-12. )
+    t1 = time.time()
+    print( '{:d} targets x {:d} times: {:.1f} s; median {:.0f} h observable'.format(
+           num, len(times), t1-t0, np.median( plan['hours'] ) ) )
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from astropy.coordinates import SkyCoord, AltAz
-from astropy import units as U
-from astropy.coordinates import EarthLocation
-from astropy.time import Time
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import dates
 import warnings
+from utils.lazy import lazy_import
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+AltAz    = lazy_import( 'astropy.coordinates', 'AltAz' )
+U = lazy_import( 'astropy.units' )
+EarthLocation = lazy_import( 'astropy.coordinates', 'EarthLocation' )
+Time = lazy_import( 'astropy.time', 'Time' )
+plt = lazy_import( 'matplotlib.pyplot' )
+dates = lazy_import( 'matplotlib.dates' )
+from week3.frame_transforms import transform_coord, transform_lonlat
 warnings.filterwarnings("ignore")
 
 
@@ -100,7 +103,7 @@ if __name__ == '__main__':
     print( 'Object name: ' +name +':' )
     coords = SkyCoord( frame='galactic', l=0*U.degree, b=0*U.degree )
     print( 'Constellation: ' +coords.get_constellation( coords ) )
-    coords = coords.transform_to('fk5')
+    coords = transform_coord( coords, 'fk5' )
     print_ra_dec( coords )
     print( 'This is on the very eastern edge of Sagittarius, '\
             'very nearly falling within Scorpius/Serpens.')
@@ -112,16 +115,13 @@ if __name__ == '__main__':
     # Get Location object for Laramie
     laramie = EarthLocation.of_address('Laramie, WY')
     t = Time('2025-01-01')
-    t.to_value('mjd')
-    (times, ras, decs) = ( [], [], [] )
-    # Get galactic lat and galactic long at zenith from Laramie
-    for i in range(365):
-        t2 = t + i
-        zenith = AltAz( alt=90*U.degree, az=0*U.degree, location=laramie, obstime=t2 )
-        coord=SkyCoord(zenith).transform_to('galactic')
-        ras.append( float(coord.l.deg) )
-        decs.append( float(coord.b.deg) )
-        times.append( t2.to_value('iso') )
+    # Get galactic lat and galactic long at zenith from Laramie, for all
+    #   365 days in one AltAz frame (to ICRS through astropy, then to
+    #   galactic with the cached rotation; see frame_transforms.py)
+    obstimes = t + np.arange( 365 )
+    zenith = AltAz( location=laramie, obstime=obstimes )
+    ras, decs = transform_lonlat( np.zeros( 365 ), np.full( 365, 90. ), zenith, 'galactic' )
+    times = list( obstimes.to_value('iso') )
 
     # Make plots of l and b during year    
     plt.scatter(times, ras, label='Galactic Longitude (l)', s=5 )
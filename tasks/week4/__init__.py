@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week4; week4.find_matching_sources (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['find_matching_sources', 'map_projections', 'sky_density', 'sphere_randoms'] )
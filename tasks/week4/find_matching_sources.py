@@ -5,11 +5,12 @@ Created on Fri Feb 14 12:15:36 2025
 @author: Tony weinbeck@alum.mit.edu
 """
 
-from astropy.coordinates import SkyCoord
-import astropy.units as U
 import numpy as np
 from numpy.random import random
-import matplotlib.pyplot as plt
+from utils.lazy import lazy_import
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+U = lazy_import( 'astropy.units' )
+plt = lazy_import( 'matplotlib.pyplot' )
 
 pi=np.pi
 
@@ -7,11 +7,14 @@ Created on Fri Feb 14 10:14:30 2025
 
 import numpy as np
 from numpy.random import random
-import matplotlib.pyplot as plt
+from week4.sky_density import plot_sky_density
+from utils.lazy import lazy_import
+plt = lazy_import( 'matplotlib.pyplot' )
 pi = np.pi
 
 
 # Creates a series of random RA's and Dec's, and plots them on three different projections
+#   (as density images, so even millions of sources plot quickly)
 def compare_projections( num_sources ):
 
     # Generate list of RA's ranging from [-pi, pi) 
@@ -22,7 +25,7 @@ def compare_projections( num_sources ):
     # Plot on cartesian grid
     fig = plt.figure()
     ax = fig.add_subplot(111, projection="rectilinear")
-    ax.scatter( ras, decs, marker='o', color='r', s=0.7, alpha=0.3 )
+    plot_sky_density( ax, ras, decs, color='r' )
     xlab = ['14h','16h','18h','20h','22h','0h','2h','4h','6h','8h','10h']
     ax.set_xticklabels( xlab, weight=400, color='k' )
     ax.set_xlabel( 'RA ')
@@ -36,7 +39,7 @@ def compare_projections( num_sources ):
     # Plot with Aitoff projection
     fig = plt.figure()
     ax = fig.add_subplot(111, projection="aitoff")
-    ax.scatter( ras, decs, marker='o', color='r', s=0.7, alpha=0.3 )
+    plot_sky_density( ax, ras, decs, color='r' )
     xlab = ['14h','16h','18h','20h','22h','0h','2h','4h','6h','8h','10h']
     ax.set_xticklabels( xlab, weight=600, color='k' )
     ax.grid( color='b', linestyle='dashed', linewidth=1 )
@@ -47,7 +50,7 @@ def compare_projections( num_sources ):
     # Plot with Lambert projection
     fig = plt.figure()
     ax = fig.add_subplot(111, projection="lambert")
-    ax.scatter( ras, decs, marker='o', color='r', s=0.7, alpha=0.3 )
+    plot_sky_density( ax, ras, decs, color='r' )
     xlab = ['14h','16h','18h','20h','22h','0h','2h','4h','6h','8h','10h']
     ax.set_xticklabels( xlab, weight=600 )
     ax.grid( color='b', linestyle='dashed', linewidth=1 )
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 2025
+@author: Tony weinbeck@alum.mit.edu
+
+Random points uniform in area inside spherical regions: RA/Dec boxes
+(including boxes wrapping through RA = 0), caps, and unions of them.
+
+Each region is sampled exactly (RA uniform, sin(Dec) uniform in a box; cos
+of the distance from the center uniform in a cap), so nothing is rejected
+except, for a union, points which also fall in an earlier region (as for
+overlapping polygons in mask_randoms.py).
+
+Points are generated in fixed-size chunks, chunk i always from its own
+random stream spawned from (seed, i) (see chunk_rng in mask_randoms.py),
+so the output depends only on the regions, the number of points, the seed
+and the chunk size: never on the number of worker processes or the order
+the chunks are done in. write_randoms has each worker write its chunks
+straight into their own rows of memory-mapped .npy columns, so 10^9
+randoms need no more memory than a few chunks.
+"""
+
+import os
+import json
+import numpy as np
+from week6.cap_geometry import radec_to_xyz
+from week6.mask_randoms import cap_frames, chunk_rng, MAX_BATCH
+from utils.lazy import lazy_import
+ProcessPoolExecutor = lazy_import( 'concurrent.futures', 'ProcessPoolExecutor' )
+
+pi = np.pi
+
+# Points per chunk (one random stream each)
+CHUNK_ROWS = 2**22
+
+# Description of the run, written (last) alongside the RA.npy/DEC.npy columns
+RANDOMS_FILE = 'randoms.json'
+
+
+
+def box( ramin, ramax, decmin, decmax ):
+    # RA/Dec box (degrees), ramin <= RA < ramax and decmin <= Dec < decmax
+    #   ramin > ramax wraps through RA = 0, e.g. box( 350, 10, -5, 5 );
+    #   box( 0, 360, -90, 90 ) is the whole sky
+    if decmin < -90. or decmax > 90. or decmax <= decmin or ramin == ramax:
+        msg = "Strange input: [ramin, ramax, decmin, decmax] = {}".format( [ramin, ramax, decmin, decmax] )
+        raise ValueError( msg )
+    width = ( ramax - ramin ) % 360.
+    if width == 0:
+        width = 360.
+    return { 'type': 'box', 'args': [ ramin, ramax, decmin, decmax ],
+             'ramin': ramin % 360., 'width': width,
+             'zmin': np.sin( np.radians( decmin ) ), 'zmax': np.sin( np.radians( decmax ) ) }
+
+
+
+def cap( ra, dec, radius ):
+    # Cap of the given radius (degrees) around (ra, dec)
+    if radius <= 0 or radius > 180.:
+        raise ValueError( "Cap radius must be in (0, 180] degrees, not {}".format( radius ) )
+    center = radec_to_xyz( ra, dec )
+    u, v = cap_frames( center )
+    return { 'type': 'cap', 'args': [ ra, dec, radius ], 'center': center[0],
+             'u': u[0], 'v': v[0], 'cos_r': np.cos( np.radians( radius ) ) }
+
+
+
+def region_from_args( kind, args ):
+    # Rebuild a region from its type and arguments (as saved in RANDOMS_FILE)
+    if kind == 'box':
+        return box( *args )
+    if kind == 'cap':
+        return cap( *args )
+    raise ValueError( "Unknown region type '{}'".format( kind ) )
+
+
+
+def region_area( region ):
+    # Area of a region (steradians)
+    if region['type'] == 'box':
+        return np.radians( region['width'] ) * ( region['zmax'] - region['zmin'] )
+    return 2*pi * ( 1. - region['cos_r'] )
+
+
+
+def in_region( region, ras, decs ):
+    # True for points (degrees) inside the region
+    ras, decs = np.radians( ras ), np.radians( decs )
+    if region['type'] == 'box':
+        z = np.sin( decs )
+        return ( ( np.degrees( ras ) - region['ramin'] ) % 360. < region['width'] ) \
+             & ( z >= region['zmin'] ) & ( z < region['zmax'] )
+    cx, cy, cz = region['center']
+    return np.cos( decs ) * ( np.cos( ras )*cx + np.sin( ras )*cy ) + np.sin( decs )*cz >= region['cos_r']
+
+
+
+def sample_region( region, num, rng ):
+    # num random (RA, Dec) points (degrees) uniform inside one region
+    if region['type'] == 'box':
+        ras = ( region['ramin'] + region['width'] * rng.random( num ) ) % 360.
+        z   = region['zmin'] + ( region['zmax'] - region['zmin'] ) * rng.random( num )
+        return ras, np.degrees( np.arcsin( z ) )
+    # Distance from the center (cos_t) and position angle (phi), then
+    #   x = cos_t*center + sin_t*(cos(phi)*u + sin(phi)*v), one component at
+    #   a time rather than as (N,3) arrays
+    cos_t = 1. - rng.random( num ) * ( 1. - region['cos_r'] )
+    sin_t = np.sqrt( 1. - cos_t**2 )
+    phi   = 2*pi * rng.random( num )
+    a, b  = sin_t*np.cos( phi ), sin_t*np.sin( phi )
+    c, u, v = region['center'], region['u'], region['v']
+    x = cos_t*c[0] + a*u[0] + b*v[0]
+    y = cos_t*c[1] + a*u[1] + b*v[1]
+    z = cos_t*c[2] + a*u[2] + b*v[2]
+    ras  = np.degrees( np.arctan2( y, x ) ) % 360.
+    decs = np.degrees( np.arcsin( np.clip( z, -1., 1. ) ) )
+    return ras, decs
+
+
+
+def draw_points( regions, num, rng ):
+    # num random (RA, Dec) points uniform in area over the union of regions
+    #   The points are shared out among the regions in proportion to area
+    #   (multinomially), and those drawn in a region which an earlier region
+    #   also contains are dropped, so overlaps are not sampled twice; the
+    #   result is shuffled, so any subset of rows is itself uniform
+    regions = [ regions ] if isinstance( regions, dict ) else list( regions )
+    areas = np.array( [ region_area( r ) for r in regions ] )
+    if len(regions) == 0 or areas.sum() <= 0:
+        raise ValueError( "Regions have no area" )
+    if len(regions) == 1:
+        return sample_region( regions[0], num, rng )
+    ras, decs = [], []
+    n_have = 0
+    efficiency = 1.   # Acceptance rate; only below 1 where regions overlap
+    while n_have < num:
+        n_try = int( min( MAX_BATCH, 1.05*(num - n_have)/efficiency + 100 ) )
+        ra, dec = [], []
+        for i, n in enumerate( rng.multinomial( n_try, areas/areas.sum() ) ):
+            r, d = sample_region( regions[i], n, rng )
+            keep = np.ones( n, dtype=bool )
+            for j in range( i ):
+                keep[keep] = ~in_region( regions[j], r[keep], d[keep] )
+            ra.append( r[keep] )
+            dec.append( d[keep] )
+        ra, dec = np.concatenate( ra ), np.concatenate( dec )
+        efficiency = max( len(ra) / n_try, 1e-3 )
+        order = rng.permutation( len(ra) )[: num - n_have]
+        ras.append( ra[order] )
+        decs.append( dec[order] )
+        n_have += len(order)
+    return np.concatenate( ras ), np.concatenate( decs )
+
+
+
+def chunk_bounds( num, chunk_rows=CHUNK_ROWS ):
+    # (first row, number of rows) of each chunk
+    return [ ( lo, min( chunk_rows, num-lo ) ) for lo in range( 0, num, chunk_rows ) ]
+
+
+
+def iter_randoms( regions, num, seed, chunk_rows=CHUNK_ROWS ):
+    # Generator yielding (ras, decs) for each chunk, in order
+    for ichunk, (lo, n) in enumerate( chunk_bounds( num, chunk_rows ) ):
+        yield draw_points( regions, n, chunk_rng( seed, ichunk ) )
+
+
+
+def random_points( regions, num, seed, chunk_rows=CHUNK_ROWS ):
+    # All num points in memory, identical to the columns written by write_randoms
+    chunks = list( iter_randoms( regions, num, seed, chunk_rows ) )
+    if len(chunks) == 0:
+        return np.zeros( 0 ), np.zeros( 0 )
+    return np.concatenate( [c[0] for c in chunks] ), np.concatenate( [c[1] for c in chunks] )
+
+
+
+def _write_chunk( args ):
+    # Worker for write_randoms (must be at module level to be pickled):
+    #   draws one chunk and writes it into its own rows of the output columns
+    outdir, regions, seed, ichunk, lo, n = args
+    ras, decs = draw_points( regions, n, chunk_rng( seed, ichunk ) )
+    for col, values in ( ('RA', ras), ('DEC', decs) ):
+        out = np.load( os.path.join( outdir, col +'.npy' ), mmap_mode='r+' )
+        out[lo:lo+n] = values
+        out.flush()
+        del out
+    return ichunk
+
+
+
+def write_randoms( outdir, regions, num, seed, nproc=1, chunk_rows=CHUNK_ROWS ):
+    # Write num randoms over the union of regions to outdir/RA.npy and
+    #   outdir/DEC.npy (float64, degrees), chunk by chunk on nproc processes
+    #   The columns can be read back memory-mapped (np.load(..., mmap_mode='r')),
+    #   or queried with week2/fits_query.py; RANDOMS_FILE is written last, so
+    #   a directory without one holds an unfinished run
+    regions = [ regions ] if isinstance( regions, dict ) else list( regions )
+    os.makedirs( outdir, exist_ok=True )
+    if os.path.exists( os.path.join( outdir, RANDOMS_FILE ) ):
+        os.remove( os.path.join( outdir, RANDOMS_FILE ) )
+    for col in ['RA', 'DEC']:
+        out = np.lib.format.open_memmap( os.path.join( outdir, col +'.npy' ), mode='w+',
+                                         dtype=np.float64, shape=(num,) )
+        del out
+
+    jobs = [ ( outdir, regions, seed, ichunk, lo, n )
+             for ichunk, (lo, n) in enumerate( chunk_bounds( num, chunk_rows ) ) ]
+    if nproc > 1:
+        with ProcessPoolExecutor( max_workers=nproc ) as pool:
+            list( pool.map( _write_chunk, jobs ) )
+    else:
+        for job in jobs:
+            _write_chunk( job )
+
+    meta = { 'num': int( num ), 'seed': seed, 'chunk_rows': int( chunk_rows ),
+             'regions': [ { 'type': r['type'], 'args': [ float( a ) for a in r['args'] ] } for r in regions ],
+             'area_deg2': float( union_area( regions ) * (180./pi)**2 ) }
+    with open( os.path.join( outdir, RANDOMS_FILE ), 'w' ) as fp:
+        json.dump( meta, fp, indent=1 )
+    return outdir
+
+
+
+def union_area( regions, num=10**6, seed=0 ):
+    # Area (steradians) of a union of regions: exact if they don't overlap,
+    #   otherwise estimated from the fraction of num points drawn in
+    #   proportion to area which no earlier region also contains
+    regions = [ regions ] if isinstance( regions, dict ) else list( regions )
+    total = sum( region_area( r ) for r in regions )
+    if len(regions) < 2:
+        return total
+    rng = np.random.default_rng( seed )
+    cdf = np.cumsum( [ region_area( r ) for r in regions ] )
+    which = np.searchsorted( cdf, rng.random( num )*cdf[-1], side='right' )
+    owned = np.ones( num, dtype=bool )
+    for i, r in enumerate( regions ):
+        sel = which == i
+        ras, decs = sample_region( r, sel.sum(), rng )
+        for j in range( i ):
+            owned[ np.flatnonzero( sel )[ in_region( regions[j], ras, decs ) ] ] = False
+    return total * owned.mean()
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import time
+
+    ap = ArgumentParser( description='Write reproducible randoms over a union of RA/Dec boxes and caps' )
+    ap.add_argument( "outdir", help='Output directory (RA.npy, DEC.npy, ' +RANDOMS_FILE +')' )
+    ap.add_argument( "num", type=float, help='Number of randoms, e.g. 1e9' )
+    ap.add_argument( "--box", nargs=4, type=float, action='append', default=[],
+                     metavar=('RAMIN', 'RAMAX', 'DECMIN', 'DECMAX'), help='RA/Dec box (RAMIN > RAMAX wraps)' )
+    ap.add_argument( "--cap", nargs=3, type=float, action='append', default=[],
+                     metavar=('RA', 'DEC', 'RADIUS'), help='Cap (degrees)' )
+    ap.add_argument( "--seed", type=int, default=1, help='Random seed' )
+    ap.add_argument( "--nproc", type=int, default=1, help='Worker processes' )
+    ap.add_argument( "--chunk-rows", type=int, default=CHUNK_ROWS, help='Points per chunk' )
+    ns = ap.parse_args()
+
+    regions = [ box( *b ) for b in ns.box ] + [ cap( *c ) for c in ns.cap ]
+    if len(regions) == 0:
+        regions = [ box( 0., 360., -90., 90. ) ]
+    t0 = time.time()
+    write_randoms( ns.outdir, regions, int( ns.num ), ns.seed, nproc=ns.nproc, chunk_rows=ns.chunk_rows )
+    print( 'Wrote {:d} randoms to {} in {:.2f} s'.format( int( ns.num ), ns.outdir, time.time()-t0 ) )
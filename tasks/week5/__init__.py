@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week5; week5.healpix (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['healpix', 'spherical_caps', 'angular_correlation'] )
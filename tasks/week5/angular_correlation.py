@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Angular two-point correlation function
+
+DD, DR and RR pair counts in logarithmic angular bins, the Landy-Szalay
+estimator w(theta) = (DD - 2DR + RR)/RR (each count normalized by its number
+of pairs), and jackknife errors.
+
+Pairs are counted exactly, but without looking at most of them one by one:
+both catalogs are sorted by (NESTED) HEALPix pixel at a fine order, so every
+pixel at any coarser order is one contiguous block of rows. Starting from
+large pixels, a pair of pixels whose separations must all be outside the
+bins is dropped, a pair whose separations must all fall in one bin
+adds (weight in one) x (weight in the other) to that bin in one go, and
+any other pair is split into its 4 x 4 child pixels; only small pairs of
+pixels (or pixels at the finest order) are counted point by point. Most of
+the work is then near the bin edges, rather than in all N1 x N2 pairs.
+
+Jackknife regions are groups of coarse HEALPix pixels holding equal numbers
+of randoms. Counts are kept for each pair of regions, so all of the
+delete-one estimates come from a single pass.
+"""
+
+import numpy as np
+from contextlib import nullcontext
+from week6.cap_geometry import radec_to_xyz
+from utils.instrument import timed, count
+from utils.shared_catalog import shared, attach
+from utils.lazy import lazy_import
+ProcessPoolExecutor = lazy_import( 'concurrent.futures', 'ProcessPoolExecutor' )
+hp = lazy_import( 'healpy' )
+
+pi = np.pi
+
+# Finest HEALPix order (Nside=65536, ~3 arcsec pixels); pixels are never
+#   split further than this
+LEAF_ORDER = 16
+
+# Order at which pairs of pixels are first listed, and then shared out
+#   among worker processes
+START_ORDER = 3
+
+# Order of the pixels jackknife regions are made of (Nside=16, ~3.7 deg)
+JK_ORDER = 4
+
+# Pairs of pixels holding at most this many pairs of points are counted
+#   point by point rather than split further
+BRUTE_PAIRS = 256
+
+# Most pixel pairs, and point pairs, handled in one go (bounds memory use)
+MAX_CELL_PAIRS  = 2**18
+MAX_POINT_PAIRS = 2**19
+
+# Default bins: 10 logarithmic bins from 0.01 to 1 degree
+DEFAULT_EDGES = np.logspace( -2, 0, 11 )
+
+# Catalogs used by worker processes (set by _init_worker)
+_CATALOGS = {}
+
+
+
+def jackknife_regions( ras, decs, njk, order=JK_ORDER ):
+    # Region number of every (NESTED) pixel at the given order: runs of
+    #   consecutive pixels (which are close together on the sky) each
+    #   holding ~1/njk of the given points (normally the randoms)
+    npix = hp.order2npix( order )
+    counts = np.bincount( hp.ang2pix( hp.order2nside( order ), ras, decs, nest=True, lonlat=True ),
+                          minlength=npix )
+    before = np.cumsum( counts ) - counts
+    return np.minimum( ( before * njk ) // max( counts.sum(), 1 ), njk-1 ).astype( np.int32 )
+
+
+
+def prepare_catalog( ras, decs, weights=None, regions=None, jk_order=JK_ORDER, order=LEAF_ORDER ):
+    # Sort a catalog by pixel at the finest order, for pair counting
+    #   regions: jackknife region of each pixel at jk_order (from
+    #            jackknife_regions), or None for no jackknife
+    ras  = np.asarray( ras,  dtype=float )
+    decs = np.asarray( decs, dtype=float )
+    pix  = hp.ang2pix( hp.order2nside( order ), ras, decs, nest=True, lonlat=True )
+    rows = np.argsort( pix, kind='stable' )
+    pix  = pix[rows]
+    w = np.ones( len(rows) ) if weights is None else np.asarray( weights, dtype=float )[rows]
+    if regions is None:
+        region = np.zeros( len(rows), dtype=np.int32 )
+    else:
+        region = regions[ pix >> 2*(order - jk_order) ]
+    # Unit vectors stored as (3, N), so x, y and z are each contiguous
+    return { 'order': order, 'pix': pix, 'xyz': np.ascontiguousarray( radec_to_xyz( ras[rows], decs[rows] ).T ),
+             'w': w, 'cumw': np.r_[ 0., np.cumsum( w ) ], 'region': region,
+             'njk': 1 if regions is None else int( regions.max() ) + 1, 'jk_order': jk_order }
+
+
+
+def cell_ranges( cat, cells, order ):
+    # First and last+1 rows of a sorted catalog in each pixel at order
+    shift = 2*( cat['order'] - order )
+    cells = np.asarray( cells, dtype=np.int64 )
+    return np.searchsorted( cat['pix'], cells << shift ), np.searchsorted( cat['pix'], (cells+1) << shift )
+
+
+
+def cell_separations( p, q, order ):
+    # Angle (radians) between the centers of pixels p and q at order
+    nside = hp.order2nside( order )
+    c1 = np.array( hp.pix2vec( nside, p, nest=True ) )
+    c2 = np.array( hp.pix2vec( nside, q, nest=True ) )
+    return np.arctan2( np.linalg.norm( np.cross( c1, c2, axis=0 ), axis=0 ), np.sum( c1*c2, axis=0 ) )
+
+
+
+def start_pairs( cat1, cat2, theta_max, order=START_ORDER ):
+    # All pairs of non-empty pixels at order which may hold pairs of points
+    #   closer than theta_max (radians)
+    shift1 = 2*( cat1['order'] - order )
+    shift2 = 2*( cat2['order'] - order )
+    cells1 = np.unique( cat1['pix'] >> shift1 )
+    cells2 = np.unique( cat2['pix'] >> shift2 )
+    p = np.repeat( cells1, len(cells2) )
+    q = np.tile( cells2, len(cells1) )
+    near = cell_separations( p, q, order ) - 2*hp.max_pixrad( hp.order2nside( order ) ) < theta_max
+    return p[near], q[near]
+
+
+
+def expand_ranges( lo, n ):
+    # Concatenation of arange(lo[k], lo[k]+n[k]) over k
+    return np.repeat( lo - np.cumsum( n ) + n, n ) + np.arange( n.sum() )
+
+
+
+def count_points( cat1, cat2, lo1, n1, lo2, n2, cos_edges, counts ):
+    # Count every pair of points between row blocks [lo1, lo1+n1) of cat1
+    #   and [lo2, lo2+n2) of cat2, adding weight products into counts
+    #   (flattened (njk, njk, nbins))
+    #   cos_edges: cosines of the bin edges, in increasing order; the cosine
+    #   of each separation (a dot product) is good to ~1e-16, i.e. ~1e-12
+    #   radians even at 0.01 degree, far finer than any bin
+    nb, njk = len(cos_edges) - 1, cat1['njk']
+    x1, x2 = cat1['xyz'], cat2['xyz']
+    ends = np.cumsum( n1 * n2 )
+    start = 0
+    while start < len(n1):
+        # As many blocks as fit in MAX_POINT_PAIRS (at least one)
+        done = ends[start-1] if start > 0 else 0
+        stop = max( np.searchsorted( ends, done + MAX_POINT_PAIRS, side='right' ), start+1 )
+        k = slice( start, stop )
+        # Each row of a block in cat1, repeated once per row of the block in cat2
+        rep = np.repeat( n2[k], n1[k] )
+        i = np.repeat( expand_ranges( lo1[k], n1[k] ), rep )
+        j = expand_ranges( np.repeat( lo2[k], n1[k] ), rep )
+        cos_sep = x1[0][i]*x2[0][j] + x1[1][i]*x2[1][j] + x1[2][i]*x2[2][j]
+        b = nb - np.searchsorted( cos_edges, cos_sep )
+        ok = ( b >= 0 ) & ( b < nb )
+        i, j, b = i[ok], j[ok], b[ok]
+        index = ( cat1['region'][i] * njk + cat2['region'][j] ) * nb + b
+        counts += np.bincount( index, weights=cat1['w'][i] * cat2['w'][j], minlength=len(counts) )
+        count( 'point_pairs', int( ends[stop-1] - done ) )
+        start = stop
+
+
+
+def cell_info( cat, cells, order ):
+    # Row ranges and centers of pixels at order, each looked up once however
+    #   many pixel pairs it appears in; returns (inverse, lo, hi, centers)
+    #   with inverse mapping each of the given cells to its row in the others
+    cells, inverse = np.unique( cells, return_inverse=True )
+    lo, hi = cell_ranges( cat, cells, order )
+    centers = np.array( hp.pix2vec( hp.order2nside( order ), cells, nest=True ) )
+    return inverse, lo, hi, centers
+
+
+
+def count_cells( cat1, cat2, p, q, order, edges, counts ):
+    # Count all pairs of points in pixels p (of cat1) x q (of cat2) at order,
+    #   splitting pixel pairs as needed (see header); edges in radians
+    nb, njk = len(edges) - 1, cat1['njk']
+    cos_edges = np.cos( edges[::-1] )
+    # Angles here are only compared with edges to decide what to do with a
+    #   pixel pair; a small margin keeps rounding from deciding it wrongly
+    eps = 1e-12
+    stack = [ ( order, np.asarray( p, dtype=np.int64 ), np.asarray( q, dtype=np.int64 ) ) ]
+    while len(stack) > 0:
+        order, p, q = stack.pop()
+        if len(p) > MAX_CELL_PAIRS:
+            stack.append( ( order, p[MAX_CELL_PAIRS:], q[MAX_CELL_PAIRS:] ) )
+            p, q = p[:MAX_CELL_PAIRS], q[:MAX_CELL_PAIRS]
+        inv1, lo1, hi1, c1 = cell_info( cat1, p, order )
+        inv2, lo2, hi2, c2 = cell_info( cat2, q, order )
+        full = ( hi1[inv1] > lo1[inv1] ) & ( hi2[inv2] > lo2[inv2] )
+        p, q, inv1, inv2 = p[full], q[full], inv1[full], inv2[full]
+        count( 'cell_pairs', len(p) )
+        if len(p) == 0:
+            continue
+
+        # Range of separations possible between points in each pixel pair
+        rad = 2*hp.max_pixrad( hp.order2nside( order ) )
+        a, b = c1[:,inv1], c2[:,inv2]
+        sep = np.arctan2( np.linalg.norm( np.cross( a, b, axis=0 ), axis=0 ), np.sum( a*b, axis=0 ) )
+        bmin = np.searchsorted( edges, sep - rad - eps, side='right' ) - 1
+        bmax = np.searchsorted( edges, sep + rad + eps, side='right' ) - 1
+        live = ( bmax >= 0 ) & ( bmin < nb )
+        lo1, n1 = lo1[inv1], hi1[inv1] - lo1[inv1]
+        lo2, n2 = lo2[inv2], hi2[inv2] - lo2[inv2]
+
+        # Whole pixel pairs in a single bin (only once pixels are no larger
+        #   than jackknife pixels, so each lies in a single region)
+        whole = live & ( bmin == bmax ) & ( order >= cat1['jk_order'] )
+        if whole.any():
+            w12 = ( cat1['cumw'][lo1[whole] + n1[whole]] - cat1['cumw'][lo1[whole]] ) \
+                * ( cat2['cumw'][lo2[whole] + n2[whole]] - cat2['cumw'][lo2[whole]] )
+            index = ( cat1['region'][lo1[whole]] * njk + cat2['region'][lo2[whole]] ) * nb + bmin[whole]
+            counts += np.bincount( index, weights=w12, minlength=len(counts) )
+
+        # Small pixel pairs point by point, the rest split into children
+        rest = live & ~whole
+        brute = rest & ( ( n1*n2 <= BRUTE_PAIRS ) | ( order >= cat1['order'] ) )
+        if brute.any():
+            count_points( cat1, cat2, lo1[brute], n1[brute], lo2[brute], n2[brute], cos_edges, counts )
+        split = rest & ~brute
+        if split.any():
+            kids = np.arange( 4 )
+            p4 = ( 4*p[split][:,None] + kids ).repeat( 4, axis=1 ).ravel()
+            q4 = np.tile( 4*q[split][:,None] + kids, (1, 4) ).ravel()
+            stack.append( ( order+1, p4, q4 ) )
+    return counts
+
+
+
+def _init_worker( cat1, cat2 ):
+    # Give each worker process the catalogs once, rather than with every task
+    #   (descriptors of shared-memory copies, in worker processes)
+    _CATALOGS['cat1'] = attach( cat1 ) if 'backing' in cat1 else cat1
+    _CATALOGS['cat2'] = attach( cat2 ) if 'backing' in cat2 else cat2
+
+
+
+def _count_worker( args ):
+    # Worker for pair_counts (must be at module level to be pickled)
+    p, q, order, edges = args
+    cat1, cat2 = _CATALOGS['cat1'], _CATALOGS['cat2']
+    counts = np.zeros( cat1['njk']**2 * ( len(edges)-1 ) )
+    return count_cells( cat1, cat2, p, q, order, edges, counts )
+
+
+
+@timed( 'pair_counts' )
+def pair_counts( cat1, cat2, edges=DEFAULT_EDGES, nproc=1, ntasks=None ):
+    # Weighted counts of ordered pairs (point in cat1, point in cat2) in each
+    #   bin of separation (edges in degrees), for each pair of jackknife
+    #   regions: an (njk, njk, nbins) array
+    #   For an auto-correlation pass the same catalog twice: every pair is
+    #   then counted in both orders (a point is never paired with itself, as
+    #   long as edges[0] > 0)
+    #   The start pixel pairs are shared out over ntasks tasks (default
+    #   8*nproc) run on nproc processes; the result does not depend on nproc
+    edges = np.radians( np.asarray( edges, dtype=float ) )
+    if edges[0] <= 0 or np.any( np.diff( edges ) <= 0 ):
+        raise ValueError( "Bin edges must be positive and increasing" )
+    if cat1['njk'] != cat2['njk'] or cat1['jk_order'] != cat2['jk_order']:
+        raise ValueError( "Catalogs were prepared with different jackknife regions" )
+    njk, nb = cat1['njk'], len(edges) - 1
+    order = min( START_ORDER, cat1['order'] )
+    p, q = start_pairs( cat1, cat2, edges[-1], order )
+
+    # Interleave the pixel pairs among tasks, so each gets a similar share
+    #   of dense and sparse parts of the sky
+    ntasks = ntasks or 8*nproc
+    tasks = [ ( p[k::ntasks], q[k::ntasks], order, edges ) for k in range( ntasks ) ]
+    if nproc > 1:
+        # Workers map the catalogs from shared memory instead of each
+        #   unpickling its own copy
+        with shared( cat1 ) as desc1, ( nullcontext( desc1 ) if cat2 is cat1 else shared( cat2 ) ) as desc2, \
+             ProcessPoolExecutor( max_workers=nproc, initializer=_init_worker,
+                                  initargs=( desc1, desc2 ) ) as pool:
+            parts = list( pool.map( _count_worker, tasks ) )
+    else:
+        _init_worker( cat1, cat2 )
+        parts = [ _count_worker( t ) for t in tasks ]
+        _CATALOGS.clear()
+    return np.sum( parts, axis=0 ).reshape( njk, njk, nb )
+
+
+
+def pair_norms( cat1, cat2, auto ):
+    # Number of (weighted, ordered) pairs overall and with each jackknife
+    #   region left out: arrays of length 1 + njk
+    njk = cat1['njk']
+    w1  = np.bincount( cat1['region'], weights=cat1['w'],    minlength=njk )
+    w2  = np.bincount( cat2['region'], weights=cat2['w'],    minlength=njk )
+    ww1 = np.bincount( cat1['region'], weights=cat1['w']**2, minlength=njk )
+    W1  = np.r_[ w1.sum(),  w1.sum()  - w1  ]
+    W2  = np.r_[ w2.sum(),  w2.sum()  - w2  ]
+    WW1 = np.r_[ ww1.sum(), ww1.sum() - ww1 ]
+    return W1*W1 - WW1 if auto else W1*W2
+
+
+
+def leave_one_out( counts ):
+    # Pair counts overall and with each jackknife region left out: an
+    #   (1 + njk, nbins) array from the (njk, njk, nbins) region-pair counts
+    total = counts.sum( axis=(0, 1) )
+    rows  = counts.sum( axis=1 )
+    cols  = counts.sum( axis=0 )
+    diag  = np.einsum( 'kkb->kb', counts )
+    return np.vstack( [ total, total - rows - cols + diag ] )
+
+
+
+def landy_szalay( dd, dr, rr, ndd, ndr, nrr ):
+    # Landy-Szalay estimator from raw pair counts and their numbers of pairs
+    #   (dd, rr being ordered pair counts, so ndd, nrr count ordered pairs too)
+    dd, dr, rr = dd / ndd, dr / ndr, rr / nrr
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        return ( dd - 2*dr + rr ) / rr
+
+
+
+def angular_correlation( data_ras, data_decs, rand_ras, rand_decs, edges=DEFAULT_EDGES, njk=32,
+                         data_weights=None, rand_weights=None, nproc=1 ):
+    # w(theta) of a data catalog, against randoms covering the same area
+    #   (e.g. from mask_randoms.py or week4/sphere_randoms.py)
+    #   njk: number of jackknife regions (0 or 1 for none)
+    # Returns a dict with the bin edges and centers (degrees), w, its
+    #   jackknife errors and covariance, the leave-one-out w's, and the
+    #   raw DD, DR, RR counts
+    edges = np.asarray( edges, dtype=float )
+    regions = jackknife_regions( rand_ras, rand_decs, njk ) if njk > 1 else None
+    data = prepare_catalog( data_ras, data_decs, data_weights, regions )
+    rand = prepare_catalog( rand_ras, rand_decs, rand_weights, regions )
+
+    dd = leave_one_out( pair_counts( data, data, edges, nproc ) )
+    dr = leave_one_out( pair_counts( data, rand, edges, nproc ) )
+    rr = leave_one_out( pair_counts( rand, rand, edges, nproc ) )
+    norms = [ pair_norms( data, data, True ), pair_norms( data, rand, False ), pair_norms( rand, rand, True ) ]
+    w_all = landy_szalay( dd, dr, rr, *[ n[:,None] for n in norms ] )
+
+    result = { 'edges': edges, 'theta': np.sqrt( edges[1:] * edges[:-1] ), 'w': w_all[0],
+               'dd': dd[0], 'dr': dr[0], 'rr': rr[0], 'njk': data['njk'] }
+    if data['njk'] > 1:
+        w_jk = w_all[1:]
+        n = len(w_jk)
+        diff = w_jk - w_jk.mean( axis=0 )
+        result['w_jk'] = w_jk
+        result['cov']  = ( n-1 )/n * diff.T @ diff
+        result['w_err'] = np.sqrt( np.diag( result['cov'] ) )
+    return result
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from week2.fits_query import query
+    import time
+
+    ap = ArgumentParser( description='Angular correlation function w(theta) (Landy-Szalay, jackknife errors)' )
+    ap.add_argument( "data", help='Data catalog: FITS file or directory of RA.npy/DEC.npy columns' )
+    ap.add_argument( "randoms", help='Randoms, e.g. from week4/sphere_randoms.py' )
+    ap.add_argument( "--bins", nargs=3, type=float, default=[0.01, 1., 10], metavar=('MIN', 'MAX', 'N'),
+                     help='Logarithmic bins (degrees)' )
+    ap.add_argument( "--njk", type=int, default=32, help='Jackknife regions' )
+    ap.add_argument( "--nproc", type=int, default=1, help='Worker processes' )
+    ns = ap.parse_args()
+
+    t0 = time.time()
+    data = query( ns.data, ['RA', 'DEC'] )
+    rand = query( ns.randoms, ['RA', 'DEC'] )
+    edges = np.logspace( np.log10( ns.bins[0] ), np.log10( ns.bins[1] ), int( ns.bins[2] ) + 1 )
+    result = angular_correlation( data['RA'], data['DEC'], rand['RA'], rand['DEC'], edges,
+                                  njk=ns.njk, nproc=ns.nproc )
+    print( '{:d} data, {:d} randoms, {:.1f} s'.format( len(data['RA']), len(rand['RA']), time.time()-t0 ) )
+    print( '  theta (deg)          w       error' )
+    err = result.get( 'w_err', np.full( len(result['w']), np.nan ) )
+    for theta, w, e in zip( result['theta'], result['w'], err ):
+        print( '{:12.4f} {:12.5f} {:10.5f}'.format( theta, w, e ) )
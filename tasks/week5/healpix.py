@@ -9,9 +9,11 @@ Class 9: HEALPix
 
 import numpy as np
 from numpy.random import random as rand
-import healpy as hp
-import matplotlib.pyplot as plt
+from week4.sky_density import plot_sky_density
 import warnings
+from utils.lazy import lazy_import
+hp = lazy_import( 'healpy' )
+plt = lazy_import( 'matplotlib.pyplot' )
 warnings.filterwarnings('ignore')
 
 pi = np.pi
@@ -69,8 +71,8 @@ def create_points( num_points, Nside ):
 
 
 def plot_points( ras, decs, color, ax, label='' ):
-    # Print given points onto a map
-    ax.scatter( ras-pi, decs, marker='o', color=color, s=.5, alpha=0.01, label=label )
+    # Print given points (in radians) onto a map, as a density image
+    plot_sky_density( ax, ras-pi, decs, color=color, label=label )
     return
 
 
@@ -126,7 +128,7 @@ if __name__ == "__main__":
     ax.grid( color='k', linestyle='dashed', linewidth=.5 )
     
     # Plot all points in gray, and then specific pixels in various colors
-    plot_points( ras, decs, 'gray', ax )
+    plot_points( ras*pi/180, decs*pi/180, 'gray', ax )
     plot_specific_pixel( ras, decs, pix, 2, 'b', ax )
     plot_specific_pixel( ras, decs, pix, 5, 'g', ax )
     plot_specific_pixel( ras, decs, pix, 8, 'r', ax )
@@ -7,10 +7,11 @@ Astro 5160
 Class 10: Spherical Caps
 """
 
-from astropy.coordinates import SkyCoord
-from astropy import units as U
 import numpy as np
 import re  # To replace characters in a string
+from utils.lazy import lazy_import
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+U = lazy_import( 'astropy.units' )
 
 
 
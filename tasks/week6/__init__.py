@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week6; week6.cap_geometry (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['cap_geometry', 'general_masking', 'mangle', 'mask_operations', 'mask_randoms', 'pixel_coverage', 'polygon_area'] )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Cap geometry: vectorized spherical-cap helpers shared by the masking tools
+"""
+
+import numpy as np
+
+pi = np.pi
+
+# A padding cap that every point on the sphere lies inside (1 - p.c <= 2 < 3)
+ALWAYS_IN_CAP = np.array( [0., 0., 1., 3.] )
+
+
+
+def radec_to_xyz( ras, decs ):
+    # Convert RA/Dec (degrees) into an (N,3) array of unit vectors
+    ras  = np.radians( np.atleast_1d( np.asarray( ras,  dtype=float ) ) )
+    decs = np.radians( np.atleast_1d( np.asarray( decs, dtype=float ) ) )
+    cos_dec = np.cos( decs )
+    return np.stack( [ cos_dec*np.cos( ras ), cos_dec*np.sin( ras ), np.sin( decs ) ], axis=-1 )
+
+
+
+def xyz_to_radec( xyz ):
+    # Convert an (N,3) array of (not necessarily normalized) vectors into
+    #   RA in [0, 360) and Dec in [-90, 90], both in degrees
+    xyz  = np.atleast_2d( xyz )
+    ras  = np.degrees( np.arctan2( xyz[:,1], xyz[:,0] ) ) % 360.
+    decs = np.degrees( np.arctan2( xyz[:,2], np.hypot( xyz[:,0], xyz[:,1] ) ) )
+    return ras, decs
+
+
+
+def cap_theta( cm ):
+    # Opening angle (radians) of the region kept by a cap with size cm = 1-cos(theta)
+    #   A negative cm is a complemented cap, which keeps everything farther
+    #   than arccos(1+cm) from the cap center, i.e. a cap of pi - arccos(1+cm)
+    #   around the antipode
+    cm = np.asarray( cm, dtype=float )
+    theta = np.arccos( np.clip( 1. - np.abs( cm ), -1., 1. ) )
+    return np.where( cm < 0, pi - theta, theta )
+
+
+
+def in_polygon( caps, xyz ):
+    # True for each point (row of xyz) lying inside every cap of one polygon
+    #   caps: (ncaps, 4) array of [x, y, z, cm], using the Mangle convention
+    #   that a point p is in a cap if 1 - p.c < cm, or 1 - p.c > -cm for cm < 0
+    caps = np.atleast_2d( caps )
+    cdotm = 1. - np.atleast_2d( xyz ) @ caps[:,:3].T
+    inside = np.where( caps[:,3] < 0, cdotm > -caps[:,3], cdotm < caps[:,3] )
+    return np.all( inside, axis=1 )
+
+
+
+def pad_caps( polys ):
+    # Stack a list of polygons with varying numbers of caps into a single
+    #   (npoly, maxcaps, 4) array, padding with caps that contain the whole sphere
+    maxcaps = max( len(p) for p in polys )
+    padded = np.tile( ALWAYS_IN_CAP, ( len(polys), maxcaps, 1 ) )
+    for i, p in enumerate( polys ):
+        padded[ i, :len(p) ] = p
+    return padded
+
+
+
+def in_polygons( padded, polyids, xyz ):
+    # True for each point lying inside its own polygon, where point i is
+    #   tested against polygon polyids[i] of the padded cap array
+    caps  = padded[ polyids ]
+    cdotm = 1. - np.einsum( 'ij,ikj->ik', np.atleast_2d( xyz ), caps[:,:,:3] )
+    cm    = caps[:,:,3]
+    inside = np.where( cm < 0, cdotm > -cm, cdotm < cm )
+    return np.all( inside, axis=1 )
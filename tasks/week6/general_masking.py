@@ -7,13 +7,14 @@ Astro 5160
 Class 12: General_Masking
 """
 
-from astropy.coordinates import SkyCoord
-from astropy import units as U
 import numpy as np
-import pymangle as pm
-import matplotlib.pyplot as plt
 import re  # To replace characters in a string
 import warnings
+from utils.lazy import lazy_import
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+U = lazy_import( 'astropy.units' )
+pm = lazy_import( 'pymangle' )
+plt = lazy_import( 'matplotlib.pyplot' )
 warnings.filterwarnings('ignore')
 
 pi = np.pi
@@ -31,15 +32,23 @@ def return_cap_vector( ra, dec, rad ):
 
 
 
-def write_to_mangle_file( *vs, fname='', sters=0 ):
+def write_to_mangle_file( *vs, fname='', sters=None, weights=None ):
     # Prints polygons with specific formatting to a Mangle file
     #   Accepts a variable number of polygons, and a variable number of spherical
     #   caps within each polygon
     # If have a list of areas for each polygon, can include in arguments
-    #   ( len(sters) must match len(vs) )
+    #   ( len(sters) must match len(vs) ); otherwise the exact area of each
+    #   polygon is calculated and filled in
+    # Similarly for the weight of each polygon (default 1)
+    # (imported here, as polygon_area itself builds on this file)
+    from week6.polygon_area import polygon_areas
 
     # The number of ordered arguments (=num of polygons)
     n_polys = len(vs)
+    if sters is None:
+        sters = polygon_areas( vs )
+    if weights is None:
+        weights = [1] * n_polys
 
     with open(fname, "w") as f:
         i = 1  # To keep track of which polygon we're printing
@@ -47,13 +56,10 @@ def write_to_mangle_file( *vs, fname='', sters=0 ):
         for v in vs:
             n_caps = len(v)       # Number of caps for current polygon
 
-            # If being fed the areas for each polygon, set appropriately
-            if len(sters) != 0:
-                ster = sters[i-1]  # b/c zero-ordering
-            else: ster = 0
+            ster = sters[i-1]  # b/c zero-ordering
 
             # Print output to file
-            print( 'polygon ' +str(i) +' ( ' +str(n_caps) +' caps, 1 weight, ' \
+            print( 'polygon ' +str(i) +' ( ' +str(n_caps) +' caps, ' +str(weights[i-1]) +' weight, ' \
                   +'0 pixel, ' +str(ster) +' str):', file=f )
             np.set_printoptions(formatter={'float': '{:12.9f}'.format})
             print( ' ' +re.sub( r"[\[\]]", "", str(v)  ), file=f )
@@ -63,6 +69,35 @@ def write_to_mangle_file( *vs, fname='', sters=0 ):
 
 
 
+def read_mangle_file( fname ):
+    # Reads a Mangle polygon file (as written above, or by Mangle itself) back
+    #   into the same form accepted by write_to_mangle_file
+    # Returns a list of (n_caps, 4) cap arrays, plus the weight and area (str)
+    #   listed in each polygon header
+    polys, weights, sters = [], [], []
+    with open(fname) as f:
+        tokens = []
+        n_caps = 0
+        for line in f:
+            if line.startswith( 'polygon' ):
+                # e.g. 'polygon 1 ( 4 caps, 1 weight, 0 pixel, 0.0123 str):'
+                fields = re.split( r"[\s(),:]+", line.strip() )
+                n_caps = int( fields[ fields.index('caps') - 1 ] )
+                weights.append( float( fields[ fields.index('weight') - 1 ] ) )
+                sters.append( float( fields[ fields.index('str') - 1 ] ) )
+                tokens = []
+                if n_caps == 0:
+                    polys.append( np.zeros( (0, 4) ) )
+            elif n_caps > 0:
+                # Cap lines are 'x y z cm'; collect until this polygon is complete
+                tokens += line.split()
+                if len(tokens) >= 4*n_caps:
+                    polys.append( np.array( tokens[:4*n_caps], dtype=float ).reshape( n_caps, 4 ) )
+                    n_caps = 0
+    return polys, np.array( weights ), np.array( sters )
+
+
+
 def calc_area( ra_min, ra_max, dec_min, dec_max ):
     # Calculate area of lat-long rectangle using formula derived in notes
     ster = pi/180 * (ra_max-ra_min) \
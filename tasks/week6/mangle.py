@@ -7,13 +7,17 @@ Astro 5160
 Class 11: Mangle
 """
 
-from astropy.coordinates import SkyCoord
-from astropy import units as U
 import numpy as np
-import pymangle as pm
-import matplotlib.pyplot as plt
 import re  # To replace characters in a string
+from week6.general_masking import read_mangle_file
+from week6.mask_randoms import genrand_mask
+from week6.polygon_area import polygon_areas
+from week4.sky_density import plot_sky_density
 import warnings
+from utils.lazy import lazy_import
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+U = lazy_import( 'astropy.units' )
+plt = lazy_import( 'matplotlib.pyplot' )
 warnings.filterwarnings('ignore')
 
 pi = np.pi
@@ -35,9 +39,11 @@ def write_to_mangle_file( *vs, fname='' ):
     # Prints polygons with specific formatting to a Mangle file
     #   Accepts a variable number of polygons, and a variable number of spherical
     #   caps within each polygon
+    #   The exact area of each polygon is filled in as its 'str' value
 
     # The number of arguments (=num of polygons)
     n_polys = len(vs)
+    sters = polygon_areas( vs )
 
     with open(fname, "w") as f:
         i = 1  # To keep track of which polygon we're printing
@@ -46,7 +52,8 @@ def write_to_mangle_file( *vs, fname='' ):
             n_caps = len(v)       # Number of caps for current polygon
 
             # Print output to file
-            print( 'polygon ' +str(i) +' ( ' +str(n_caps) +' caps, 1 weight, 0 pixel, 0 str):', file=f )
+            print( 'polygon ' +str(i) +' ( ' +str(n_caps) +' caps, 1 weight, 0 pixel, ' \
+                  +str(sters[i-1]) +' str):', file=f )
             np.set_printoptions(formatter={'float': '{:12.9f}'.format})
             print( ' ' +re.sub( r"[\[\]]", "", str(v)  ), file=f )
             # This is ugly but it just prints the formatted list without the brackets
@@ -62,7 +69,12 @@ def plot_masks( *args ):
     ax = fig.add_subplot(111)
     ax.grid( color='k', linestyle='dashed', linewidth=.5 )
 
-    # Plot each dataset using different color     
+    # All datasets are binned onto the same grid, covering every point
+    all_ras  = np.concatenate( [arg[0] for arg in args] )
+    all_decs = np.concatenate( [arg[1] for arg in args] )
+    extent = ( all_ras.min(), all_ras.max(), all_decs.min(), all_decs.max() )
+
+    # Plot each dataset as a density image using different color
     colors = ['b', 'r', 'g', 'y']
     i = 0
     for arg in args:
@@ -71,7 +83,7 @@ def plot_masks( *args ):
         label = arg[2]
         color = colors[ i ]
         i += 1
-        ax.scatter( ras, decs, marker='o', color=color, s=.5, alpha=0.01, label=label )
+        plot_sky_density( ax, ras, decs, color=color, label=label, extent=extent, alpha=0.6 )
     ax.set_xlabel( 'RA (degs)') 
     ax.set_ylabel( 'Dec (degs)') 
     ax.set_aspect('equal')
@@ -107,17 +119,16 @@ if __name__ == '__main__':
 
 
     # Part 3)  Read in Mangle files, plot both masks on same plot
-    inter = pm.Mangle( "intersection.ply" )
-    both  = pm.Mangle( "bothcaps.ply" )
+    (inter, _, _) = read_mangle_file( "intersection.ply" )
+    (both,  _, _) = read_mangle_file( "bothcaps.ply" )
 
     # Create a bunch of random points inside each mask
     npoints = 10000
-    (ra_min,  ra_max)   = (68.5, 82.5)
-    (dec_min, dec_max)  = (28.5, 42.5)
-    # Use genrand_range() to speed up compared with genrand() 
-    #   (restricts random points to rectangle containing the masks)
-    (ras_inter, decs_inter)  =  inter.genrand_range( npoints, ra_min,ra_max, dec_min,dec_max )
-    (ras_both,  decs_both )  =   both.genrand_range( npoints, ra_min,ra_max, dec_min,dec_max )
+    # Use genrand_mask() rather than pymangle's genrand()/genrand_range(), so
+    #   points are only drawn in HEALPix pixels overlapping the masks and no
+    #   bounding box needs to be picked by hand
+    (ras_inter, decs_inter)  =  genrand_mask( inter, npoints, seed=1 )
+    (ras_both,  decs_both )  =  genrand_mask( both,  npoints, seed=2 )
 
     # Create list to feed to the plot_masks function
     plot_inter = [ras_inter, decs_inter, 'Intersection']
@@ -138,8 +149,8 @@ if __name__ == '__main__':
     mask = np.array( [cap1_flip, cap2] )
     fname = "flip1.ply"
     write_to_mangle_file( mask, fname=fname )
-    flip1  = pm.Mangle( fname )    
-    (ras_flip1, decs_flip1)  =  flip1.genrand_range( npoints, ra_min,ra_max, dec_min,dec_max )
+    (flip1, _, _)  = read_mangle_file( fname )
+    (ras_flip1, decs_flip1)  =  genrand_mask( flip1, npoints, seed=3 )
 
     plot_flip1 = [ras_flip1, decs_flip1, 'Flip1']
     plot_masks( plot_inter, plot_flip1 )
@@ -156,8 +167,8 @@ if __name__ == '__main__':
     mask = np.array( [cap1, cap2_flip] )
     fname = "flip2.ply"
     write_to_mangle_file( mask, fname=fname )
-    flip2  = pm.Mangle( fname )
-    (ras_flip2, decs_flip2)  =  flip2.genrand_range( npoints, ra_min,ra_max, dec_min,dec_max )
+    (flip2, _, _)  = read_mangle_file( fname )
+    (ras_flip2, decs_flip2)  =  genrand_mask( flip2, npoints, seed=4 )
 
     plot_flip2 = [ras_flip2, decs_flip2, 'Flip2']
     plot_masks( plot_inter, plot_flip1, plot_flip2 )
@@ -174,9 +185,9 @@ if __name__ == '__main__':
     mask = np.array( [cap1_flip, cap2_flip] )
     fname = "flipboth.ply"
     write_to_mangle_file( mask, fname=fname )
-    flip_both  = pm.Mangle( fname )
+    (flip_both, _, _)  = read_mangle_file( fname )
     npoints = 1000000
-    (ras_flip_both, decs_flip_both)  =  flip_both.genrand( npoints )
+    (ras_flip_both, decs_flip_both)  =  genrand_mask( flip_both, npoints, seed=5 )
 
     plot_flip_both = [ras_flip_both, decs_flip_both, 'Flip_both']
     plot_masks( plot_flip_both )
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Mask operations: intersection, union, complement and difference of Mangle masks
+
+A mask here is a pair (polys, weights), with polys a list of (n_caps, 4) cap
+arrays as from read_mangle_file. Every operation returns a new mask whose
+polygons do not overlap. Where the inputs overlap, the output weight comes
+from a policy: 'max', 'min', 'product' or 'last' (the weight of the second
+mask, or of the later polygon).
+
+Removing polygon b from polygon a splits a into the disjoint pieces
+    a & not(c1),  a & c1 & not(c2),  a & c1 & c2 & not(c3),  ...
+for the caps c1, c2, ... of b, which is how Mangle itself does it. Only pairs
+of polygons which share a cell of a coarse equal-area RA/Dec grid are ever
+compared, so the work grows with the number of overlaps rather than the
+number of pairs.
+"""
+
+import numpy as np
+from week6.cap_geometry import cap_theta, pad_caps
+from week6.polygon_area import polygon_areas
+
+pi = np.pi
+
+# Pieces with less area than this (steradians, ~0.04 arcsec^2) are dropped
+MIN_AREA = 1e-12
+
+# Margin (radians) added around polygon boxes, so rounding never drops a cell
+BOX_MARGIN = 1e-9
+
+# How to combine the weights of two overlapping polygons
+POLICIES = { 'max':     np.maximum,
+             'min':     np.minimum,
+             'product': np.multiply,
+             'last':    lambda w1, w2: w2 }
+
+
+
+def complement_cap( cap ):
+    # Flip a Mangle cap so it keeps the other side of its circle
+    flipped = np.array( cap, dtype=float )
+    flipped[...,3] = -flipped[...,3]
+    return flipped
+
+
+
+def grid_shape( npoly, zspan=None ):
+    # Default cell grid: roughly one polygon per cell, with twice as many
+    #   cells in RA as in z = sin(Dec); no finer than the typical polygon
+    #   height in z (zspan), so each polygon touches only a few cells
+    nz = int( np.clip( np.sqrt( npoly / 2. ), 4, 2048 ) )
+    if zspan is not None and zspan > 0:
+        nz = min( nz, max( 4, int( 2. / zspan ) ) )
+    return nz, 2*nz
+
+
+
+def cell_polygon( iz, ira, nz, nra ):
+    # Caps for one cell of the grid: nz equal bands in z = sin(Dec), each
+    #   split into nra equal ranges of RA, so all cells have the same area
+    z0, z1   = -1. + 2.*iz/nz, -1. + 2.*(iz+1)/nz
+    ra0, ra1 = np.radians( 360.*ira/nra ), np.radians( 360.*(ira+1)/nra )
+    caps = [ [ np.cos( ra0 + pi/2 ), np.sin( ra0 + pi/2 ), 0., 1. ],    # RA > ra0
+             [ np.cos( ra1 - pi/2 ), np.sin( ra1 - pi/2 ), 0., 1. ] ]   # RA < ra1
+    if z0 > -1.:
+        caps.append( [ 0., 0., 1.,  1. - z0 ] )       # z > z0
+    if z1 < 1.:
+        caps.append( [ 0., 0., 1., -(1. - z1) ] )     # z < z1
+    return np.array( caps )
+
+
+
+def _intersect_arcs( s1, w1, s2, w2 ):
+    # Arcs of RA (start, width in radians; width >= 2 pi for all of it, < 0
+    #   for none) holding the intersection of two arcs; where it is in two
+    #   pieces (arcs over pi wide), the narrower arc, which holds both
+    d = ( s2 - s1 ) % ( 2*pi )
+    e = ( s1 - s2 ) % ( 2*pi )
+    a = d <= w1
+    b = e <= w2
+    start = np.where( a, s2, s1 )
+    width = np.where( a, np.minimum( w2, w1 - d ), np.minimum( w1, w2 - e ) )
+    width = np.where( a | b, width, -1. )
+    both  = a & b
+    start = np.where( both, np.where( w1 <= w2, s1, s2 ), start )
+    width = np.where( both, np.minimum( w1, w2 ), width )
+    start = np.where( w1 >= 2*pi, s2, np.where( w2 >= 2*pi, s1, start ) )
+    width = np.where( w1 >= 2*pi, w2, np.where( w2 >= 2*pi, w1, width ) )
+    empty = ( w1 < 0 ) | ( w2 < 0 )
+    return start, np.where( empty, -1., width )
+
+
+
+def polygon_boxes( polys ):
+    # RA/Dec box (radians) around each polygon, from the boxes around all of
+    #   its caps: (dec_lo, dec_hi, ra_start, ra_width), with ra_width >= 2 pi
+    #   for all RA and dec_lo > dec_hi or ra_width < 0 for an empty polygon
+    # A cap keeps a disc around its axis (the antipode, if complemented); a
+    #   hemisphere bounded by a great circle through the poles keeps an RA
+    #   range of exactly pi, which is what bounds lat-long rectangles
+    padded = pad_caps( [ np.atleast_2d( p ) for p in polys ] )
+    xyz  = padded[...,:3]
+    norm = np.linalg.norm( xyz, axis=-1 )
+    axes = xyz / np.where( norm > 0, norm, 1. )[...,None]
+    axes = np.where( padded[...,3:] < 0, -axes, axes )
+    theta = cap_theta( padded[...,3] )
+    dec_c = np.arcsin( np.clip( axes[...,2], -1., 1. ) )
+    ra_c  = np.arctan2( axes[...,1], axes[...,0] )
+
+    dec_lo = np.maximum( np.max( dec_c - theta, axis=1 ), -pi/2 ) - BOX_MARGIN
+    dec_hi = np.minimum( np.min( dec_c + theta, axis=1 ),  pi/2 ) + BOX_MARGIN
+
+    pole  = ( dec_c + theta >= pi/2 ) | ( dec_c - theta <= -pi/2 )
+    half  = np.arcsin( np.clip( np.sin( theta ) / np.maximum( np.cos( dec_c ), 1e-300 ), 0., 1. ) )
+    meridian = ( np.abs( theta - pi/2 ) < 1e-12 ) & ( np.abs( axes[...,2] ) < 1e-12 )
+    half  = np.where( meridian, pi/2, half )
+    width = np.where( pole & ~meridian, 2*pi, 2*half + 2*BOX_MARGIN )
+    start = ra_c - half - BOX_MARGIN
+
+    ra_start, ra_width = np.zeros( len(padded) ), np.full( len(padded), 2*pi )
+    for j in range( padded.shape[1] ):
+        ra_start, ra_width = _intersect_arcs( ra_start, ra_width, start[:,j], width[:,j] )
+    return dec_lo, dec_hi, ra_start % ( 2*pi ), ra_width
+
+
+
+def box_cells( boxes, nz, nra ):
+    # Grid cells each box touches, as matching arrays (cells, polyids)
+    dec_lo, dec_hi, ra_start, ra_width = boxes
+    empty = ( dec_lo > dec_hi ) | ( ra_width < 0 )
+
+    # Range of z bands
+    iz0 = np.clip( np.floor( ( np.sin( dec_lo ) + 1 )/2 * nz ), 0, nz-1 ).astype(int)
+    iz1 = np.clip( np.floor( ( np.sin( dec_hi ) + 1 )/2 * nz ), 0, nz-1 ).astype(int)
+
+    # Range of RA columns, or all of them
+    all_ra = ra_width >= 2*pi
+    ira0   = np.floor( ra_start/(2*pi) * nra ).astype(int)
+    ira1   = np.floor( ( ra_start + np.maximum( ra_width, 0. ) )/(2*pi) * nra ).astype(int)
+    nspan  = np.minimum( ira1 - ira0 + 1, nra )
+    ira0   = np.where( all_ra, 0, ira0 )
+    nspan  = np.where( all_ra, nra, nspan )
+
+    # Expand each box into individual cells
+    ncells  = np.where( empty, 0, ( iz1 - iz0 + 1 ) * nspan )
+    polyids = np.repeat( np.arange( len(ncells) ), ncells )
+    local   = np.arange( len(polyids) ) - np.repeat( np.cumsum( ncells ) - ncells, ncells )
+    iz  = iz0[polyids] + local // nspan[polyids]
+    ira = ( ira0[polyids] + local % nspan[polyids] ) % nra
+    return iz*nra + ira, polyids
+
+
+
+def cell_index( polys, nz, nra ):
+    # Conservative list of the grid cells each polygon may touch, found from
+    #   the RA/Dec box around all of its caps (polygon_boxes)
+    # Returns matching arrays (cells, polyids)
+    return box_cells( polygon_boxes( polys ), nz, nra )
+
+
+
+def _grid_for( boxes, npoly, grid ):
+    # The given grid, or the default one for boxes around npoly polygons
+    if grid is not None:
+        return grid
+    dec_lo, dec_hi, _, ra_width = boxes
+    ok = ( dec_lo <= dec_hi ) & ( ra_width >= 0 )
+    zspan = np.median( np.sin( dec_hi[ok] ) - np.sin( dec_lo[ok] ) ) if ok.any() else None
+    return grid_shape( npoly, zspan )
+
+
+
+def overlap_pairs( cells_a, ids_a, cells_b, ids_b ):
+    # Unique pairs (ia, ib) of polygons from two cell indexes sharing a cell
+    order_b = np.argsort( cells_b, kind='stable' )
+    cells_b, ids_b = cells_b[order_b], ids_b[order_b]
+    lo = np.searchsorted( cells_b, cells_a, side='left' )
+    hi = np.searchsorted( cells_b, cells_a, side='right' )
+    n  = hi - lo
+    ia = np.repeat( ids_a, n )
+    ib = ids_b[ np.repeat( lo, n ) + np.arange( n.sum() ) - np.repeat( np.cumsum( n ) - n, n ) ]
+    if len(ia) == 0:
+        return np.zeros( 0, dtype=int ), np.zeros( 0, dtype=int )
+    nb = int( ib.max() ) + 1
+    pairs = np.unique( ia.astype( np.int64 ) * nb + ib )
+    return pairs // nb, pairs % nb
+
+
+
+def _candidate_pairs( polys_a, polys_b, grid ):
+    # Pairs of polygons from two lists which might overlap
+    if len(polys_a) == 0 or len(polys_b) == 0:
+        return np.zeros( 0, dtype=int ), np.zeros( 0, dtype=int )
+    boxes_a, boxes_b = polygon_boxes( polys_a ), polygon_boxes( polys_b )
+    both = tuple( np.concatenate( [x, y] ) for x, y in zip( boxes_a, boxes_b ) )
+    nz, nra = _grid_for( both, len(polys_a) + len(polys_b), grid )
+    cells_a, ids_a = box_cells( boxes_a, nz, nra )
+    cells_b, ids_b = box_cells( boxes_b, nz, nra )
+    return overlap_pairs( cells_a, ids_a, cells_b, ids_b )
+
+
+
+def cut_polygons( polys, cutters, weights=None, cutter_weights=None, policy=None ):
+    # Cut each polygon by a list of other polygons, one after another
+    #   cutters[i] lists the polygons (cap arrays) cutting polys[i], and
+    #   cutter_weights[i] their weights
+    # With policy=None the cutters are removed, leaving polys[i] minus their
+    #   union; otherwise the part inside each cutter is kept as a separate
+    #   piece, with weight policy( cutter weight, current weight )
+    # Returns (pieces, piece weights, owners), where owners[k] is the index
+    #   of the polygon that piece k came from
+    # All pieces take their next cutter in the same pass, so the number of
+    #   passes is set by the largest number of cutters any polygon has
+    if weights is None:
+        weights = np.ones( len(polys) )
+    pieces = [ np.atleast_2d( p ) for p in polys ]
+    pweights = list( np.asarray( weights, dtype=float ) )
+    owners = list( range( len(polys) ) )
+    ncut = [ len(c) for c in cutters ]
+    for r in range( max( ncut, default=0 ) ):
+        active = [ k for k in range( len(pieces) ) if ncut[owners[k]] > r ]
+        if len(active) == 0:
+            continue
+
+        # Only pieces actually overlapping their cutter need to be split
+        cut = [ np.atleast_2d( cutters[owners[k]][r] ) for k in active ]
+        inside = [ np.vstack( [pieces[k], c] ) for k, c in zip( active, cut ) ]
+        overlap = polygon_areas( inside ) > MIN_AREA
+
+        new_pieces, new_weights, new_owners = [], [], []
+        for k, c, hit, ins in zip( active, cut, overlap, inside ):
+            if not hit:
+                continue
+            # piece & c1 & ... & c_{i-1} & not(c_i), for each cap c_i of the cutter
+            for i in range( len(c) ):
+                new_pieces.append( np.vstack( [pieces[k], c[:i], complement_cap( c[i:i+1] )] ) )
+                new_weights.append( pweights[k] )
+                new_owners.append( owners[k] )
+            if policy is not None:
+                new_pieces.append( ins )
+                new_weights.append( POLICIES[policy]( cutter_weights[owners[k]][r], pweights[k] ) )
+                new_owners.append( owners[k] )
+        if len(new_pieces):
+            keep = polygon_areas( new_pieces ) > MIN_AREA
+            new_pieces  = [ p for p, k in zip( new_pieces,  keep ) if k ]
+            new_weights = [ w for w, k in zip( new_weights, keep ) if k ]
+            new_owners  = [ o for o, k in zip( new_owners,  keep ) if k ]
+
+        split = set( k for k, hit in zip( active, overlap ) if hit )
+        pieces   = [ p for k, p in enumerate( pieces )   if k not in split ] + new_pieces
+        pweights = [ w for k, w in enumerate( pweights ) if k not in split ] + new_weights
+        owners   = [ o for k, o in enumerate( owners )   if k not in split ] + new_owners
+    return pieces, np.array( pweights, dtype=float ), np.array( owners, dtype=int )
+
+
+
+def subtract( polys, holes ):
+    # Remove a list of hole polygons from each polygon (holes[i] from polys[i])
+    #   Returns the surviving pieces, and which polygon each came from
+    pieces, _, owners = cut_polygons( polys, holes )
+    return pieces, owners
+
+
+
+def _holes_from_pairs( n, ia, ib, polys_b ):
+    # List, for each of n polygons, the polygons of polys_b paired with it
+    holes = [ [] for _ in range( n ) ]
+    for a, b in zip( ia, ib ):
+        holes[a].append( np.atleast_2d( polys_b[b] ) )
+    return holes
+
+
+
+def mask_and( mask_a, mask_b, policy='product', grid=None ):
+    # Intersection of two masks: a & b for every overlapping pair of polygons
+    (polys_a, w_a), (polys_b, w_b) = mask_a, mask_b
+    ia, ib = _candidate_pairs( polys_a, polys_b, grid )
+    pieces = [ np.vstack( [polys_a[a], polys_b[b]] ) for a, b in zip( ia, ib ) ]
+    keep = polygon_areas( pieces ) > MIN_AREA if len(pieces) else np.zeros( 0, dtype=bool )
+    weights = POLICIES[policy]( np.asarray( w_a )[ia], np.asarray( w_b )[ib] )
+    return [ p for p, k in zip( pieces, keep ) if k ], weights[keep]
+
+
+
+def mask_difference( mask_a, mask_b, grid=None ):
+    # Everything in mask a that is not in mask b, keeping the weights of a
+    (polys_a, w_a), (polys_b, _) = mask_a, mask_b
+    ia, ib = _candidate_pairs( polys_a, polys_b, grid )
+    pieces, owners = subtract( polys_a, _holes_from_pairs( len(polys_a), ia, ib, polys_b ) )
+    return pieces, np.asarray( w_a )[owners]
+
+
+
+def mask_or( mask_a, mask_b, policy='max', grid=None ):
+    # Union of two masks, each assumed to have non-overlapping polygons
+    #   (see balkanize otherwise): a & not(b), b & not(a), and a & b with
+    #   weights from the policy
+    (polys_a, w_a), (polys_b, w_b) = mask_a, mask_b
+    ia, ib = _candidate_pairs( polys_a, polys_b, grid )
+    only_a, own_a = subtract( polys_a, _holes_from_pairs( len(polys_a), ia, ib, polys_b ) )
+    only_b, own_b = subtract( polys_b, _holes_from_pairs( len(polys_b), ib, ia, polys_a ) )
+
+    pieces = [ np.vstack( [polys_a[a], polys_b[b]] ) for a, b in zip( ia, ib ) ]
+    keep = polygon_areas( pieces ) > MIN_AREA if len(pieces) else np.zeros( 0, dtype=bool )
+    both = [ p for p, k in zip( pieces, keep ) if k ]
+    w_both = POLICIES[policy]( np.asarray( w_a )[ia], np.asarray( w_b )[ib] )[keep]
+
+    weights = np.concatenate( [ np.asarray( w_a )[own_a], np.asarray( w_b )[own_b], w_both ] )
+    return only_a + only_b + both, weights
+
+
+
+def mask_not( mask, grid=None, weight=1. ):
+    # Complement of a mask: every cell of the grid, minus the polygons
+    #   touching that cell (cells touching nothing are kept whole)
+    polys, _ = mask
+    boxes = polygon_boxes( polys ) if len(polys) > 0 else ( np.zeros( 0 ), )*4
+    nz, nra = _grid_for( boxes, len(polys), grid )
+    cells, ids = box_cells( boxes, nz, nra )
+    order = np.argsort( cells, kind='stable' )
+    cells, ids = cells[order], ids[order]
+
+    grid_cells = [ cell_polygon( k // nra, k % nra, nz, nra ) for k in range( nz*nra ) ]
+    lo = np.searchsorted( cells, np.arange( nz*nra ), side='left' )
+    hi = np.searchsorted( cells, np.arange( nz*nra ), side='right' )
+    holes = [ [ np.atleast_2d( polys[b] ) for b in ids[l:h] ] for l, h in zip( lo, hi ) ]
+    pieces, _ = subtract( grid_cells, holes )
+    return pieces, np.full( len(pieces), float( weight ) )
+
+
+
+def balkanize( polys, weights=None, policy='last', grid=None ):
+    # Split a list of possibly overlapping polygons into non-overlapping ones,
+    #   combining the weights wherever they overlap according to the policy
+    # Each polygon first loses the parts covered by any later polygon, so
+    #   every point belongs to the last polygon covering it. For 'max' and
+    #   'min' the polygons are sorted by weight beforehand so the last one is
+    #   also the right one; for 'product' each piece is then split along the
+    #   earlier polygons overlapping it
+    if weights is None:
+        weights = np.ones( len(polys) )
+    weights = np.asarray( weights, dtype=float )
+    if len(polys) == 0:
+        return [], np.zeros( 0 )
+    if policy == 'max':
+        order = np.argsort( weights, kind='stable' )
+    elif policy == 'min':
+        order = np.argsort( -weights, kind='stable' )
+    else:
+        order = np.arange( len(polys) )
+    polys   = [ np.atleast_2d( polys[k] ) for k in order ]
+    weights = weights[order]
+
+    # Candidate overlapping pairs within the list, as i < j
+    ia, ib = _candidate_pairs( polys, polys, grid )
+    later  = ia < ib
+    ia, ib = ia[later], ib[later]
+
+    pieces, owners = subtract( polys, _holes_from_pairs( len(polys), ia, ib, polys ) )
+    pweights = weights[owners]
+    if policy == 'product':
+        earlier = _holes_from_pairs( len(polys), ib, ia, polys )
+        earlier_w = [ [] for _ in range( len(polys) ) ]
+        for a, b in zip( ib, ia ):
+            earlier_w[a].append( weights[b] )
+        pieces, pweights, _ = cut_polygons( pieces, [ earlier[o] for o in owners ], weights=pweights,
+                                            cutter_weights=[ earlier_w[o] for o in owners ],
+                                            policy=policy )
+    return pieces, pweights
+
+
+
+if __name__ == '__main__':
+
+    # Redo the combinations of the two caps from Mangle.py, this time as
+    #   actual masks rather than by plotting random points
+    from week6.mangle import return_cap_vector
+    from astropy import units as U
+
+    cap1 = return_cap_vector( ra=76*U.degree, dec=36*U.degree, rad=5*U.degree )
+    cap2 = return_cap_vector( ra=75*U.degree, dec=35*U.degree, rad=5*U.degree )
+    mask1 = ( [ np.array( [cap1] ) ], np.array( [1.] ) )
+    mask2 = ( [ np.array( [cap2] ) ], np.array( [0.5] ) )
+
+    for name, (polys, weights) in [ ( '1 & 2',   mask_and( mask1, mask2 ) ),
+                                    ( '1 + 2',   mask_or( mask1, mask2 ) ),
+                                    ( '1 - 2',   mask_difference( mask1, mask2 ) ),
+                                    ( 'not(1)',  mask_not( mask1 ) ) ]:
+        print( '{:8s} {:3d} polygons, area {:.6f} str, weights {}'.format(
+               name, len(polys), polygon_areas( polys ).sum(), np.unique( weights ) ) )
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Mask randoms: area-aware random points inside Mangle masks
+
+Rather than throwing points at the whole sphere (genrand) or at a hand-picked
+RA/Dec box (genrand_range) and rejecting everything outside the mask, this
+builds a HEALPix coverage map of (polygon, pixel) pairs that can overlap the
+mask. Since HEALPix pixels all have the same area, drawing pairs uniformly (or
+in proportion to the polygon weight) and then a point inside the chosen pixel
+samples the mask uniformly, and rejection only ever happens locally, inside a
+single pixel. The cost is therefore set by how well the pixels fit the mask
+edges, not by what fraction of the sky the mask covers.
+"""
+
+import numpy as np
+from week6.cap_geometry import radec_to_xyz, xyz_to_radec, pad_caps, in_polygons
+from week6.pixel_coverage import pixel_coverage
+from week6.general_masking import read_mangle_file
+from utils.lazy import lazy_import
+ProcessPoolExecutor = lazy_import( 'concurrent.futures', 'ProcessPoolExecutor' )
+hp = lazy_import( 'healpy' )
+
+pi = np.pi
+
+# Most candidate points generated in one pass, to bound memory use
+MAX_BATCH = 2**20
+
+
+
+def candidate_pixels( caps, nside ):
+    # Returns the (NESTED) HEALPix pixels at Nside which may overlap a polygon:
+    #   those inside it or on its boundary, from pixel_coverage.py (cached)
+    cov = pixel_coverage( [caps], [nside] )[nside][0]
+    return np.union1d( cov['inside'], cov['boundary'] )
+
+
+
+def build_coverage( polys, nside=64, weights=None ):
+    # Build the (polygon, pixel) coverage map used to draw randoms
+    #   polys: list of (n_caps, 4) cap arrays, as from read_mangle_file
+    #   weights: optional polygon weights, used when drawing weighted randoms
+    # Returns a dict which can be reused (or pickled to worker processes) for
+    #   any number of calls to draw_randoms
+    pixels, polyids = [], []
+    for i, cov in enumerate( pixel_coverage( polys, [nside] )[nside] ):
+        pix = np.union1d( cov['inside'], cov['boundary'] )
+        pixels.append( pix )
+        polyids.append( np.full( len(pix), i ) )
+    pixels  = np.concatenate( pixels )
+    polyids = np.concatenate( polyids )
+
+    # Sort by pixel, then polygon, so all polygons sharing a pixel are adjacent
+    order   = np.lexsort( (polyids, pixels) )
+    pixels  = pixels[order]
+    polyids = polyids[order]
+
+    # For each pair, the index of the first pair in the same pixel; pairs
+    #   between that and this one belong to lower-numbered polygons, which
+    #   take precedence where polygons overlap (as in pymangle's polyid)
+    first = np.r_[ True, pixels[1:] != pixels[:-1] ]
+    pair_start = np.maximum.accumulate( np.where( first, np.arange( len(pixels) ), 0 ) )
+
+    if weights is None:
+        weights = np.ones( len(polys) )
+    weights = np.asarray( weights, dtype=float )
+
+    # Centers of the pixels, for sampling inside each pixel's bounding cap
+    centers = np.array( hp.pix2vec( nside, pixels, nest=True ) ).T
+    u, v = cap_frames( centers )
+
+    coverage = { 'nside': nside, 'pixels': pixels, 'polyids': polyids,
+                 'pair_start': pair_start, 'centers': centers, 'u': u, 'v': v,
+                 'caps': pad_caps( polys ), 'weights': weights,
+                 'pair_cdf': np.cumsum( weights[polyids] ) }
+    return coverage
+
+
+
+def coverage_from_file( fname, nside=64 ):
+    # Convenience wrapper: read a Mangle file and build its coverage map
+    polys, weights, _ = read_mangle_file( fname )
+    return build_coverage( polys, nside=nside, weights=weights )
+
+
+
+def cap_frames( centers ):
+    # Orthonormal basis vectors (u, v) perpendicular to each of the (N,3) centers
+    axis = np.zeros_like( centers )
+    near_pole = np.abs( centers[:,2] ) > 0.9
+    axis[  near_pole, 0 ] = 1.
+    axis[ ~near_pole, 2 ] = 1.
+    u = np.cross( axis, centers )
+    u /= np.linalg.norm( u, axis=1 )[:,None]
+    v = np.cross( centers, u )
+    return u, v
+
+
+
+def points_in_caps( centers, u, v, theta, rng ):
+    # Draw one point uniformly inside a cap of opening angle theta around each
+    #   of the given (N,3) centers, with (u, v) from cap_frames
+    n = len(centers)
+    cos_t = 1. - rng.random( n ) * ( 1. - np.cos( theta ) )
+    sin_t = np.sqrt( 1. - cos_t**2 )
+    phi   = 2*pi * rng.random( n )
+    return cos_t[:,None]*centers \
+         + ( sin_t*np.cos( phi ) )[:,None]*u + ( sin_t*np.sin( phi ) )[:,None]*v
+
+
+
+def owned_by_polygon( coverage, pairs, xyz ):
+    # For each point drawn from a (polygon, pixel) pair, check that no
+    #   lower-numbered polygon sharing the pixel also contains it
+    n_before = pairs - coverage['pair_start'][pairs]
+    owned = np.ones( len(pairs), dtype=bool )
+    if n_before.sum() == 0:
+        return owned
+
+    # Expand to one row per (point, earlier polygon in same pixel)
+    which_pt = np.repeat( np.arange( len(pairs) ), n_before )
+    offsets  = np.arange( len(which_pt) ) - np.repeat( np.cumsum( n_before ) - n_before, n_before )
+    earlier  = coverage['pair_start'][pairs][which_pt] + offsets
+    hits = in_polygons( coverage['caps'], coverage['polyids'][earlier], xyz[which_pt] )
+    owned[ which_pt[hits] ] = False
+    return owned
+
+
+
+def draw_randoms( coverage, nrand, rng=None, weighted=False ):
+    # Generate nrand random (RA, Dec) points inside the mask described by coverage
+    #   weighted=True makes the density of points proportional to polygon weight
+    #   rng may be a numpy Generator, or a seed for one
+    rng = np.random.default_rng( rng )
+    nside   = coverage['nside']
+    maxrad  = hp.max_pixrad( nside )
+    npairs  = len( coverage['pixels'] )
+    if npairs == 0:
+        raise ValueError( "Mask has no area at Nside={:d}".format( nside ) )
+    if weighted:
+        cdf = coverage['pair_cdf']
+        if cdf[-1] <= 0:
+            raise ValueError( "All polygons in mask have zero weight" )
+
+    ras, decs = [], []
+    n_have = 0
+    efficiency = 0.5   # Initial guess at acceptance rate; updated as we go
+    while n_have < nrand:
+        n_try = int( min( MAX_BATCH, 1.2*(nrand - n_have)/efficiency + 100 ) )
+
+        # Pick (polygon, pixel) pairs, each pixel having the same area
+        if weighted:
+            pairs = np.searchsorted( cdf, rng.random( n_try )*cdf[-1], side='right' )
+        else:
+            pairs = rng.integers( 0, npairs, n_try )
+
+        # Sample inside each pixel's bounding cap, then keep only points which
+        #   land in that pixel, inside that polygon, and not in an earlier polygon
+        xyz = points_in_caps( coverage['centers'][pairs], coverage['u'][pairs],
+                              coverage['v'][pairs], maxrad, rng )
+        keep = hp.vec2pix( nside, xyz[:,0], xyz[:,1], xyz[:,2], nest=True ) \
+                == coverage['pixels'][pairs]
+        keep[keep] = in_polygons( coverage['caps'], coverage['polyids'][pairs[keep]], xyz[keep] )
+        keep[keep] = owned_by_polygon( coverage, pairs[keep], xyz[keep] )
+
+        n_keep = keep.sum()
+        efficiency = max( n_keep / n_try, 1e-3 )
+        ra, dec = xyz_to_radec( xyz[keep][: nrand - n_have] )
+        ras.append( ra )
+        decs.append( dec )
+        n_have += len(ra)
+
+    return np.concatenate( ras ), np.concatenate( decs )
+
+
+
+def genrand_mask( polys, nrand, weights=None, nside=64, seed=None, weighted=False ):
+    # One-shot replacement for pymangle's genrand(): builds the coverage map
+    #   for a list of polygons and draws nrand points inside them
+    coverage = build_coverage( polys, nside=nside, weights=weights )
+    return draw_randoms( coverage, nrand, rng=seed, weighted=weighted )
+
+
+
+def chunk_rng( seed, ichunk ):
+    # Independent random stream for chunk number ichunk of a seeded run
+    #   This is identical to np.random.SeedSequence(seed).spawn(n)[ichunk], so
+    #   any worker can regenerate its chunk knowing only (seed, ichunk)
+    return np.random.default_rng( np.random.SeedSequence( seed, spawn_key=(ichunk,) ) )
+
+
+
+def chunk_sizes( nrand, nchunks ):
+    # Split nrand points as evenly as possible into nchunks chunks
+    sizes = np.full( nchunks, nrand // nchunks )
+    sizes[ : nrand % nchunks ] += 1
+    return sizes
+
+
+
+def genrand_streams( coverage, nrand, nchunks, seed, weighted=False ):
+    # Generator yielding (ras, decs) for each of nchunks reproducible chunks
+    #   The concatenated output depends only on (seed, nchunks), not on where
+    #   or in what order the chunks are generated
+    for ichunk, n in enumerate( chunk_sizes( nrand, nchunks ) ):
+        yield draw_randoms( coverage, n, rng=chunk_rng( seed, ichunk ), weighted=weighted )
+
+
+
+def _draw_chunk( args ):
+    # Worker for genrand_parallel (must be at module level to be pickled)
+    coverage, n, seed, ichunk, weighted = args
+    return draw_randoms( coverage, n, rng=chunk_rng( seed, ichunk ), weighted=weighted )
+
+
+
+def genrand_parallel( coverage, nrand, nchunks, seed, nproc=4, weighted=False ):
+    # Same output as concatenating genrand_streams(), but with the chunks
+    #   generated on a pool of nproc worker processes
+    jobs = [ (coverage, n, seed, i, weighted)
+             for i, n in enumerate( chunk_sizes( nrand, nchunks ) ) ]
+    with ProcessPoolExecutor( max_workers=nproc ) as pool:
+        chunks = list( pool.map( _draw_chunk, jobs ) )
+    return np.concatenate( [c[0] for c in chunks] ), np.concatenate( [c[1] for c in chunks] )
+
+
+
+
+if __name__ == '__main__':
+
+    # Quick check against pymangle: a small cap (0.2% of the sky) is the worst
+    #   case for genrand(), but costs the same as any other mask here
+    from week6.mangle import return_cap_vector
+    from astropy import units as U
+    import time
+
+    cap = return_cap_vector( ra=76*U.degree, dec=36*U.degree, rad=3*U.degree )
+    polys = [ np.array( [cap] ) ]
+
+    t0 = time.time()
+    coverage = build_coverage( polys, nside=64 )
+    ras, decs = draw_randoms( coverage, 1000000, rng=42 )
+    print( 'Generated {:d} randoms in {:.2f} s'.format( len(ras), time.time()-t0 ) )
+
+    # Every point should be within 3 degrees of the cap center
+    sep = np.degrees( np.arccos( np.clip( radec_to_xyz( ras, decs ) @ cap[:3], -1, 1 ) ) )
+    print( 'Max separation from cap center: {:.4f} deg'.format( sep.max() ) )
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Pixel coverage: the HEALPix pixels a cap or Mangle polygon covers, fully or
+partly, at any Nside
+
+Each (NESTED) pixel is tested against a polygon's caps through the disc
+around its center of radius max_pixrad, which contains the whole pixel: the
+pixel is inside a cap if the disc is, outside it if the disc misses the cap,
+and otherwise on the boundary. A pixel inside every cap is inside the
+polygon, and one outside any cap is outside it. Starting from the 12 base
+pixels, only boundary pixels are split into their 4 children at the next
+level, so the work follows the polygon's edges and not its area, for all the
+polygons of a mask at once.
+
+Unlike testing pixel centers, this never misses a pixel the polygon touches:
+'inside' pixels lie wholly inside, and every other pixel with any part in
+the polygon is a 'boundary' pixel (as can be a few which only come within a
+pixel radius of it, with a fraction of ~0: a pixel is only dropped when it
+is shown to be outside). Boundary pixels are refined a few levels
+further (extra_levels) to drop those that miss the polygon, promote those
+wholly inside, and estimate the fraction of each that is covered (from the
+inside sub-pixels, and the centers of those still on the boundary).
+
+The result for each polygon is kept as MOC-style cells (NUNIQ = 4*4^order +
+pixel) inside it plus the boundary pixels at the finest Nside, from which
+the coverage at any coarser Nside follows directly. Results are cached by a
+hash of each polygon's caps (in memory, up to CACHE_BYTES, and in cache_dir
+if given), so a mask seen before, or the unchanged polygons of an edited
+one, are not redone.
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from week6.cap_geometry import cap_theta, pad_caps, in_polygons
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+hp = lazy_import( 'healpy' )
+
+pi = np.pi
+
+# Levels below the requested Nside used to refine boundary pixels
+EXTRA_LEVELS = 2
+
+# Deepest HEALPix order used (Nside 2^20, pixels ~0.2" across)
+MAX_ORDER = 20
+
+# Allowance (radians) for rounding in the angle between pixel and cap centers
+MARGIN = 1e-7
+
+# Most (pixel x cap) elements tested in one pass, to bound memory use
+MAX_ELEMENTS = 2**22
+
+# Directory for cached coverage (None: cache in memory only)
+CACHE_DIR = os.environ.get( 'ASTRO5160_COVERAGE_CACHE' )
+
+# Memory for coverage kept in _CACHE (bytes); the least recently used
+#   polygons are dropped beyond this
+CACHE_BYTES = 2**28
+
+# Coverage worked out so far, by cache key, least recently used first
+_CACHE = OrderedDict()
+_CACHE_USED = 0
+
+# Codes for pixels from classify()
+OUTSIDE, BOUNDARY, INSIDE = 0, 1, 2
+
+
+
+def nside_order( nside ):
+    # HEALPix order of a power-of-two Nside, up to 2^MAX_ORDER
+    order = int( nside ).bit_length() - 1
+    if nside < 1 or 2**order != nside or order > MAX_ORDER:
+        raise ValueError( "Nside must be a power of 2 up to 2^{:d}, not {}".format( MAX_ORDER, nside ) )
+    return order
+
+
+
+def uniq_order( uniq ):
+    # (order, pixel) of NUNIQ cell numbers
+    uniq = np.asarray( uniq, dtype=np.int64 )
+    starts = 4 * 4**np.arange( MAX_ORDER+2, dtype=np.int64 )
+    order = np.searchsorted( starts, uniq, side='right' ) - 1
+    return order, uniq - starts[order]
+
+
+
+def cap_key( caps, order, extra_levels ):
+    # Cache key of one polygon's coverage: hash of its caps and the levels
+    caps = np.ascontiguousarray( np.atleast_2d( caps ), dtype=float )
+    sha = hashlib.sha256( caps.tobytes() )
+    sha.update( '{:d},{:d}'.format( order, extra_levels ).encode() )
+    return sha.hexdigest()
+
+
+
+def _cap_axes( padded ):
+    # Unit axes and opening angles of the regions kept by padded caps
+    #   (a complemented cap keeps a disc around the antipode of its center)
+    xyz  = padded[...,:3]
+    norm = np.linalg.norm( xyz, axis=-1, keepdims=True )
+    axes = xyz / np.where( norm > 0, norm, 1. )
+    axes = np.where( padded[...,3:] < 0, -axes, axes )
+    return axes, cap_theta( padded[...,3] )
+
+
+
+def classify( axes, radii, pid, pix, order ):
+    # INSIDE, BOUNDARY or OUTSIDE for each pixel pix (at order) against
+    #   polygon pid, with axes (P,m,3) and radii (P,m) from _cap_axes
+    codes = np.empty( len(pix), dtype=np.int8 )
+    step = max( 1, MAX_ELEMENTS // axes.shape[1] )
+    R = hp.max_pixrad( 2**order ) + MARGIN
+    for lo in range( 0, len(pix), step ):
+        sl = slice( lo, lo+step )
+        centers = np.array( hp.pix2vec( 2**order, pix[sl], nest=True ) )
+        dots = np.einsum( 'nmj,jn->nm', axes[ pid[sl] ], centers )
+        d = np.arccos( np.clip( dots, -1., 1. ) )
+        r = radii[ pid[sl] ]
+        inside  = np.all( ( d + R <= r ) | ( r >= pi ), axis=1 )
+        outside = np.any( d - R >= r, axis=1 )
+        codes[sl] = np.where( inside, INSIDE, np.where( outside, OUTSIDE, BOUNDARY ) )
+    return codes
+
+
+
+def _refine( polys, order, extra_levels ):
+    # Coverage of each polygon (see polygon_cells) by hierarchical refinement,
+    #   all polygons together
+    padded = pad_caps( polys )
+    axes, radii = _cap_axes( padded )
+    deepest = min( order + extra_levels, MAX_ORDER )
+    pid = np.repeat( np.arange( len(polys) ), 12 )
+    pix = np.tile( np.arange( 12, dtype=np.int64 ), len(polys) )
+    cells, deep = [], []
+    for k in range( deepest+1 ):
+        codes = classify( axes, radii, pid, pix, k )
+        inside = codes == INSIDE
+        if k <= order:
+            cells.append( ( pid[inside], 4 * 4**k + pix[inside] ) )
+        else:
+            # Below the requested order: count towards the ancestor at order,
+            #   in units of pixels at the deepest order
+            deep.append( ( pid[inside], pix[inside] >> 2*(k-order), 4**(deepest-k), 0 ) )
+        count( 'coverage_pixels_tested', len(pix) )
+        boundary = codes == BOUNDARY
+        if k == deepest:
+            # Still on the boundary at the deepest level: counted by its center
+            bpid, bpix = pid[boundary], pix[boundary]
+            centers = np.array( hp.pix2vec( 2**k, bpix, nest=True ) ).T
+            hit = in_polygons( padded, bpid, centers ) if len(bpix) > 0 else np.zeros( 0, dtype=bool )
+            deep.append( ( bpid, bpix >> 2*(k-order), hit.astype( float ), 1 ) )
+            break
+        pid = np.repeat( pid[boundary], 4 )
+        pix = ( 4*pix[boundary][:,None] + np.arange( 4 ) ).ravel()
+
+    # Boundary pixels at order: wholly inside, partly, or (after all) outside
+    full = 4**( deepest-order )
+    dpid = np.concatenate( [ np.asarray( p, dtype=np.int64 ) for p, _, _, _ in deep ] )
+    dpix = np.concatenate( [ np.asarray( a, dtype=np.int64 ) for _, a, _, _ in deep ] )
+    win  = np.concatenate( [ np.broadcast_to( w, len(p) ) for p, _, w, _ in deep ] ).astype( float )
+    nbnd = np.concatenate( [ np.full( len(p), b ) for p, _, _, b in deep ] )
+    key, inv = np.unique( dpid * ( 12 * 4**order ) + dpix, return_inverse=True )
+    win  = np.bincount( inv, weights=win, minlength=len(key) )
+    nbnd = np.bincount( inv, weights=nbnd, minlength=len(key) )
+    kpid, kpix = key // ( 12 * 4**order ), key % ( 12 * 4**order )
+    promoted = ( win == full ) & ( nbnd == 0 )
+    partial  = ~promoted & ( win + nbnd > 0 )
+    fraction = win / full
+    cells.append( ( kpid[promoted], 4 * 4**order + kpix[promoted] ) )
+
+    # Split by polygon: sort once, then slice
+    cpid = np.concatenate( [ p for p, _ in cells ] )
+    cuniq = np.concatenate( [ u for _, u in cells ] )
+    srt = np.lexsort( ( cuniq, cpid ) )
+    cpid, cuniq = cpid[srt], cuniq[srt]
+    kpid, kpix, fraction = kpid[partial], kpix[partial], fraction[partial]
+    ids = np.arange( len(polys)+1 )
+    c_at = np.searchsorted( cpid, ids )
+    k_at = np.searchsorted( kpid, ids )
+    # (copies, so a cached polygon does not hold on to the whole batch)
+    return [ { 'order': order, 'inside': cuniq[ c_at[i]:c_at[i+1] ].copy(),
+               'boundary': kpix[ k_at[i]:k_at[i+1] ].copy(),
+               'fraction': fraction[ k_at[i]:k_at[i+1] ].copy() }
+             for i in range( len(polys) ) ]
+
+
+
+def _cache_path( cache_dir, key ):
+    return os.path.join( cache_dir, key +'.npz' )
+
+
+
+def _remember( key, cover ):
+    # Keep a polygon's coverage in _CACHE, dropping the least recently used
+    #   ones to stay within CACHE_BYTES
+    global _CACHE_USED
+    if key in _CACHE:
+        _CACHE.move_to_end( key )
+        return
+    _CACHE[key] = cover
+    _CACHE_USED += sum( v.nbytes for v in cover.values() if hasattr( v, 'nbytes' ) )
+    while _CACHE_USED > CACHE_BYTES and len(_CACHE) > 1:
+        _, old = _CACHE.popitem( last=False )
+        _CACHE_USED -= sum( v.nbytes for v in old.values() if hasattr( v, 'nbytes' ) )
+
+
+
+def clear_cache():
+    # Forget all coverage kept in memory (cache_dir files are kept)
+    global _CACHE_USED
+    _CACHE.clear()
+    _CACHE_USED = 0
+
+
+
+def polygon_cells( polys, nside, extra_levels=EXTRA_LEVELS, cache_dir=CACHE_DIR ):
+    # Coverage of each polygon at nside: a list of dicts with 'inside' (NUNIQ
+    #   cells, at orders up to nside's, wholly inside the polygon), 'boundary'
+    #   (pixels at nside partly inside it) and 'fraction' (estimated part of
+    #   each boundary pixel inside); see coverage_at for pixel lists
+    #   polys: list of (n_caps, 4) cap arrays, as from read_mangle_file
+    order = nside_order( nside )
+    keys = [ cap_key( caps, order, extra_levels ) for caps in polys ]
+    # Held here too, as a large mask may not all fit in _CACHE
+    covers = {}
+    missing = []
+    for i, key in enumerate( keys ):
+        if key in covers:
+            continue
+        if key in _CACHE:
+            covers[key] = _CACHE[key]
+            _remember( key, covers[key] )
+            continue
+        if cache_dir is not None and os.path.exists( _cache_path( cache_dir, key ) ):
+            with np.load( _cache_path( cache_dir, key ) ) as f:
+                covers[key] = { 'order': int( f['order'] ), 'inside': f['inside'],
+                                'boundary': f['boundary'], 'fraction': f['fraction'] }
+            _remember( key, covers[key] )
+            continue
+        covers[key] = None
+        missing.append( i )
+    count( 'coverage_cached', len(polys) - len(missing) )
+
+    if len(missing) > 0:
+        with timer( 'pixel_coverage' ):
+            found = _refine( [ np.atleast_2d( polys[i] ) for i in missing ], order, extra_levels )
+        for i, cover in zip( missing, found ):
+            covers[ keys[i] ] = cover
+            _remember( keys[i], cover )
+            if cache_dir is not None:
+                os.makedirs( cache_dir, exist_ok=True )
+                path = _cache_path( cache_dir, keys[i] )
+                with open( path +'.tmp', 'wb' ) as f:
+                    np.savez( f, **cover )
+                os.replace( path +'.tmp', path )
+    return [ covers[key] for key in keys ]
+
+
+
+def coverage_at( cover, nside ):
+    # Pixel lists at nside (at most the Nside cover was made at) from one
+    #   polygon's cells: 'inside' pixels wholly inside, 'boundary' pixels
+    #   partly inside, and the estimated 'fraction' of each boundary pixel
+    order, top = nside_order( nside ), cover['order']
+    if order > top:
+        raise ValueError( "Coverage was made at Nside {:d}, not finer".format( 2**top ) )
+    k, ipix = uniq_order( cover['inside'] )
+
+    # Cells at or above this order give whole ranges of pixels
+    coarse = k <= order
+    shift = 2*( order - k[coarse] )
+    starts, sizes = ipix[coarse] << shift, np.int64( 1 ) << shift
+    inside = np.repeat( starts - np.cumsum( sizes ) + sizes, sizes ) + np.arange( sizes.sum() )
+
+    # Finer cells and boundary pixels add up within their parent at this order,
+    #   in units of pixels at the cover's order
+    parents = np.concatenate( [ ipix[~coarse] >> 2*( k[~coarse] - order ), cover['boundary'] >> 2*( top - order ) ] )
+    weights = np.concatenate( [ 4.0**( top - k[~coarse] ), cover['fraction'] ] )
+    partial = np.concatenate( [ np.zeros( ( ~coarse ).sum(), dtype=bool ), np.ones( len( cover['boundary'] ), dtype=bool ) ] )
+    pix, inv = np.unique( parents, return_inverse=True )
+    total = np.bincount( inv, weights=weights, minlength=len(pix) )
+    any_partial = np.bincount( inv, weights=partial, minlength=len(pix) ) > 0
+    full = ( total >= 4**( top - order ) ) & ~any_partial
+    inside = np.sort( np.concatenate( [ inside, pix[full] ] ) )
+    return { 'inside': inside, 'boundary': pix[~full], 'fraction': total[~full] / 4**( top - order ) }
+
+
+
+def pixel_coverage( polys, nsides, extra_levels=EXTRA_LEVELS, cache_dir=CACHE_DIR ):
+    # Inside/boundary pixel lists of each polygon at each of nsides (one pass,
+    #   at the largest): {nside: [ coverage_at dict for each polygon ]}
+    nsides = sorted( set( np.atleast_1d( nsides ).tolist() ) )
+    covers = polygon_cells( polys, nsides[-1], extra_levels, cache_dir )
+    return { nside: [ coverage_at( cover, nside ) for cover in covers ] for nside in nsides }
+
+
+
+def coverage_map( polys, nside, weights=None, extra_levels=EXTRA_LEVELS, cache_dir=CACHE_DIR ):
+    # NESTED HEALPix map of the (weighted) fraction of each pixel covered by
+    #   the polygons; overlapping polygons add up, so balkanize overlapping
+    #   masks first (mask_operations.py)
+    if weights is None:
+        weights = np.ones( len(polys) )
+    out = np.zeros( hp.nside2npix( nside ) )
+    for cover, w in zip( polygon_cells( polys, nside, extra_levels, cache_dir ), weights ):
+        cov = coverage_at( cover, nside )
+        out[ cov['inside'] ] += w
+        out[ cov['boundary'] ] += w * cov['fraction']
+    return out
+
+
+
+def ranges_to_uniq( starts, ends, order ):
+    # Fewest NUNIQ cells covering the disjoint pixel ranges [starts, ends) at
+    #   order (the largest aligned cells first, as in a MOC)
+    lo = np.asarray( starts, dtype=np.int64 )
+    hi = np.asarray( ends, dtype=np.int64 )
+    cells = []
+    for k in range( order+1 ):
+        shift = 2*( order - k )
+        a = ( lo + ( np.int64( 1 ) << shift ) - 1 ) >> shift
+        b = hi >> shift
+        ok = b > a
+        n = ( b - a )[ok]
+        first = np.repeat( a[ok] - np.cumsum( n ) + n, n ) + np.arange( n.sum() )
+        cells.append( 4 * 4**k + first )
+        # What's left of each range either side of the cells
+        lo = np.concatenate( [ lo[~ok], lo[ok], b[ok] << shift ] )
+        hi = np.concatenate( [ hi[~ok], a[ok] << shift, hi[ok] ] )
+        keep = hi > lo
+        lo, hi = lo[keep], hi[keep]
+    return np.sort( np.concatenate( cells ) )
+
+
+
+def moc_cells( polys, nside, extra_levels=EXTRA_LEVELS, cache_dir=CACHE_DIR, partial=True ):
+    # MOC (sorted NUNIQ cells, at orders up to nside's) of the union of the
+    #   polygons: the pixels inside them, and also the boundary pixels unless
+    #   partial=False (a MOC of the area surely inside)
+    order = nside_order( nside )
+    starts, ends = [], []
+    for cover in polygon_cells( polys, nside, extra_levels, cache_dir ):
+        k, ipix = uniq_order( cover['inside'] )
+        shift = 2*( order - k )
+        starts.append( ipix << shift )
+        ends.append( ( ipix + 1 ) << shift )
+        if partial:
+            starts.append( cover['boundary'] )
+            ends.append( cover['boundary'] + 1 )
+    starts, ends = np.concatenate( starts ), np.concatenate( ends )
+    if len(starts) == 0:
+        return np.zeros( 0, dtype=np.int64 )
+    # Merge overlapping or touching ranges
+    order_ = np.argsort( starts, kind='stable' )
+    starts, ends = starts[order_], np.maximum.accumulate( ends[order_] )
+    new = np.r_[ True, starts[1:] > ends[:-1] ]
+    group = np.cumsum( new ) - 1
+    merged_ends = np.zeros( group[-1]+1, dtype=np.int64 )
+    np.maximum.at( merged_ends, group, ends )
+    return ranges_to_uniq( starts[new], merged_ends, order )
+
+
+
+
+if __name__ == '__main__':
+
+    # Compare against pixel centers (and healpy's query_disc) for a cap and
+    #   a lat-long rectangle, at several Nsides
+    import time
+    from astropy import units as U
+    from week6.general_masking import return_cap_vector
+    from week6.cap_geometry import in_polygon
+    from week6.polygon_area import polygon_areas
+
+    cap = np.array( [ return_cap_vector( ra=76*U.degree, dec=36*U.degree, rad=3*U.degree ) ] )
+    rect = np.array( [ return_cap_vector( ra=150*U.degree +6*U.hourangle, dec=0*U.degree, rad=90*U.degree ),
+                       return_cap_vector( ra=210*U.degree +6*U.hourangle, dec=0*U.degree, rad=90*U.degree ),
+                       return_cap_vector( ra=0*U.hourangle, dec=90*U.degree, rad=70*U.degree ),
+                       return_cap_vector( ra=0*U.hourangle, dec=90*U.degree, rad=50*U.degree ) ] )
+    rect[1,3] *= -1
+    rect[3,3] *= -1
+    polys = [ cap, rect ]
+    areas = polygon_areas( polys )
+
+    t0 = time.time()
+    covers = pixel_coverage( polys, [64, 256, 1024] )
+    t1 = time.time()
+    pixel_coverage( polys, [64, 256, 1024] )
+    t2 = time.time()
+    print( 'Coverage at Nside 64, 256, 1024: {:.3f} s (cached: {:.4f} s)'.format( t1-t0, t2-t1 ) )
+    for nside, per_poly in covers.items():
+        for name, caps, cov, area in zip( ['cap', 'rectangle'], polys, per_poly, areas ):
+            both = np.concatenate( [ cov['inside'], cov['boundary'] ] )
+            centers = np.array( hp.pix2vec( nside, np.arange( hp.nside2npix( nside ) ), nest=True ) ).T
+            by_center = np.flatnonzero( in_polygon( caps, centers ) )
+            estimate = ( len( cov['inside'] ) + cov['fraction'].sum() ) * hp.nside2pixarea( nside )
+            print( '  Nside {:4d} {:>9s}: {:7d} inside, {:6d} boundary; all {:d} pixel centers covered: {}; '
+                   'area {:.5f} vs {:.5f} sr'.format( nside, name, len( cov['inside'] ), len( cov['boundary'] ),
+                   len(by_center), bool( np.isin( by_center, both ).all() ), estimate, area ) )
+    disc = hp.query_disc( 1024, cap[0,:3], np.radians( 3. ), inclusive=True, nest=True )
+    both = np.concatenate( [ covers[1024][0]['inside'], covers[1024][0]['boundary'] ] )
+    print( 'Cap pixels at Nside 1024 also found by query_disc(inclusive): {}/{:d}'.format(
+           np.isin( both, disc ).sum(), len(both) ) )
+    print( 'MOC of both at Nside 1024: {:d} cells'.format( len( moc_cells( polys, 1024 ) ) ) )
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tony Weinbeck
+Astro 5160
+Polygon area: exact areas (in steradians) of Mangle cap-intersection polygons
+
+The exact area uses the Gauss-Bonnet theorem. The boundary of a polygon is
+made of arcs of its cap circles, meeting at vertices where two circles cross.
+For a region on the unit sphere,
+
+    area = 2 pi chi - sum( geodesic curvature along the arcs )
+                    - sum( turning angles at the vertices )
+
+The curvature integral along an arc of a circle with opening angle r, which
+sweeps an angle dphi around the cap axis, is cos(r)*dphi. The Euler
+characteristic chi is awkward to get in general. However, chi = 2*(number of
+pieces) - (number of boundary loops), and the area lies in (0, 4 pi), so we
+only need the number of boundary loops and can reduce modulo 4 pi.
+
+Everything is done at once for all the polygons with the same number of caps,
+using padded (npoly, ncaps, ...) arrays.
+"""
+
+import numpy as np
+from week6.cap_geometry import in_polygon
+from week6.mask_randoms import candidate_pixels, cap_frames
+from utils.lazy import lazy_import
+hp = lazy_import( 'healpy' )
+
+pi = np.pi
+
+# Tolerance for deciding whether a point on one cap boundary lies inside another
+EPS = 1e-10
+
+# Most (polygon x cap^3) elements handled in one pass, to bound memory use
+MAX_ELEMENTS = 2**22
+
+
+
+def normalize_caps( caps ):
+    # Convert Mangle caps [x, y, z, cm] into (axis, c) form, in which the
+    #   region kept by every cap is p.axis >= c (so c = cos of its radius)
+    #   A complemented cap (cm < 0) becomes a cap about the antipode
+    caps = np.asarray( caps, dtype=float )
+    xyz  = caps[...,:3]
+    norm = np.linalg.norm( xyz, axis=-1, keepdims=True )
+    axes = xyz / np.where( norm > 0, norm, 1. )
+    cm   = caps[...,3]
+    flip = cm < 0
+    axes = np.where( flip[...,None], -axes, axes )
+    c    = np.where( flip, -1. - cm, 1. - cm )
+    return axes, c
+
+
+
+def _group_areas( axes, c, ncaps ):
+    # Exact areas for P polygons padded to m caps: axes (P,m,3), c (P,m),
+    #   where only the first ncaps[p] caps of polygon p are real
+    P, m = c.shape
+    idx = np.arange( m )
+    valid = idx[None,:] < ncaps[:,None]
+
+    # Caps covering the whole sphere constrain nothing; empty caps empty the polygon
+    empty = np.any( valid & (c >= 1.), axis=1 )
+    valid &= (c > -1.)
+
+    # Drop repeated caps, and empty any polygon holding a cap and its complement
+    adot = np.einsum( 'pik,pjk->pij', axes, axes )
+    pair = valid[:,:,None] & valid[:,None,:]
+    same = pair & (adot > 1-EPS) & (np.abs( c[:,:,None] - c[:,None,:] ) < EPS)
+    later = idx[None,:] > idx[:,None]
+    valid &= ~np.any( same & later[None], axis=1 )
+    empty |= np.any( pair & (adot < -1+EPS) & (np.abs( c[:,:,None] + c[:,None,:] ) < EPS), axis=(1,2) )
+
+    # Padding (and dropped) caps are replaced by ones every point lies inside
+    axes = np.where( valid[...,None], axes, np.array( [0., 0., 1.] ) )
+    c    = np.where( valid, c, -2. )
+    pair = valid[:,:,None] & valid[:,None,:] & (idx[:,None] != idx[None,:])[None]
+
+    # Intersections of every pair of circles i, j: points p with p.a_i = c_i
+    #   and p.a_j = c_j lie along the line x0 + t (a_i x a_j)
+    ai, aj = axes[:,:,None,:], axes[:,None,:,:]
+    ci, cj = c[:,:,None], c[:,None,:]
+    d      = np.clip( adot, -1., 1. )
+    denom  = np.where( pair, 1. - d**2, 1. )
+    alpha  = (ci - cj*d) / denom
+    beta   = (cj - ci*d) / denom
+    h2     = 1. - (alpha**2 + beta**2 + 2*alpha*beta*d)
+    cross  = pair & (denom > EPS) & (h2 > 0)
+    t      = np.sqrt( np.where( cross, h2/denom, 0. ) )
+    x0     = alpha[...,None]*ai + beta[...,None]*aj
+    n      = np.cross( ai, aj )
+    X      = np.stack( [x0 + t[...,None]*n, x0 - t[...,None]*n], axis=3 )   # (P,m,m,2,3)
+
+    # Vertices are intersections lying inside every other cap
+    inside = np.einsum( 'pijsk,pqk->pijsq', X, axes ) >= c[:,None,None,None,:] - EPS
+    vertex = cross[...,None] & np.all( inside, axis=-1 )                   # (P,m,m,2)
+
+    # Turning angle at each vertex: the angle between the inward normals of
+    #   the two circles (every vertex is a convex corner of the intersection)
+    ni = ai[:,:,:,None,:] - ci[...,None,None]*X
+    nj = aj[:,:,:,None,:] - cj[...,None,None]*X
+    cos_turn = np.einsum( 'pijsk,pijsk->pijs', ni, nj ) \
+             / ( np.linalg.norm( ni, axis=-1 )*np.linalg.norm( nj, axis=-1 ) + 1e-300 )
+    turning = 0.5 * np.sum( np.where( vertex, np.arccos( np.clip( cos_turn, -1., 1. ) ), 0. ), axis=(1,2,3) )
+
+    # Azimuth of every vertex around the axis of each circle it lies on
+    u, v = cap_frames( axes.reshape(-1,3) )
+    u, v = u.reshape( P, m, 3 ), v.reshape( P, m, 3 )
+    phi  = np.arctan2( np.einsum( 'pijsk,pik->pijs', X, v ), np.einsum( 'pijsk,pik->pijs', X, u ) )
+    phi  = np.where( vertex, phi, np.inf ).reshape( P, m, 2*m )
+    order = np.argsort( phi, axis=-1 )
+    phi   = np.take_along_axis( phi, order, axis=-1 )
+    nvert = vertex.reshape( P, m, 2*m ).sum( axis=-1 )
+
+    # Arc t of circle i runs from its t'th vertex to the next one (or, for a
+    #   circle with no vertices, all the way round)
+    tt     = np.arange( 2*m )
+    is_arc = tt[None,None,:] < nvert[...,None]
+    nxt    = np.where( tt[None,None,:]+1 < nvert[...,None], tt[None,None,:]+1, 0 )
+    phi0   = np.where( is_arc, phi, 0. )
+    phi1   = np.take_along_axis( phi0, nxt, axis=-1 )
+    dphi   = np.where( is_arc, (phi1 - phi0) % (2*pi), 0. )
+    dphi   = np.where( is_arc & (nvert[...,None] == 1), 2*pi, dphi )
+    full   = valid & (nvert == 0)
+    is_arc[...,0] |= full
+    dphi[...,0]    = np.where( full, 2*pi, dphi[...,0] )
+
+    # An arc is part of the boundary if its midpoint is inside every cap
+    mid = phi0 + dphi/2
+    si  = np.sqrt( np.clip( 1. - c**2, 0., None ) )[...,None,None]
+    M   = c[...,None,None]*axes[:,:,None,:] \
+        + si*( np.cos( mid )[...,None]*u[:,:,None,:] + np.sin( mid )[...,None]*v[:,:,None,:] )
+    on_boundary = is_arc & np.all( np.einsum( 'pitk,pqk->pitq', M, axes ) >= c[:,None,None,:] - EPS, axis=-1 )
+
+    # Geodesic curvature integral along the boundary arcs
+    curvature = np.sum( c[...,None] * np.where( on_boundary, dphi, 0. ), axis=(1,2) )
+
+    # Count boundary loops: whole circles, plus cycles of arcs joined at vertices
+    nloops = np.sum( full & on_boundary[...,0], axis=1 )
+    nloops += _count_arc_loops( on_boundary & ~full[...,None], order, nxt, P, m )
+
+    area = np.mod( -2*pi*nloops - turning - curvature, 4*pi )
+
+    # Polygons with no boundary are the whole sphere (no real caps) or empty;
+    #   an area indistinguishable from 4 pi could also be zero, so check
+    #   whether the polygon actually covers any of the coordinate axes
+    has_caps = np.any( valid, axis=1 )
+    area = np.where( has_caps & (nloops == 0), 0., area )
+    area = np.where( ~has_caps, 4*pi, area )
+    near_full = has_caps & (area > 4*pi - 1e-8)
+    if near_full.any():
+        probes = np.vstack( [np.eye(3), -np.eye(3)] )
+        hits = np.all( np.einsum( 'nk,pqk->pnq', probes, axes[near_full] ) >= c[near_full][:,None,:], axis=-1 )
+        area[ np.where( near_full )[0][ ~np.any( hits, axis=1 ) ] ] = 0.
+    return np.where( empty, 0., area )
+
+
+
+def _count_arc_loops( on_boundary, order, nxt, P, m ):
+    # Number of closed loops formed by the boundary arcs of each polygon
+    #   Each vertex is shared by two circles: the boundary arrives along one
+    #   and leaves along the other. Following arcs from vertex to vertex is a
+    #   permutation of the arcs, and the loops are its cycles
+    p, i, t = np.nonzero( on_boundary )
+    nloops = np.zeros( P, dtype=int )
+    if len(p) == 0:
+        return nloops
+
+    # Canonical id of a vertex: (i,j,s) and (j,i,1-s) are the same point
+    def vertex_id( p, i, slot ):
+        j, s = slot // 2, slot % 2
+        lo, hi = np.minimum( i, j ), np.maximum( i, j )
+        s = np.where( i < j, s, 1 - s )
+        return ( ( p*m + lo )*m + hi )*2 + s
+
+    start = vertex_id( p, i, order[p, i, t] )
+    end   = vertex_id( p, i, order[p, i, nxt[p, i, t]] )
+
+    # The next arc is the one leaving from this arc's end vertex
+    leaving = np.full( P*m*m*2, -1 )
+    leaving[start] = np.arange( len(p) )
+    follow = leaving[end]
+    follow = np.where( follow < 0, np.arange( len(p) ), follow )
+
+    # Label every arc with the smallest index in its cycle by pointer doubling
+    label = np.arange( len(p) )
+    for _ in range( int( np.ceil( np.log2( 2*m*m + 1 ) ) ) + 1 ):
+        label  = np.minimum( label, label[follow] )
+        follow = follow[follow]
+    heads = label == np.arange( len(p) )
+    return np.bincount( p[heads], minlength=P )
+
+
+
+def polygon_areas( polys ):
+    # Exact area (steradians) of each polygon in a list of (n_caps, 4) Mangle
+    #   cap arrays, as from read_mangle_file
+    # Polygons are grouped by their number of caps, and each group is done
+    #   in vectorized chunks
+    ncaps = np.array( [ len(p) for p in polys ] )
+    areas = np.zeros( len(polys) )
+    for m in np.unique( ncaps ):
+        which = np.where( ncaps == m )[0]
+        if m == 0:
+            areas[which] = 4*pi
+            continue
+        chunk = max( 1, MAX_ELEMENTS // (2*m**3) )
+        for k in range( 0, len(which), chunk ):
+            sel = which[ k : k+chunk ]
+            axes, c = normalize_caps( np.array( [ polys[s] for s in sel ] ) )
+            areas[sel] = _group_areas( axes, c, np.full( len(sel), m ) )
+    return areas
+
+
+
+def polygon_area( caps ):
+    # Exact area (steradians) of a single polygon
+    return polygon_areas( [ np.atleast_2d( caps ) ] )[0]
+
+
+
+def polygon_areas_healpix( polys, nside=256 ):
+    # Quick approximate areas: the number of HEALPix pixel centers at Nside
+    #   inside each polygon, times the pixel area
+    # Errors scale with the length of the polygon edges over the pixel size
+    pixarea = hp.nside2pixarea( nside )
+    areas = np.zeros( len(polys) )
+    for i, caps in enumerate( polys ):
+        pix = candidate_pixels( caps, nside )
+        if len(pix) == 0:
+            continue
+        xyz = np.array( hp.pix2vec( nside, pix, nest=True ) ).T
+        areas[i] = np.sum( in_polygon( caps, xyz ) ) * pixarea
+    return areas
+
+
+
+
+if __name__ == '__main__':
+
+    # Check against the lat-long rectangle formula used in General_Masks.py
+    from week6.general_masking import return_cap_vector, calc_area
+    from astropy import units as U
+
+    ra_min, ra_max   =  5 *U.hourangle,  6 *U.hourangle
+    dec_min, dec_max = 30 *U.degree,    40 *U.degree
+    rect = np.array( [ return_cap_vector( ra=ra_min +6*U.hourangle, dec=0*U.degree, rad=90*U.degree ),
+                       return_cap_vector( ra=ra_max +6*U.hourangle, dec=0*U.degree, rad=90*U.degree ),
+                       return_cap_vector( ra=0*U.hourangle, dec=90*U.degree, rad=(90*U.degree - dec_min) ),
+                       return_cap_vector( ra=0*U.hourangle, dec=90*U.degree, rad=(90*U.degree - dec_max) ) ] )
+    # The second and fourth caps keep the side away from the rectangle, so flip them
+    rect[1,3] *= -1
+    rect[3,3] *= -1
+
+    print( 'calc_area:              {:.9f} str'.format( calc_area( ra_min.to(U.deg).value, ra_max.to(U.deg).value, dec_min, dec_max ) ) )
+    print( 'polygon_area:           {:.9f} str'.format( polygon_area( rect ) ) )
+    print( 'polygon_areas_healpix:  {:.9f} str'.format( polygon_areas_healpix( [rect], nside=1024 )[0] ) )
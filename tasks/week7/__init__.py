@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week7; week7.call_earlier_function (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['call_earlier_function'] )
@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week8; week8.cross_match_surveys (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['cross_match_surveys', 'local_skyserver', 'query_cache', 'sdssDR9query', 'sdss_scatter_plot'] )
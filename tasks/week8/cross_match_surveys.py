@@ -3,9 +3,16 @@
 
 #import astropy
 import os
-from astropy.table import Table
-import matplotlib.pyplot as plt
+import numpy as np
 import glob
+from week4.sky_density import plot_sky_density
+from week8.query_cache import ingest_csv, FIRST_MATCH_COLUMNS
+from week8.local_skyserver import localQuery, DEFAULT_DB
+from utils import instrument
+from utils.instrument import timer, timed, count
+from utils.lazy import lazy_import
+Table = lazy_import( 'astropy.table', 'Table' )
+plt = lazy_import( 'matplotlib.pyplot' )
 
 '''
 ASTRO5160 Week 8 Class 16: Cross-Matching Surveys
@@ -13,7 +20,8 @@ ASTRO5160 Week 8 Class 16: Cross-Matching Surveys
 -Reads and plots all sources from local VLA FIRST file
    (must be able to access /d/scratch for relevant file)
 -Runs remote SDSS query script to find counterparts within 1.2" of first 100 FIRST sources
-   (must have previously downloaded 'sdssDR9query.py' into local directory)
+   (must have previously downloaded 'sdssDR9query.py' into local directory), or
+   runs the same queries locally if there is a local_skyserver.py database
 -Lists all Legacy Survey sweep files needed to match first 100 FIRST sources to
    Legacy Survey sources (again must have access to /d/scratch)
 -----------------
@@ -22,10 +30,13 @@ ASTRO5160 Week 8 Class 16: Cross-Matching Surveys
 
 
 
+@timed( 'plot' )
 def plot_aitoff( ras, decs, output_file ):
+    # RA/Dec in degrees; the Aitoff axes want radians, with RA in [-pi, pi)
+    #   Sources are binned into a density image rather than scattered one by one
     fig = plt.figure()
     ax = fig.add_subplot(111, projection="aitoff")
-    ax.scatter( ras, decs, marker='o', color='r', s=0.1, alpha=0.05 )
+    plot_sky_density( ax, np.radians( ras ), np.radians( decs ), color='r' )
     xlab = ['14h','16h','18h','20h','22h','0h','2h','4h','6h','8h','10h']
     ax.set_xticklabels( xlab, weight=600, color='k' )
     ax.grid( color='k', linestyle='dashed', linewidth=1 )
@@ -91,7 +102,8 @@ if __name__ == '__main__':
     # Q1: Read in VLA FIRST file as table
     cwd = os.getcwd()
     first_file = '/d/scratch/ASTR5160/data/first/first_08jul16.fits'
-    first_data = Table.read( first_file )
+    with timer( 'read_fits' ):
+        first_data = Table.read( first_file )
     ras = first_data['RA']
     decs = first_data['DEC']
     output_file = os.path.join( cwd, 'first_sources_plot.png' )
@@ -104,11 +116,29 @@ if __name__ == '__main__':
     # Save the list of matches the following output file
     outfile = os.path.join( cwd, 'first_sdss_matches.txt' )
     if os.path.exists( outfile ):  os.remove( outfile )
-    for i in range( 0, num_sources ):
-        print( 'Querying source {:d} of {:d}, with RA, Dec of {:10f}, {:10f}'.format( \
-                i+1, num_sources, ras[i], decs[i] ) )
-        command = 'python sdssDR9query.py ' +str(ras[i]) +' ' +str(decs[i]) +' >> ' +outfile
-        os.system( command )
+    if os.path.exists( DEFAULT_DB ):
+        # A local copy of PhotoObj (see local_skyserver.py): same query, same
+        #   output (the last line of the result), run in-process with no rate limit
+        qry = localQuery()
+        with open( outfile, 'w' ) as f:
+            for i in range( 0, num_sources ):
+                qry.query = 'SELECT top 1 ra,dec,u,g,r,i,z,GNOE.distance*60 FROM PhotoObj as PT ' \
+                            'JOIN dbo.fGetNearbyObjEq(' +str(ras[i]) +',' +str(decs[i]) +',0.02) as GNOE ' \
+                            'on PT.objID = GNOE.objID ORDER BY GNOE.distance'
+                with timer( 'sdss_query' ):
+                    f.write( list( qry.executeQuery() )[-1].decode() )
+    else:
+        for i in range( 0, num_sources ):
+            print( 'Querying source {:d} of {:d}, with RA, Dec of {:10f}, {:10f}'.format( \
+                    i+1, num_sources, ras[i], decs[i] ) )
+            command = 'python sdssDR9query.py ' +str(ras[i]) +' ' +str(decs[i]) +' >> ' +outfile
+            with timer( 'sdss_query' ):
+                os.system( command )
+            count( 'http_requests' )
+    # Convert the (headerless) matches into a typed columnar cache, recording the query
+    match_query = 'SELECT top 1 ra,dec,u,g,r,i,z,GNOE.distance*60 FROM PhotoObj as PT ' \
+                  'JOIN dbo.fGetNearbyObjEq(RA,DEC,0.02) as GNOE on PT.objID = GNOE.objID ORDER BY GNOE.distance'
+    ingest_csv( outfile, query=match_query, names=FIRST_MATCH_COLUMNS )
 
 
     # Q6: List all the Legacy Survey Sweep files needed to find matches for first 100
@@ -136,6 +166,10 @@ if __name__ == '__main__':
     print( '\n\nSweep files needed for first {:d} FIRST sources:'.format( num_sources ) )
     print( *files_needed, sep='\n' )
 
+    # Per-stage timings, if run with ASTRO5160_INSTRUMENT=1
+    if instrument.enabled():
+        instrument.report()
+
 
 
 
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import math
+import sqlite3
+import numpy as np
+from week6.cap_geometry import radec_to_xyz
+from week8.sdssDR9query import sdssQuery
+from utils.instrument import timer, count
+
+'''
+ASTRO5160 Week 8: Local SkyServer (SQLite, HTM-indexed)
+-----------------
+-load_catalog() loads a PhotoObj-like extract (FITS file, .npy column
+   directory, CSV query result or dict of arrays) into a PhotoObj table in an
+   SQLite file, with each object's unit vector (cx, cy, cz) and its HTM
+   (Hierarchical Triangular Mesh) trixel ID at depth 20, as on SkyServer
+-htmID is indexed, and every trixel at a coarser depth is one contiguous
+   range of htmIDs, so the objects near a position are found by a handful of
+   index range scans (htm_cover) plus an exact distance cut
+-run_query() takes the SQL text SkyServer takes (e.g. what sdssQuery.filterQuery
+   produces): dbo.fGetNearbyObjEq(ra, dec, arcmin) and fGetNearestObjEq are
+   evaluated into temporary tables (objID, htmID, cx, cy, cz, distance in
+   arcmin) and the call is replaced by the table; 'SELECT top N' becomes LIMIT N
+-localQuery is sdssQuery, executed against the local file (same CSV lines
+   back, no rate limit); serve() answers x_sql.asp-style HTTP requests, so the
+   remote client itself can be pointed at it
+-----------------
+*Note: run 'python local_skyserver.py load photoobj.fits' to build skyserver.db, then e.g.
+   'python local_skyserver.py query "SELECT top 1 ra,dec,g FROM PhotoObj p JOIN dbo.fGetNearbyObjEq(145.28,34.74,0.02) n on p.objID = n.objID"'
+'''
+
+# Default database file (or set ASTRO5160_SKYSERVER_DB)
+DEFAULT_DB = os.environ.get( 'ASTRO5160_SKYSERVER_DB', 'skyserver.db' )
+
+# HTM depth of the stored htmIDs (SkyServer uses 20, ~0.3 arcsec trixels)
+HTM_DEPTH = 20
+
+# Rows inserted at a time while loading
+LOAD_ROWS = 2**18
+
+# Columns computed on loading (any of these in the input are replaced)
+DERIVED_COLUMNS = ['cx', 'cy', 'cz', 'htmID']
+
+# The 8 root trixels (IDs 8-15: S0-S3, N0-N3), as vertex triples in
+#   counter-clockwise order seen from outside the sphere
+_V = np.array( [ [0., 0., 1.], [1., 0., 0.], [0., 1., 0.], [-1., 0., 0.], [0., -1., 0.], [0., 0., -1.] ] )
+HTM_ROOTS = { 8: ( _V[1], _V[5], _V[2] ), 9: ( _V[2], _V[5], _V[3] ), 10: ( _V[3], _V[5], _V[4] ),
+              11: ( _V[4], _V[5], _V[1] ), 12: ( _V[1], _V[0], _V[4] ), 13: ( _V[4], _V[0], _V[3] ),
+              14: ( _V[3], _V[0], _V[2] ), 15: ( _V[2], _V[0], _V[1] ) }
+
+_NEARBY = re.compile( r'(?:\bdbo\.)?\b(fGetNearbyObjEq|fGetNearestObjEq)\s*\(([^()]*)\)', re.IGNORECASE )
+_TOP = re.compile( r'^\s*select\s+(distinct\s+)?top\s+(\d+)\s+', re.IGNORECASE )
+_CONNECTIONS = {}
+
+pi = np.pi
+
+
+
+def _normalize( v ):
+    # Unit vector(s) along v (components on the first axis)
+    return v / np.sqrt( np.sum( v*v, axis=0 ) )
+
+
+
+def htm_ids( ras, decs, depth=HTM_DEPTH ):
+    # HTM trixel IDs (int64) of RA/Dec positions (degrees) at the given depth
+    #   Every point descends the mesh together, one level per step: at each
+    #   level the trixel (a, b, c) splits at its edge midpoints into
+    #   (a, w2, w1), (b, w0, w2), (c, w1, w0) and (w0, w1, w2)
+    p = radec_to_xyz( ras, decs ).T
+    n = p.shape[1]
+    ids = np.zeros( n, dtype=np.int64 )
+    a, b, c = np.zeros( (3, n) ), np.zeros( (3, n) ), np.zeros( (3, n) )
+    found = np.zeros( n, dtype=bool )
+    for root, ( ra_, rb, rc ) in HTM_ROOTS.items():
+        inside = ~found & ( np.cross( ra_, rb ) @ p >= 0 ) & ( np.cross( rb, rc ) @ p >= 0 ) \
+                        & ( np.cross( rc, ra_ ) @ p >= 0 )
+        ids[inside] = root
+        a[:, inside], b[:, inside], c[:, inside] = ra_[:,None], rb[:,None], rc[:,None]
+        found |= inside
+
+    for level in range( depth ):
+        w0, w1, w2 = _normalize( b+c ), _normalize( a+c ), _normalize( a+b )
+        # Which side of each inner edge the point is on
+        in0 = np.sum( np.cross( w2, w1, axis=0 ) * p, axis=0 ) >= 0
+        in1 = ~in0 & ( np.sum( np.cross( w0, w2, axis=0 ) * p, axis=0 ) >= 0 )
+        in2 = ~in0 & ~in1 & ( np.sum( np.cross( w1, w0, axis=0 ) * p, axis=0 ) >= 0 )
+        child = np.where( in0, 0, np.where( in1, 1, np.where( in2, 2, 3 ) ) )
+        ids = 4*ids + child
+        a, b, c = np.where( in0, a, np.where( in1, b, np.where( in2, c, w0 ) ) ), \
+                  np.where( in0, w2, np.where( in1, w0, np.where( in2, w1, w1 ) ) ), \
+                  np.where( in0, w1, np.where( in1, w2, np.where( in2, w0, w2 ) ) )
+    return ids
+
+
+
+def cover_depth( radius, depth=HTM_DEPTH ):
+    # Depth at which to cover a circle of radius (degrees): trixels of about
+    #   a quarter of the radius, so a few tens of them are enough
+    level = int( np.floor( np.log2( 90. / max( radius, 1e-9 ) ) ) ) + 2
+    return min( max( level, 0 ), depth )
+
+
+
+def _unit( a, b, c=None ):
+    # Unit vector along a+b (+c), for 3-tuples
+    x, y, z = a[0]+b[0], a[1]+b[1], a[2]+b[2]
+    if c is not None:
+        x, y, z = x+c[0], y+c[1], z+c[2]
+    norm = math.sqrt( x*x + y*y + z*z )
+    return ( x/norm, y/norm, z/norm )
+
+
+
+def _dot( a, b ):
+    # Dot product of 3-tuples
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+
+
+def htm_cover( ra, dec, radius, depth=HTM_DEPTH, level=None ):
+    # Ranges [lo, hi] of depth-'depth' htmIDs covering the circle of radius
+    #   (degrees) around RA/Dec, merged and sorted
+    #   Trixels inside the circle, or partly inside at depth 'level' (default
+    #   cover_depth), contribute all of their descendants' IDs; trixels whose
+    #   bounding circle misses it are dropped
+    #   (a few hundred trixels are visited, so plain floats beat numpy here)
+    if level is None:
+        level = cover_depth( radius, depth )
+    center = tuple( radec_to_xyz( ra, dec )[0].tolist() )
+    rad, cos_r = math.radians( radius ), math.cos( math.radians( radius ) )
+    ranges = []
+    stack = [ ( root, tuple( a ), tuple( b ), tuple( c ), 0 ) for root, ( a, b, c ) in HTM_ROOTS.items() ]
+    while len(stack) > 0:
+        tid, a, b, c, d = stack.pop()
+        full = rad < pi/2 and _dot( a, center ) >= cos_r and _dot( b, center ) >= cos_r \
+                          and _dot( c, center ) >= cos_r
+        if not full:
+            m = _unit( a, b, c )
+            rho = math.acos( max( min( _dot( m, a ), _dot( m, b ), _dot( m, c ), 1. ), -1. ) )
+            if math.acos( max( min( _dot( m, center ), 1. ), -1. ) ) > rad + rho + 1e-12:
+                continue
+        if full or d == level:
+            shift = 2*( depth-d )
+            ranges.append( ( tid << shift, ( (tid+1) << shift ) - 1 ) )
+            continue
+        w0, w1, w2 = _unit( b, c ), _unit( a, c ), _unit( a, b )
+        stack.extend( [ ( 4*tid, a, w2, w1, d+1 ), ( 4*tid+1, b, w0, w2, d+1 ),
+                        ( 4*tid+2, c, w1, w0, d+1 ), ( 4*tid+3, w0, w1, w2, d+1 ) ] )
+
+    merged = []
+    for lo, hi in sorted( ranges ):
+        if len(merged) > 0 and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max( merged[-1][1], hi )
+        else:
+            merged.append( [lo, hi] )
+    return [ tuple( r ) for r in merged ]
+
+
+
+def connect( db=DEFAULT_DB, create=False ):
+    # Open (and remember) a connection to a local SkyServer file
+    key = os.path.abspath( db )
+    if key not in _CONNECTIONS:
+        if not create and not os.path.exists( db ):
+            raise ValueError( "No SkyServer database '{}': build one with load_catalog()".format( db ) )
+        con = sqlite3.connect( db )
+        con.execute( 'PRAGMA cache_size = -262144' )
+        con.execute( 'PRAGMA temp_store = MEMORY' )
+        _CONNECTIONS[key] = con
+    return _CONNECTIONS[key]
+
+
+
+def _sql_type( values ):
+    # SQLite column type of a numpy column
+    kind = values.dtype.kind
+    if kind in 'iub':
+        return 'INTEGER'
+    if kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+
+def _iter_source( source ):
+    # Chunks {column: array} of a catalog: CSV files go through the columnar
+    #   query cache, anything else through week2/fits_query.py
+    from week2.fits_query import expand_sources, iter_chunks, _native
+    for src in expand_sources( source ):
+        if isinstance( src, str ) and src.lower().endswith( ( '.csv', '.txt' ) ):
+            from week8.query_cache import cached_csv
+            src = dict( cached_csv( src ) )
+        for chunk, nrows in iter_chunks( src, LOAD_ROWS ):
+            if not isinstance( chunk, dict ):
+                chunk = { name: chunk[name] for name in chunk.columns.names }
+            yield { col: _native( values ) for col, values in chunk.items() }, nrows
+
+
+
+def load_catalog( source, db=DEFAULT_DB, table='PhotoObj' ):
+    # Load a PhotoObj-like catalog into the database (appending to any
+    #   rows already there), computing cx, cy, cz and htmID for each object
+    #   source: FITS file, .npy column directory, CSV file, dict of arrays, or
+    #           a list/glob of these; it needs RA and DEC columns (any case),
+    #           and objIDs are numbered on from the largest so far if it has
+    #           no objID column
+    #   Vector columns (e.g. FITS arrays) are skipped
+    # Returns the number of rows loaded
+    con = connect( db, create=True )
+    con.execute( 'CREATE TABLE IF NOT EXISTS _meta ( key TEXT PRIMARY KEY, value )' )
+    row = con.execute( "SELECT value FROM _meta WHERE key = 'htm_depth'" ).fetchone()
+    if row is not None and row[0] != HTM_DEPTH:
+        raise ValueError( "{} holds htmIDs at depth {}, not {}".format( db, row[0], HTM_DEPTH ) )
+    con.execute( "INSERT OR REPLACE INTO _meta VALUES ( 'htm_depth', ? )", ( HTM_DEPTH, ) )
+
+    derived = [ c.lower() for c in DERIVED_COLUMNS ]
+    names, loaded = None, 0
+    for chunk, nrows in _iter_source( source ):
+        lower = { col.lower(): col for col in chunk }
+        if 'ra' not in lower or 'dec' not in lower:
+            raise ValueError( "Catalog has no RA/DEC columns: {}".format( list( chunk ) ) )
+        ras, decs = chunk[lower['ra']].astype( float ), chunk[lower['dec']].astype( float )
+        columns = { col: values for col, values in chunk.items()
+                    if values.ndim == 1 and col.lower() not in derived and col.lower() != 'objid' }
+        if 'objid' in lower:
+            objids = chunk[lower['objid']].astype( np.int64 )
+        else:
+            start = con.execute( 'SELECT max( objID ) FROM {}'.format( table ) ).fetchone()[0] \
+                    if _has_table( con, table ) else None
+            start = 0 if start is None else start + 1
+            objids = start + np.arange( nrows, dtype=np.int64 )
+        xyz = radec_to_xyz( ras, decs )
+        columns = dict( objID=objids, **columns, cx=xyz[:,0], cy=xyz[:,1], cz=xyz[:,2],
+                        htmID=htm_ids( ras, decs ) )
+
+        if names is None:
+            names = list( columns )
+            spec = [ 'objID INTEGER PRIMARY KEY' ] + \
+                   [ '"{}" {}'.format( col, _sql_type( columns[col] ) ) for col in names[1:] ]
+            con.execute( 'CREATE TABLE IF NOT EXISTS {} ( {} )'.format( table, ', '.join( spec ) ) )
+            known = { r[1].lower(): r[1] for r in con.execute( 'PRAGMA table_info({})'.format( table ) ) }
+            names = [ col for col in names if col.lower() in known ]
+        lists = [ columns[col].tolist() for col in names ]
+        with timer( 'sql_load' ):
+            con.executemany( 'INSERT INTO {} ( {} ) VALUES ( {} )'.format(
+                                 table, ', '.join( '"{}"'.format( c ) for c in names ),
+                                 ', '.join( '?' * len(names) ) ), zip( *lists ) )
+        count( 'rows_loaded', nrows )
+        loaded += nrows
+
+    if names is not None:
+        # Built after the bulk insert, which is much faster than keeping it up to date
+        con.execute( 'CREATE INDEX IF NOT EXISTS {0}_htmID ON {0} ( htmID )'.format( table ) )
+    con.commit()
+    return loaded
+
+
+
+def _has_table( con, table ):
+    # True if the database has this table
+    return con.execute( "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE",
+                        ( table, ) ).fetchone()[0] > 0
+
+
+
+def nearby_objects( ra, dec, radius, db=DEFAULT_DB, table='PhotoObj', nearest=False ):
+    # Objects within radius (arcmin) of RA/Dec (degrees), as SkyServer's
+    #   fGetNearbyObjEq: {objID, htmID, cx, cy, cz, distance (arcmin)}, sorted
+    #   by distance; nearest=True keeps only the closest (fGetNearestObjEq)
+    con = connect( db )
+    found = []
+    with timer( 'htm_search' ):
+        for lo, hi in htm_cover( ra, dec, radius / 60. ):
+            found.extend( con.execute( 'SELECT objID, htmID, cx, cy, cz FROM {} WHERE htmID BETWEEN ? AND ?'
+                                       .format( table ), ( lo, hi ) ).fetchall() )
+    count( 'htm_candidates', len(found) )
+    rows = np.array( found, dtype=float ).reshape( -1, 5 )
+    objids = np.array( [ r[0] for r in found ], dtype=np.int64 )
+    htmids = np.array( [ r[1] for r in found ], dtype=np.int64 )
+    # Chord length -> angle, which stays accurate for tiny separations
+    center = radec_to_xyz( ra, dec )[0]
+    chord = np.sqrt( np.sum( ( rows[:, 2:] - center )**2, axis=1 ) )
+    distance = np.degrees( 2*np.arcsin( np.minimum( chord/2, 1. ) ) ) * 60.
+    order = np.argsort( distance, kind='stable' )
+    order = order[ distance[order] <= radius ]
+    if nearest:
+        order = order[:1]
+    return { 'objID': objids[order], 'htmID': htmids[order], 'cx': rows[order, 2],
+             'cy': rows[order, 3], 'cz': rows[order, 4], 'distance': distance[order] }
+
+
+
+def fGetNearbyObjEq( ra, dec, radius, db=DEFAULT_DB ):
+    # SkyServer's fGetNearbyObjEq: objects within radius (arcmin) of RA/Dec
+    return nearby_objects( ra, dec, radius, db )
+
+
+
+def fGetNearestObjEq( ra, dec, radius, db=DEFAULT_DB ):
+    # SkyServer's fGetNearestObjEq: the closest object within radius (arcmin)
+    return nearby_objects( ra, dec, radius, db, nearest=True )
+
+
+
+def translate_query( sql, con, db=DEFAULT_DB ):
+    # Rewrite SkyServer (SQL Server) text for SQLite: each fGetNearbyObjEq /
+    #   fGetNearestObjEq call is evaluated into a temporary table which takes
+    #   its place, 'dbo.' prefixes are dropped and 'SELECT top N' becomes
+    #   LIMIT N; returns (new SQL, temporary tables to drop afterwards)
+    tables = []
+
+    def evaluate( match ):
+        try:
+            ra, dec, radius = [ float( arg ) for arg in match.group( 2 ).split( ',' ) ]
+        except ValueError:
+            raise ValueError( "{}() needs 3 numbers (ra, dec, arcmin), not '{}'".format(
+                              match.group( 1 ), match.group( 2 ) ) )
+        found = nearby_objects( ra, dec, radius, db, nearest=match.group( 1 ).lower() == 'fgetnearestobjeq' )
+        name = '_nearby{:d}'.format( len(tables) )
+        con.execute( 'CREATE TEMP TABLE {} ( objID INTEGER PRIMARY KEY, htmID INTEGER, cx REAL, cy REAL, '
+                     'cz REAL, distance REAL )'.format( name ) )
+        con.executemany( 'INSERT INTO {} VALUES ( ?, ?, ?, ?, ?, ? )'.format( name ),
+                         zip( *[ found[c].tolist() for c in ['objID', 'htmID', 'cx', 'cy', 'cz', 'distance'] ] ) )
+        tables.append( name )
+        return name
+
+    sql = sql.strip().rstrip( ';' )
+    try:
+        sql = _NEARBY.sub( evaluate, sql )
+    except Exception:
+        drop_tables( con, tables )
+        raise
+    sql = re.sub( r'\bdbo\.', '', sql, flags=re.IGNORECASE )
+    top = _TOP.match( sql )
+    if top is not None:
+        sql = 'SELECT ' + ( top.group( 1 ) or '' ) + sql[top.end():] + ' LIMIT ' + top.group( 2 )
+    return sql, tables
+
+
+
+def drop_tables( con, tables ):
+    # Drop temporary tables made by translate_query
+    for name in tables:
+        con.execute( 'DROP TABLE IF EXISTS temp.{}'.format( name ) )
+
+
+
+def run_query( sql, db=DEFAULT_DB ):
+    # Run SkyServer SQL text on the local database; returns (column names,
+    #   list of row tuples)
+    con = connect( db )
+    sql, tables = translate_query( sql, con, db )
+    try:
+        with timer( 'sql_query' ):
+            cursor = con.execute( sql )
+            rows = cursor.fetchall()
+        names = [ d[0] for d in cursor.description ] if cursor.description is not None else []
+    except sqlite3.Error as e:
+        raise ValueError( "SQL error: {} in '{}'".format( e, sql ) )
+    finally:
+        drop_tables( con, tables )
+    count( 'sql_queries' )
+    return names, rows
+
+
+
+def csv_lines( names, rows ):
+    # Query results as the lines (bytes) of SkyServer's CSV output
+    lines = [ b'#Table1\n', ( ','.join( names ) + '\n' ).encode() ]
+    for row in rows:
+        lines.append( ( ','.join( '' if v is None else str( v ) for v in row ) + '\n' ).encode() )
+    return lines
+
+
+
+class localQuery( sdssQuery ):
+    # sdssQuery, answered by the local database instead of SkyServer: set
+    #   .query, and executeQuery() returns the same CSV lines (as bytes), with
+    #   no need to wait between queries
+    db = DEFAULT_DB
+
+    def executeQuery( self ):
+        self.filterQuery()
+        return iter( csv_lines( *run_query( self.cleanQuery, self.db ) ) )
+
+
+
+def serve( db=DEFAULT_DB, port=8005 ):
+    # Answer SkyServer x_sql.asp-style requests (?cmd=SQL&format=csv, on any
+    #   path) over HTTP from the local database, e.g. for sdssQuery with
+    #   url = 'http://localhost:8005/x_sql.asp'
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class Handler( BaseHTTPRequestHandler ):
+        def do_GET( self ):
+            params = parse_qs( urlparse( self.path ).query )
+            try:
+                body, status = b''.join( csv_lines( *run_query( params.get( 'cmd', [''] )[0], db ) ) ), 200
+            except ValueError as e:
+                body, status = ( 'ERROR: {}\n'.format( e ) ).encode(), 400
+            self.send_response( status )
+            self.send_header( 'Content-Type', 'text/plain' )
+            self.send_header( 'Content-Length', str( len(body) ) )
+            self.end_headers()
+            self.wfile.write( body )
+
+    connect( db )
+    print( 'Serving {} on http://localhost:{:d}/x_sql.asp'.format( db, port ) )
+    HTTPServer( ( 'localhost', port ), Handler ).serve_forever()
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    ap = ArgumentParser( description='Local SkyServer: load a catalog, run SkyServer SQL, or serve it over HTTP' )
+    ap.add_argument( "command", choices=['load', 'query', 'serve'] )
+    ap.add_argument( "args", nargs='*', help='load: catalog files; query: SQL text' )
+    ap.add_argument( "--db", default=DEFAULT_DB, help='Database file' )
+    ap.add_argument( "--port", type=int, default=8005, help='Port for serve' )
+    ns = ap.parse_intermixed_args()
+
+    if ns.command == 'load':
+        print( '{:d} rows loaded into {}'.format( load_catalog( ns.args, ns.db ), ns.db ) )
+    elif ns.command == 'query':
+        qry = localQuery()
+        qry.db = ns.db
+        qry.query = ' '.join( ns.args )
+        for line in qry.executeQuery():
+            print( line.decode().rstrip() )
+    else:
+        serve( ns.db, ns.port )
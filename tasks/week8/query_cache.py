@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+ASTRO5160 Week 8: Columnar cache for SkyServer query results
+-----------------
+-Parses a query result file (CSV, with or without a header line) once, and
+   saves each column as its own typed .npy file in a cache directory
+-A schema.json file alongside records the column names/types, the number
+   of rows, the SQL query text and where/when the data came from
+-Columns are loaded back memory-mapped, so opening even a 10^7-row dump
+   only reads the columns (and pages) which are actually used
+-The cache is rebuilt automatically if the source file changes
+-----------------
+'''
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from utils.lazy import lazy_import
+pd = lazy_import( 'pandas' )
+
+# Name of the schema/provenance file inside each cache directory
+SCHEMA_FILE = 'schema.json'
+
+# Columns returned by sdssDR9query.py (distance is in arcsec)
+FIRST_MATCH_COLUMNS = ['ra', 'dec', 'u', 'g', 'r', 'i', 'z', 'distance']
+
+
+
+def cache_dir_for( fname ):
+    # Default cache directory for a source file: 'results.csv' -> 'results.csv.cols/'
+    return fname + '.cols'
+
+
+
+def file_checksum( fname, blocksize=2**20 ):
+    # SHA-256 of a file, read in blocks
+    sha = hashlib.sha256()
+    with open( fname, 'rb' ) as f:
+        for block in iter( lambda: f.read( blocksize ), b'' ):
+            sha.update( block )
+    return sha.hexdigest()
+
+
+
+def read_schema( cache_dir ):
+    # Read the schema/provenance dictionary of a cache directory
+    with open( os.path.join( cache_dir, SCHEMA_FILE ) ) as f:
+        return json.load( f )
+
+
+
+def is_fresh( fname, cache_dir ):
+    # True if cache_dir holds a complete cache of the current version of fname
+    #   (the schema is written last, so a half-written cache has none)
+    try:
+        schema = read_schema( cache_dir )
+    except (OSError, ValueError):
+        return False
+    stat = os.stat( fname )
+    source = schema['source']
+    if source['size'] != stat.st_size:
+        return False
+    if source['mtime'] == stat.st_mtime:
+        return True
+    # Touched but maybe not changed: fall back to comparing contents
+    return source['sha256'] == file_checksum( fname )
+
+
+
+def ingest_csv( fname, cache_dir=None, query='', names=None, dtypes=None ):
+    # Convert a CSV query result into a columnar cache
+    #   names: column names, for files with no header line (e.g. the output
+    #          of sdssDR9query.py); rows which don't parse as numbers (such as
+    #          repeated header lines or 'no objects found' messages) are dropped
+    #   dtypes: optional {column: dtype}, e.g. to store magnitudes as float32
+    #   query: SQL text which produced the file, kept as provenance
+    # Returns the cache directory
+    if cache_dir is None:
+        cache_dir = cache_dir_for( fname )
+    os.makedirs( cache_dir, exist_ok=True )
+
+    if names is None:
+        df = pd.read_csv( fname )
+    else:
+        df = pd.read_csv( fname, header=None, names=names, comment='#' )
+        df = df.apply( pd.to_numeric, errors='coerce' ).dropna( how='any' )
+    if dtypes is not None:
+        df = df.astype( dtypes )
+
+    # Remove any schema first, so the cache reads as incomplete until done
+    schema_path = os.path.join( cache_dir, SCHEMA_FILE )
+    if os.path.exists( schema_path ):
+        os.remove( schema_path )
+
+    columns = []
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            # Strings must be fixed-width to be memory-mappable
+            values = values.astype( str )
+        np.save( os.path.join( cache_dir, str(col) +'.npy' ), values )
+        columns.append( { 'name': str(col), 'dtype': values.dtype.str } )
+
+    stat = os.stat( fname )
+    schema = { 'columns': columns,
+               'nrows': len(df),
+               'query': query,
+               'source': { 'path': os.path.abspath( fname ), 'size': stat.st_size,
+                           'mtime': stat.st_mtime, 'sha256': file_checksum( fname ) },
+               'created': time.strftime( '%Y-%m-%dT%H:%M:%S' ) }
+    with open( schema_path, 'w' ) as f:
+        json.dump( schema, f, indent=2 )
+    return cache_dir
+
+
+
+def load_columns( cache_dir, columns=None, mmap=True ):
+    # Load columns from a cache directory as {name: array}
+    #   columns: list of names to load (default all); others are never opened
+    #   mmap: if True the arrays are read-only memory maps, so only the parts
+    #         actually used are read from disk
+    schema = read_schema( cache_dir )
+    if columns is None:
+        columns = [ c['name'] for c in schema['columns'] ]
+    known = { c['name'] for c in schema['columns'] }
+    missing = [ c for c in columns if c not in known ]
+    if len(missing) > 0:
+        raise ValueError( "Columns not in cache {}: {}".format( cache_dir, missing ) )
+
+    mode = 'r' if mmap else None
+    return { c: np.load( os.path.join( cache_dir, c +'.npy' ), mmap_mode=mode ) for c in columns }
+
+
+
+def cached_csv( fname, cache_dir=None, query='', names=None, dtypes=None, columns=None, mmap=True ):
+    # Load a CSV query result through its columnar cache, (re)building the
+    #   cache first if it is missing or older than the CSV file
+    if cache_dir is None:
+        cache_dir = cache_dir_for( fname )
+    if not is_fresh( fname, cache_dir ):
+        ingest_csv( fname, cache_dir, query=query, names=names, dtypes=dtypes )
+    return load_columns( cache_dir, columns=columns, mmap=mmap )
+
+
+
+
+if __name__ == '__main__':
+
+    # Cache the week 8 SQL results, and show what was stored
+    fname = 'sql_results.csv'
+    query = 'SELECT p.ra, p.dec, p.g FROM photoObj p, dbo.fGetNearbyObjEq(300,-1,2) n WHERE p.objID = n.objID'
+    data = cached_csv( fname, query=query )
+    print( json.dumps( read_schema( cache_dir_for( fname ) ), indent=2 ) )
+    print( { c: ( v.dtype, v.shape ) for c, v in data.items() } )
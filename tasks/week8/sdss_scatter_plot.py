@@ -14,29 +14,81 @@ ASTRO5160 Week 8 Class 15: SDSS SQL Query
 -Plot all sources with size proportional to brightness
 -----------------
 *Note: must have pandas module installed to handle data frames
+*Note: the query results are cached by column (see query_cache.py)
 '''
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as tk
 import numpy as np
 import math
+from week8.query_cache import cached_csv
+from utils.instrument import timed
+from utils.lazy import lazy_import
+plt = lazy_import( 'matplotlib.pyplot' )
+tk  = lazy_import( 'matplotlib.ticker' )
+to_rgba_array = lazy_import( 'matplotlib.colors', 'to_rgba_array' )
 
 
 def plot_within_bounds( df, col, lower_bound=-np.inf, upper_bound=np.inf, size=36 ):
     # Function to plot all objects from 'df' data frame whose column values
     #   lie within a specified range
+    #   'df' may also be a dictionary of column arrays (e.g. from cached_csv)
 
     # Select only objects with magnitude within range    
-    mask = (df[col] > lower_bound) & (df[col] < upper_bound)
-    selected = df[mask]
+    values = np.asarray( df[col] )
+    mask = (values > lower_bound) & (values < upper_bound)
     # The RA's and Dec's of selected objects
-    ras  = selected['ra']
-    decs = selected['dec']
+    ras  = np.asarray( df['ra'] )[mask]
+    decs = np.asarray( df['dec'] )[mask]
 
     # Plot selected RA/Dec pairs on scatter plot
     plt.scatter( ras, decs, s=size, c='b', alpha=0.5 )
+    format_sky_axes()
+    
+    return
+
+
+
+def per_point( mapping, values, idx ):
+    # Expand a size or colour mapping to one entry per point
+    #   mapping may be a single value for every point, a sequence with one
+    #   entry per bin (looked up with the bin indices idx), or a function
+    #   applied directly to the column values
+    if callable( mapping ):
+        return mapping( values )
+    if isinstance( mapping, str ) or np.ndim( mapping ) == 0:
+        return mapping
+    mapping = np.asarray( mapping )
+    if mapping.dtype.kind in 'US':
+        # Colour names: convert once per bin, then index per point
+        mapping = to_rgba_array( mapping )
+    return mapping[idx]
+
 
+
+@timed( 'plot' )
+def plot_binned( df, col, bins, sizes=36, colors='b', x='ra', y='dec', alpha=0.5, cmap=None ):
+    # Plot all objects from 'df' in a single scatter call, with size and colour
+    #   set by which bin of column 'col' each object falls in
+    #   bins: bin edges; objects outside [bins[0], bins[-1]] are not plotted
+    #   sizes/colors: see per_point() (one value, one per bin, or a function)
+    #   cmap: colormap, if colors maps to numbers rather than colours
+    # Bins are assigned once with np.digitize, rather than masking the whole
+    #   data frame again for every bin
+    values = np.asarray( df[col] )
+    idx  = np.digitize( values, bins ) - 1
+    idx  = np.where( values == bins[-1], len(bins)-2, idx )
+    keep = (idx >= 0) & (idx < len(bins)-1)
+    idx, values = idx[keep], values[keep]
+
+    s = per_point( sizes,  values, idx )
+    c = per_point( colors, values, idx )
+    collection = plt.scatter( np.asarray( df[x] )[keep], np.asarray( df[y] )[keep],
+                              s=s, c=c, alpha=alpha, cmap=cmap )
+    format_sky_axes()
+    return collection
+
+
+
+def format_sky_axes():
     # Format scatter plot
     plt.gca().invert_xaxis()
     plt.gca().set_aspect('equal')
@@ -46,16 +98,17 @@ def plot_within_bounds( df, col, lower_bound=-np.inf, upper_bound=np.inf, size=3
     # This is just to ensure format of major ticks is normal person numbers
     plt.gca().xaxis.set_major_formatter(tk.StrMethodFormatter('{x:.2f}'))
     plt.gca().yaxis.set_major_formatter(tk.StrMethodFormatter('{x:.2f}'))
-    
     return
 
 
 
 if __name__ == '__main__':
     # Assuming we've already done the appropriate SQL query (see header above),
-    #   read results of SQL search, put into Pandas data frame
+    #   read results of SQL search (parsed once, then memory-mapped from the
+    #   columnar cache 'sql_results.csv.cols' on later runs)
     fname = 'sql_results.csv'
-    df = pd.read_csv( fname )
+    query = 'SELECT p.ra, p.dec, p.g FROM photoObj p, dbo.fGetNearbyObjEq(300,-1,2) n WHERE p.objID = n.objID'
+    df = cached_csv( fname, query=query )
  
     # Plot ALL objects using constant size
     plot_within_bounds( df, 'g', size=9 )
@@ -69,9 +122,9 @@ if __name__ == '__main__':
     min_size = 2
     range_s = (max_size - min_size)
 
-    for i in range( min_g, max_g ):
-        # Set size decreasing quadratically from max_size to min_size
-        size = max_size - np.sqrt( ( (i-min_g) / (range_g-1) ) ) * range_s
-        # Plot objects within 1-magnitude bins, using decreasing size
-        plot_within_bounds( df, 'g', lower_bound=i, upper_bound=i+1, size=size )
+    # 1-magnitude bins, with size decreasing quadratically from max_size to min_size
+    bins  = np.arange( min_g, max_g+1 )
+    sizes = max_size - np.sqrt( ( (bins[:-1]-min_g) / max(range_g-1, 1) ) ) * range_s
+    # Plot objects within all bins at once, using decreasing size
+    plot_binned( df, 'g', bins, sizes=sizes )
     plt.show()
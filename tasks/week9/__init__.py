@@ -0,0 +1,3 @@
+# Submodules are imported on first access, e.g. import week9; week9.classification (see utils/lazy.py)
+from utils.lazy import lazy_submodules
+__getattr__, __dir__ = lazy_submodules( __name__, ['classification', 'color_cuts', 'compact_catalog', 'incremental_match', 'magnitude_systems', 'photometric_transforms', 'spatial_index', 'sweep_store', 'target_pipeline'] )
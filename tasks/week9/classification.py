@@ -3,13 +3,22 @@
 
 #import astropy
 import os
-from astropy.table import Table, vstack
 import glob
-from astropy import units
-from astropy.coordinates import SkyCoord, search_around_sky
-import matplotlib.pyplot as plt
 import numpy as np
+from week9.sweep_store import open_store, query_cone
+from week9.color_cuts import fluxes_to_mags, make_cut, score_cut, optimize_all_pairs
+from week9.compact_catalog import CompactCatalog
+from utils import instrument
+from utils.instrument import timer, timed
+from utils.prefetch import prefetch_map
 import warnings
+from utils.lazy import lazy_import
+Table  = lazy_import( 'astropy.table', 'Table' )
+vstack = lazy_import( 'astropy.table', 'vstack' )
+units = lazy_import( 'astropy.units' )
+SkyCoord = lazy_import( 'astropy.coordinates', 'SkyCoord' )
+search_around_sky = lazy_import( 'astropy.coordinates', 'search_around_sky' )
+plt = lazy_import( 'matplotlib.pyplot' )
 warnings.filterwarnings("ignore")
 
 '''
@@ -21,6 +30,7 @@ ASTRO5160 Week 9 Class 18: Classification
 -Plot on color-color diagrams
 -Determine if we can distinguish between objects using a color cut
 -Saves plots with color cut to png files
+-Searches every color-color plane for the best cut (see color_cuts.py)
 -----------------
 *Note: must have access to /d/scratch to download object data and sweep files
 '''
@@ -80,9 +90,11 @@ def is_in_box(objs, radecbox):
     return ii
 
 
-def plot_color_color( x1, x2, y1, y2, m, b ):
-    # Plot color (x1-x2) vs (y1-y2) for the given data and bands,
-    # along with a linear function given by y=mx+b
+@timed( 'plot' )
+def plot_color_color( mags_stars, mags_qsos, x1, x2, y1, y2, m, b, outdir='.' ):
+    # Plot color (x1-x2) vs (y1-y2) for the given star and qso magnitudes
+    # (dicts/tables of magnitudes by band), along with a linear function given
+    # by y=mx+b and its completeness/contamination for selecting qsos
     plt.figure()
     # Plot color-color for stars
     x_ax1 = mags_stars[x1]-mags_stars[x2]
@@ -97,13 +109,24 @@ def plot_color_color( x1, x2, y1, y2, m, b ):
                  marker='o', color='g', s=1, alpha=.5  )  
 
     # Add the linear function for the color cut
-    plt.plot( x_ax1, m*x_ax1 + b, '-', color='r', linewidth=0.5, \
-              label='{:4.2f}*x +{:4.2f}'.format(m, b) )
+    cut = make_cut( (x1, x2), (y1, y2), [(m, b)] )
+    (comp, cont) = score_cut( mags_qsos, mags_stars, cut )
+    xs = np.array( [ np.nanmin( x_ax1 ), np.nanmax( x_ax1 ) ] )
+    plt.plot( xs, m*xs + b, '-', color='r', linewidth=0.5, \
+              label='{:4.2f}*x +{:4.2f} ({:.0%} complete, {:.0%} contaminated)'.format(m, b, comp, cont) )
     plt.xlabel( x1 +' - ' +x2 )
     plt.ylabel( y1 +' - ' +y2 )
     plt.legend()
-    plt.savefig( os.path.join( cwd, x1 +'_minus_' +x2 +'-vs-'\
-                                   +y1 +'_minus_' +y2 +'.png' ) )
+    plt.savefig( os.path.join( outdir, x1 +'_minus_' +x2 +'-vs-'\
+                                      +y1 +'_minus_' +y2 +'.png' ) )
+    return comp, cont
+
+
+def unique_matches( idx1, idx2 ):
+    # Keep only objects with exactly one match: returns (object rows, sweep rows)
+    counts = np.bincount( idx1 )
+    keep = counts[idx1] == 1
+    return idx1[keep], idx2[keep]
 
 
 
@@ -117,123 +140,78 @@ if __name__ == '__main__':
     path = '/d/scratch/ASTR5160/week10/'    
     stars_file = os.path.join( path, 'stars-ra180-dec30-rad3.fits' )
     qsos_file  = os.path.join( path,  'qsos-ra180-dec30-rad3.fits' )
-    stars_data = Table.read( stars_file )
-    qsos_data  = Table.read( qsos_file )
-
-
-    # Find appropriate sweep files for above two files
-    sweeps_path = '/d/scratch/ASTR5160/data/legacysurvey/dr9/south/sweep/9.0/*.fits'
-    sweep_files = glob.glob( sweeps_path )
-    files_needed = []
+    with timer( 'read_fits' ):
+        stars_data = Table.read( stars_file )
+        qsos_data  = Table.read( qsos_file )
+
+
+    # If the sweeps have been converted into a HEALPix-partitioned store (see
+    #   sweep_store.py), read only the partitions overlapping the 3-degree
+    #   fields around (180, 30), instead of four whole sweep files
+    store_dir = '/d/scratch/ASTR5160/data/legacysurvey/dr9/south/sweep_store'
+    if os.path.exists( store_dir ):
+        sweep_data = Table( query_cone( open_store( store_dir ), 180., 30., 3.01 ) )
+    else:
+        # Find appropriate sweep files for above two files
+        sweeps_path = '/d/scratch/ASTR5160/data/legacysurvey/dr9/south/sweep/9.0/*.fits'
+        sweep_files = glob.glob( sweeps_path )
+        files_needed = []
     
-    # Cycle through each sweep file, determine if needed
-    for f in sweep_files:
-        # Return the ra_min/max and dec_min/max bounds for given sweep file
-        radecbox = decode_sweep_name(f)
-        # Return True/False list for FIRST sources which fall inside this RA/Dec box
-        match_list1 = is_in_box( stars_data, radecbox )
-        match_list2 = is_in_box( qsos_data,  radecbox )
-        # Append the filename if any sources fall within this RA/Dec box
-        if True in match_list1 or True in match_list2: 
-            files_needed.append( f )    
-    #print( files_needed )  # Confirmed that it finds four files
-
-    # Combine the needed sweep file tables into one large (!) table
-    sweep_data = []
-    for f in files_needed:
-        data = Table.read( f )
-        if len( sweep_data ) == 0:
-            sweep_data = data
-        else:
-            sweep_data = vstack( [sweep_data, data] )            
+        # Cycle through each sweep file, determine if needed
+        for f in sweep_files:
+            # Return the ra_min/max and dec_min/max bounds for given sweep file
+            radecbox = decode_sweep_name(f)
+            # Return True/False list for FIRST sources which fall inside this RA/Dec box
+            match_list1 = is_in_box( stars_data, radecbox )
+            match_list2 = is_in_box( qsos_data,  radecbox )
+            # Append the filename if any sources fall within this RA/Dec box
+            if True in match_list1 or True in match_list2: 
+                files_needed.append( f )    
+        #print( files_needed )  # Confirmed that it finds four files
+
+        # Combine the needed sweep file tables into one large (!) table; files
+        #   are read two at a time on background threads, and stacked once
+        def read_sweep( f ):
+            with timer( 'read_sweep' ):
+                return Table.read( f )
+        tables = list( prefetch_map( read_sweep, files_needed, depth=2, nthreads=2 ) )
+        sweep_data = vstack( tables ) if len(tables) > 1 else tables[0]
 
 
     # Create SkyCoord arrays for RA/Dec pairs for each file
     # (needed for search_around_sky)
-    stars_ras  = stars_data['RA']
-    stars_decs = stars_data['DEC']
-    stars_locs = SkyCoord( ra=stars_ras *units.degree, 
-                          dec=stars_decs*units.degree, frame='icrs' )
-    qsos_ras   = qsos_data['RA']
-    qsos_decs  = qsos_data['DEC']
-    qsos_locs  = SkyCoord( ra=qsos_ras *units.degree, 
-                          dec=qsos_decs*units.degree, frame='icrs' )
-    sweep_ras  = sweep_data['RA']
-    sweep_decs = sweep_data['DEC']
-    sweep_locs = SkyCoord( ra=sweep_ras, dec=sweep_decs, frame='icrs' )
+    with timer( 'skycoord' ):
+        stars_ras  = stars_data['RA']
+        stars_decs = stars_data['DEC']
+        stars_locs = SkyCoord( ra=stars_ras *units.degree, 
+                              dec=stars_decs*units.degree, frame='icrs' )
+        qsos_ras   = qsos_data['RA']
+        qsos_decs  = qsos_data['DEC']
+        qsos_locs  = SkyCoord( ra=qsos_ras *units.degree, 
+                              dec=qsos_decs*units.degree, frame='icrs' )
+        sweep_ras  = sweep_data['RA']
+        sweep_decs = sweep_data['DEC']
+        sweep_locs = SkyCoord( ra=np.asarray( sweep_ras ) *units.degree,
+                              dec=np.asarray( sweep_decs )*units.degree, frame='icrs' )
 
 
     # Find matches for stars within sweep files
-    (idx1_stars, idx2_stars, sep2d_stars, _) = search_around_sky( \
-                    stars_locs, sweep_locs, seplimit=0.5*units.arcsec )
-    # Same for qso's
-    (idx1_qsos, idx2_qsos, sep2d_qsos, _) = search_around_sky( \
-                    qsos_locs,  sweep_locs, seplimit=0.5*units.arcsec )
+    with timer( 'search_around_sky' ):
+        (idx1_stars, idx2_stars, sep2d_stars, _) = search_around_sky( \
+                        stars_locs, sweep_locs, seplimit=0.5*units.arcsec )
+        # Same for qso's
+        (idx1_qsos, idx2_qsos, sep2d_qsos, _) = search_around_sky( \
+                        qsos_locs,  sweep_locs, seplimit=0.5*units.arcsec )
 
 
 
     # Q2: For each unique match, convert the flux into a dust-corrected magnitude
-
-    # Check for duplicate matches
-    values = []
-    duplicates_stars = []
-    for i in idx1_stars:
-        if i not in values:
-            values.append(i)
-        else:
-            duplicates_stars.append(i)
-    # Same for qso's
-    values = []
-    duplicates_qsos = []
-    for i in idx1_qsos:
-        if i not in values:
-            values.append(i)
-        else:
-            duplicates_qsos.append(i)
-
-
-    # Make new tables and populate with converted stellar magnitudes 
-    headers = ['RA','Dec','g','r','z','w1','w2']
-    mags_stars = Table( names=headers )
-    for i in idx1_stars:
-        if i not in duplicates_stars:
-            ra  = stars_data[i]['RA']
-            dec = stars_data[i]['DEC']
-
-            idx1 = list(idx1_stars).index(i)
-            idx2 = idx2_stars[idx1]
-            G  = sweep_data[idx2]['FLUX_G']  / sweep_data[idx2]['MW_TRANSMISSION_G'] 
-            R  = sweep_data[idx2]['FLUX_R']  / sweep_data[idx2]['MW_TRANSMISSION_R']
-            Z  = sweep_data[idx2]['FLUX_Z']  / sweep_data[idx2]['MW_TRANSMISSION_Z']
-            W1 = sweep_data[idx2]['FLUX_W1'] / sweep_data[idx2]['MW_TRANSMISSION_W1']
-            W2 = sweep_data[idx2]['FLUX_W2'] / sweep_data[idx2]['MW_TRANSMISSION_W2']
-            g  = 22.5 - 2.5 * np.log10(G) 
-            r  = 22.5 - 2.5 * np.log10(R) 
-            z  = 22.5 - 2.5 * np.log10(Z) 
-            w1 = 22.5 - 2.5 * np.log10(W1)
-            w2 = 22.5 - 2.5 * np.log10(W2)
-            mags_stars.add_row( [ra, dec, g, r, z, w1, w2] )
-
-    # Same for qso's
-    mags_qsos = Table( names=headers )
-    for i in idx1_qsos:
-        if i not in duplicates_qsos:
-            ra  = qsos_data[i]['RA']
-            dec = qsos_data[i]['DEC']
-
-            idx1 = list(idx1_qsos).index(i)
-            idx2 = idx2_qsos[idx1]
-            G  = sweep_data[idx2]['FLUX_G']  / sweep_data[idx2]['MW_TRANSMISSION_G'] 
-            R  = sweep_data[idx2]['FLUX_R']  / sweep_data[idx2]['MW_TRANSMISSION_R']
-            Z  = sweep_data[idx2]['FLUX_Z']  / sweep_data[idx2]['MW_TRANSMISSION_Z']
-            W1 = sweep_data[idx2]['FLUX_W1'] / sweep_data[idx2]['MW_TRANSMISSION_W1']
-            W2 = sweep_data[idx2]['FLUX_W2'] / sweep_data[idx2]['MW_TRANSMISSION_W2']
-            g  = 22.5 - 2.5 * np.log10(G) 
-            r  = 22.5 - 2.5 * np.log10(R) 
-            z  = 22.5 - 2.5 * np.log10(Z) 
-            w1 = 22.5 - 2.5 * np.log10(W1)
-            w2 = 22.5 - 2.5 * np.log10(W2)
-            mags_qsos.add_row( [ra, dec, g, r, z, w1, w2] )
+    #     (objects with more than one match are dropped), kept as float32
+    #     (see compact_catalog.py for the precision)
+    (rows_stars, sweep_rows_stars) = unique_matches( idx1_stars, idx2_stars )
+    (rows_qsos,  sweep_rows_qsos)  = unique_matches( idx1_qsos,  idx2_qsos )
+    mags_stars = CompactCatalog.from_table( fluxes_to_mags( sweep_data, rows=sweep_rows_stars ) )
+    mags_qsos  = CompactCatalog.from_table( fluxes_to_mags( sweep_data, rows=sweep_rows_qsos ) )
 
 
     # Q3: Plot various colors vs each other to determine if we can visually
@@ -244,18 +222,36 @@ if __name__ == '__main__':
     x2 = 'z'
     y1 = 'r'
     y2 = 'w1'
-    plot_color_color( x1, x2, y1, y2, 1, -1 )
+    plot_color_color( mags_stars, mags_qsos, x1, x2, y1, y2, 1, -1, outdir=cwd )
 
     # Plot (g-r) vs (z-w2)
     x1 = 'g'
     x2 = 'r'
     y1 = 'z'
     y2 = 'w2'
-    plot_color_color( x1, x2, y1, y2, .5, -.75 )
+    plot_color_color( mags_stars, mags_qsos, x1, x2, y1, y2, .5, -.75, outdir=cwd )
 
     # Plot (g-r) vs (z-w1)
     x1 = 'g'
     x2 = 'r'
     y1 = 'z'
     y2 = 'w1'
-    plot_color_color( x1, x2, y1, y2, .75, -.75 )
\ No newline at end of file
+    plot_color_color( mags_stars, mags_qsos, x1, x2, y1, y2, .75, -.75, outdir=cwd )
+
+
+    # Q4: Rather than picking lines by eye, search a grid of slopes and
+    #     intercepts in every color-color plane for the cut which best
+    #     separates qsos from stars
+    slopes     = np.linspace( -3, 3, 121 )
+    intercepts = np.linspace( -4, 4, 161 )
+    cuts = optimize_all_pairs( mags_qsos, mags_stars, slopes, intercepts, nproc=4 )
+    print( '\nBest color cuts for selecting qsos:' )
+    for cut in cuts[:5]:
+        (m, b) = cut['lines'][0]
+        print( '  ({}-{}) > {:5.2f}*({}-{}) {:+5.2f}:  completeness {:5.1%}, contamination {:5.1%}'.format(
+               cut['y'][0], cut['y'][1], m, cut['x'][0], cut['x'][1], b,
+               cut['completeness'], cut['contamination'] ) )
+
+    # Per-stage timings, if run with ASTRO5160_INSTRUMENT=1
+    if instrument.enabled():
+        instrument.report()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import numpy as np
+from utils.shared_catalog import shared, attach
+from utils.lazy import lazy_import
+ProcessPoolExecutor = lazy_import( 'concurrent.futures', 'ProcessPoolExecutor' )
+fits = lazy_import( 'astropy.io.fits' )
+
+'''
+ASTRO5160 Week 9: Colour-cut classification
+-----------------
+-A cut selects objects above (or below) one or more lines in a colour-colour
+   plane: (y1-y2) > m*(x1-x2) + b, for every (m, b) given
+-Scores cuts by completeness (fraction of targets selected) and
+   contamination (fraction of the selection which isn't a target)
+-Grid search over slopes and intercepts in one broadcast pass, for one pair
+   of colours or every pair of colours (optionally on a process pool)
+-Applies a cut to a sweep file in chunks of rows, so the whole file is
+   never read at once
+-----------------
+'''
+
+# Legacy Survey bands, and the suffixes of their FLUX_/MW_TRANSMISSION_ columns
+BANDS = ['g', 'r', 'z', 'w1', 'w2']
+
+# Rows per chunk when scoring a grid or reading a sweep file
+CHUNK_ROWS = 2**16
+
+
+
+def fluxes_to_mags( data, bands=BANDS, rows=None ):
+    # Dust-corrected magnitudes from a table/dict of sweep columns:
+    #   m = 22.5 - 2.5 log10( FLUX / MW_TRANSMISSION ) for each band
+    # Non-positive fluxes give NaN; rows optionally selects rows first
+    mags = {}
+    for band in bands:
+        flux  = np.asarray( data['FLUX_' +band.upper()] )
+        trans = np.asarray( data['MW_TRANSMISSION_' +band.upper()] )
+        if rows is not None:
+            flux, trans = flux[rows], trans[rows]
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            mags[band] = 22.5 - 2.5*np.log10( np.where( flux > 0, flux / trans, np.nan ) )
+    return mags
+
+
+
+def color( mags, pair ):
+    # Colour (band1 - band2) from a dict of magnitudes, for pair = (band1, band2)
+    return np.asarray( mags[pair[0]] ) - np.asarray( mags[pair[1]] )
+
+
+
+def make_cut( xpair, ypair, lines, above=True ):
+    # A cut in the (x1-x2, y1-y2) plane: selects objects above (or below)
+    #   every line (m, b) in lines; one line is a simple linear cut, several
+    #   make a piecewise (convex) boundary
+    return { 'x': tuple( xpair ), 'y': tuple( ypair ),
+             'lines': [ ( float( m ), float( b ) ) for m, b in np.atleast_2d( lines ) ], 'above': above }
+
+
+
+def apply_cut( mags, cut ):
+    # True for each object (row of the dict of magnitudes) passing the cut;
+    #   objects with any NaN colour fail
+    x = color( mags, cut['x'] )
+    y = color( mags, cut['y'] )
+    passed = np.isfinite( x ) & np.isfinite( y )
+    for m, b in cut['lines']:
+        passed &= ( y > m*x + b ) if cut['above'] else ( y < m*x + b )
+    return passed
+
+
+
+def score( selected_targets, n_targets, selected_others ):
+    # Completeness and contamination from counts of selected objects
+    #   (works on arrays of counts, for whole grids at once)
+    selected = selected_targets + selected_others
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        completeness  = selected_targets / n_targets
+        contamination = np.where( selected > 0, selected_others / selected, 0. )
+    return completeness, contamination
+
+
+
+def score_cut( targets, others, cut ):
+    # Completeness and contamination of one cut
+    t = apply_cut( targets, cut )
+    o = apply_cut( others, cut )
+    completeness, contamination = score( t.sum(), len(t), o.sum() )
+    return float( completeness ), float( contamination )
+
+
+
+def count_above( x, y, slopes, intercepts ):
+    # Number of points above each line y = m*x + b of a (slopes x intercepts)
+    #   grid, by broadcasting in chunks of points
+    #   ( y > m*x + b  <=>  y - m*x > b, so only a sort is needed per slope )
+    ok = np.isfinite( x ) & np.isfinite( y )
+    x, y = x[ok], y[ok]
+    counts = np.zeros( ( len(slopes), len(intercepts) ), dtype=np.int64 )
+    for lo in range( 0, len(x), CHUNK_ROWS ):
+        # (nslope, nchunk) sorted values of y - m*x
+        d = np.sort( y[lo:lo+CHUNK_ROWS][None,:] - slopes[:,None]*x[lo:lo+CHUNK_ROWS][None,:], axis=1 )
+        for k in range( len(slopes) ):
+            counts[k] += d.shape[1] - np.searchsorted( d[k], intercepts, side='right' )
+    return counts
+
+
+
+def grid_scores( targets, others, xpair, ypair, slopes, intercepts, above=True ):
+    # Completeness and contamination of every single-line cut on a grid of
+    #   slopes and intercepts; both (nslopes, nintercepts) arrays
+    slopes     = np.asarray( slopes, dtype=float )
+    intercepts = np.asarray( intercepts, dtype=float )
+    finite = lambda mags: np.sum( np.isfinite( color( mags, xpair ) ) & np.isfinite( color( mags, ypair ) ) )
+    t = count_above( color( targets, xpair ), color( targets, ypair ), slopes, intercepts )
+    o = count_above( color( others,  xpair ), color( others,  ypair ), slopes, intercepts )
+    if not above:
+        # Below the line: every object with finite colours not above it
+        #   (ties have zero measure)
+        t, o = finite( targets ) - t, finite( others ) - o
+    # Completeness is out of all targets, including any with NaN colours
+    return score( t, len( color( targets, xpair ) ), o )
+
+
+
+def objective( completeness, contamination, max_contamination=None ):
+    # Figure of merit for choosing a cut: completeness x purity, or, given a
+    #   contamination limit, the completeness of cuts within that limit
+    if max_contamination is None:
+        return completeness * ( 1. - contamination )
+    return np.where( contamination <= max_contamination, completeness, -1. )
+
+
+
+def optimize_cut( targets, others, xpair, ypair, slopes, intercepts, above=True, max_contamination=None ):
+    # Best single-line cut in one colour-colour plane over a grid of slopes
+    #   and intercepts; returns the cut, with its completeness, contamination
+    #   and figure of merit
+    comp, cont = grid_scores( targets, others, xpair, ypair, slopes, intercepts, above )
+    merit = objective( comp, cont, max_contamination )
+    k, j = np.unravel_index( np.nanargmax( merit ), merit.shape )
+    cut = make_cut( xpair, ypair, [( slopes[k], intercepts[j] )], above )
+    cut.update( { 'completeness': float( comp[k,j] ), 'contamination': float( cont[k,j] ),
+                  'merit': float( merit[k,j] ) } )
+    return cut
+
+
+
+def color_pairs( bands=BANDS ):
+    # All (x colour, y colour) planes from a list of bands, each colour being
+    #   (bluer band, redder band) and x != y
+    colors = list( itertools.combinations( bands, 2 ) )
+    return [ (x, y) for x, y in itertools.permutations( colors, 2 ) ]
+
+
+
+def _optimize_plane( args ):
+    # Worker for optimize_all_pairs (must be at module level to be pickled)
+    #   targets/others come as shared-memory descriptors (utils/shared_catalog.py)
+    return optimize_cut( attach( args[0] ), attach( args[1] ), *args[2:] )
+
+
+
+def optimize_all_pairs( targets, others, slopes, intercepts, bands=BANDS, above=True,
+                        max_contamination=None, nproc=None ):
+    # Best single-line cut in every colour-colour plane, best first
+    #   nproc: number of worker processes (None to run in this process)
+    # targets/others only need the magnitudes in 'bands', as dicts of arrays
+    targets = { b: np.asarray( targets[b] ) for b in bands }
+    others  = { b: np.asarray( others[b] )  for b in bands }
+    pairs = color_pairs( bands )
+    slopes, intercepts = np.asarray( slopes ), np.asarray( intercepts )
+    if nproc is None:
+        cuts = [ optimize_cut( targets, others, x, y, slopes, intercepts, above, max_contamination )
+                 for x, y in pairs ]
+    else:
+        # Every worker reads the magnitudes from one shared copy, rather than
+        #   having them pickled into each of the jobs
+        with shared( targets ) as tdesc, shared( others ) as odesc, \
+             ProcessPoolExecutor( max_workers=nproc ) as pool:
+            jobs = [ (tdesc, odesc, x, y, slopes, intercepts, above, max_contamination) for x, y in pairs ]
+            cuts = list( pool.map( _optimize_plane, jobs ) )
+    return sorted( cuts, key=lambda c: -c['merit'] )
+
+
+
+def select_chunks( sweep_file, cut, columns=None, chunk_rows=CHUNK_ROWS ):
+    # Generator over a sweep file in chunks of rows, yielding (start row,
+    #   boolean mask of rows passing the cut, dict of the requested columns
+    #   for those rows)
+    # The file is memory-mapped, so only chunk_rows rows are in memory at once
+    bands = sorted( set( cut['x'] ) | set( cut['y'] ), key=BANDS.index )
+    with fits.open( sweep_file, memmap=True ) as hdul:
+        data = hdul[1].data
+        for lo in range( 0, len(data), chunk_rows ):
+            chunk = data[lo:lo+chunk_rows]
+            passed = apply_cut( fluxes_to_mags( chunk, bands ), cut )
+            rows = np.flatnonzero( passed )
+            yield lo, passed, { col: np.array( chunk[col][rows] ) for col in ( columns or [] ) }
+
+
+
+def count_selected( sweep_files, cut, chunk_rows=CHUNK_ROWS ):
+    # Number of objects passing a cut in each of a list of sweep files
+    return [ sum( int( passed.sum() ) for _, passed, _ in select_chunks( f, cut, chunk_rows=chunk_rows ) )
+             for f in sweep_files ]
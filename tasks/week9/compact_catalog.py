@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from utils.lazy import lazy_import
+Table = lazy_import( 'astropy.table', 'Table' )
+
+'''
+ASTRO5160 Week 9: Compact in-memory catalogs
+-----------------
+-A CompactCatalog has a fixed schema of columns, each preallocated (and
+   grown by doubling when rows are appended in chunks), stored as:
+   -RA, DEC: float64
+   -magnitudes, fluxes and any other floating-point column: float32
+   -booleans (matched, unique match, passes a color cut, ...): one bit
+     each, packed together into a single FLAGS integer column
+   -integer and string columns: their own dtype (IDs are never rounded)
+-Floating-point columns take half the memory (and bandwidth) of float64,
+   and flags an eighth of numpy bools: a row of positions, 5 magnitudes and
+   4 flags takes 37 bytes instead of 60, and the magnitude tables of
+   classification.py (no positions) 20 instead of 40
+-cat['g'] is a column (view), cat['MATCHED'] a flag unpacked to booleans,
+   so a catalog works wherever a dict of magnitudes is expected (color cuts,
+   plots); from_table()/to_table() convert from and to astropy Tables
+-----------------
+*Precision: float32 keeps 24 bits of mantissa, so each stored value is the
+   original rounded to within a relative 2^-24 (6e-8): under 2e-6 mag for
+   magnitudes up to 30, and under 4e-6 mag for a color, far below any
+   photometric error; fluxes keep 7 significant figures. NaN and inf are
+   kept; finite values beyond 3.4e38 become inf. RA and DEC stay float64
+   (float32 would round positions by up to 0.03"), and flags, integers and
+   strings are exact
+'''
+
+# Columns always kept as float64
+POSITION_COLUMNS = ['RA', 'DEC']
+
+# Schema entry for a boolean stored as one bit of FLAGS
+FLAG = 'flag'
+
+# Name of the packed flags column in tables and in cat.columns
+FLAGS_COLUMN = 'FLAGS'
+
+# Schema for week 9 selections: positions, magnitudes and match/cut flags
+TARGET_SCHEMA = { 'RA': 'f8', 'DEC': 'f8', 'g': 'f4', 'r': 'f4', 'z': 'f4', 'w1': 'f4', 'w2': 'f4',
+                  'MATCHED': FLAG, 'UNIQUE_MATCH': FLAG, 'PASSES_CUT': FLAG, 'IS_QSO': FLAG }
+
+
+
+def infer_schema( data ):
+    # Compact schema for the columns of a table/dict of arrays: RA/DEC as
+    #   float64, other floats as float32, booleans as flags, anything else
+    #   in its own dtype
+    names = data.colnames if hasattr( data, 'colnames' ) else list( data )
+    schema = {}
+    for name in names:
+        values = np.asarray( data[name] )
+        if values.dtype.kind == 'b':
+            schema[name] = FLAG
+        elif values.dtype.kind in 'fc' and name.upper() not in POSITION_COLUMNS:
+            schema[name] = 'f4' if values.dtype.kind == 'f' else 'c8'
+        elif values.dtype.kind == 'f':
+            schema[name] = 'f8'
+        else:
+            schema[name] = values.dtype.str
+    return schema
+
+
+
+def flag_dtype( nflags ):
+    # Smallest unsigned integer type holding nflags bits
+    for dtype in ( np.uint8, np.uint16, np.uint32, np.uint64 ):
+        if nflags <= 8*np.dtype( dtype ).itemsize:
+            return np.dtype( dtype )
+    raise ValueError( "At most 64 flags can be packed, not {:d}".format( nflags ) )
+
+
+
+class CompactCatalog:
+    # Fixed-schema catalog with preallocated, compact columns (see header)
+    #   schema: {name: dtype or FLAG}, in column order
+
+    def __init__( self, schema, capacity=0 ):
+        self.schema = dict( schema )
+        self.flags  = [ name for name, kind in self.schema.items() if kind == FLAG ]
+        if FLAGS_COLUMN in self.schema:
+            raise ValueError( "'{}' is the packed flags column, not a column name".format( FLAGS_COLUMN ) )
+        self.nrows  = 0
+        self.columns = { name: np.empty( capacity, dtype=kind ) for name, kind in self.schema.items()
+                         if kind != FLAG }
+        if len( self.flags ) > 0:
+            self.columns[FLAGS_COLUMN] = np.zeros( capacity, dtype=flag_dtype( len( self.flags ) ) )
+
+    def __len__( self ):
+        return self.nrows
+
+    def __contains__( self, name ):
+        return name in self.schema
+
+    def keys( self ):
+        return list( self.schema )
+
+    @property
+    def colnames( self ):
+        return list( self.schema )
+
+    @property
+    def capacity( self ):
+        return len( next( iter( self.columns.values() ) ) ) if len( self.columns ) > 0 else 0
+
+    @property
+    def nbytes( self ):
+        # Memory used by the rows so far (the preallocated capacity is more)
+        return sum( values[:self.nrows].nbytes for values in self.columns.values() )
+
+    def __getitem__( self, name ):
+        # A column (a view of the rows so far), or a flag as booleans
+        if name in self.flags:
+            bit = self.flags.index( name )
+            return ( self.columns[FLAGS_COLUMN][:self.nrows] >> bit ) & 1 == 1
+        if name not in self.columns:
+            raise KeyError( name )
+        return self.columns[name][:self.nrows]
+
+    def reserve( self, nrows ):
+        # Make room for at least nrows rows, doubling the capacity as needed
+        if nrows <= self.capacity:
+            return
+        capacity = max( nrows, 2*self.capacity, 1024 )
+        for name, values in self.columns.items():
+            grown = np.zeros( capacity, dtype=values.dtype )
+            grown[:self.nrows] = values[:self.nrows]
+            self.columns[name] = grown
+
+    def append( self, data ):
+        # Add rows from a table/dict of arrays with every (non-flag) column
+        #   of the schema; flags not given are False, FLAGS is taken as packed
+        names = set( data.colnames if hasattr( data, 'colnames' ) else data )
+        missing = [ name for name, kind in self.schema.items() if kind != FLAG and name not in names ]
+        if len(missing) > 0:
+            raise ValueError( "Columns missing from appended rows: {}".format( missing ) )
+        first = next( name for name in self.schema if name in names )
+        n = len( data[first] )
+        lo, hi = self.nrows, self.nrows + n
+        self.reserve( hi )
+        for name, values in self.columns.items():
+            if name == FLAGS_COLUMN:
+                if FLAGS_COLUMN in names:
+                    values[lo:hi] = np.asarray( data[FLAGS_COLUMN] )
+                    continue
+                values[lo:hi] = 0
+                for bit, flag in enumerate( self.flags ):
+                    if flag in names:
+                        values[lo:hi] |= np.asarray( data[flag], dtype=bool ).astype( values.dtype ) << bit
+            else:
+                values[lo:hi] = np.asarray( data[name] )
+        self.nrows = hi
+        return self
+
+    def set_flag( self, name, values, rows=None ):
+        # Set a flag for all rows (values: booleans, one per row) or for the
+        #   selected rows only (rows: indices or a boolean mask)
+        bit = self.flags.index( name )
+        flags = self.columns[FLAGS_COLUMN][:self.nrows]
+        mask = flags.dtype.type( 1 << bit )
+        target = flags if rows is None else flags[rows]
+        target = np.where( np.asarray( values, dtype=bool ), target | mask, target & ~mask )
+        if rows is None:
+            flags[:] = target
+        else:
+            flags[rows] = target
+
+    def select( self, rows ):
+        # New catalog of the selected rows (indices or a boolean mask)
+        out = CompactCatalog( self.schema )
+        out.columns = { name: values[:self.nrows][rows] for name, values in self.columns.items() }
+        out.nrows = out.capacity
+        return out
+
+    def to_table( self, packed=False ):
+        # astropy Table of the rows so far; flags as boolean columns, or as the
+        #   single packed FLAGS column with packed=True (bit k is the k-th flag)
+        names = [ name for name in self.schema if not ( packed and name in self.flags ) ]
+        columns = { name: np.array( self[name] ) for name in names }
+        if packed and len( self.flags ) > 0:
+            columns[FLAGS_COLUMN] = np.array( self[FLAGS_COLUMN] )
+        table = Table( columns )
+        if packed and len( self.flags ) > 0:
+            table.meta['FLAGBITS'] = ','.join( self.flags )
+        return table
+
+    @classmethod
+    def from_table( cls, data, schema=None ):
+        # Compact copy of a table/dict of arrays (schema from infer_schema by
+        #   default; a packed FLAGS column's names are read from the table's
+        #   FLAGBITS header, as written by to_table( packed=True ))
+        names = data.colnames if hasattr( data, 'colnames' ) else list( data )
+        if schema is None:
+            schema = infer_schema( { n: data[n] for n in names if n != FLAGS_COLUMN } )
+            meta = getattr( data, 'meta', {} )
+            if FLAGS_COLUMN in names and 'FLAGBITS' in meta:
+                schema.update( { flag: FLAG for flag in meta['FLAGBITS'].split( ',' ) } )
+        return cls( schema, capacity=len( data[names[0]] ) ).append( data )
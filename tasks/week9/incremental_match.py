@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import numpy as np
+from week9.spatial_index import index_for_catalog, query_cones
+from week9.sweep_store import read_fits_columns
+from utils.instrument import timer, count
+
+'''
+ASTRO5160 Week 9: Incremental cross-matching
+-----------------
+-A match store (a directory) keeps, for each input catalog matched so far,
+   the ID and a hash of each row, and the matches found for it (ID, reference
+   file, reference row, separation)
+-update() compares a new version of a catalog with the stored one by ID and
+   row hash: only added rows, and rows whose hashed columns (by default RA and
+   DEC) changed, are matched against the reference catalog's spatial index
+   (spatial_index.py); matches of removed or changed rows are dropped, and the
+   new ones merged in
+-The reference files' sizes/modification times and the match radius are
+   recorded too: if any of them change, every row is matched again
+-matches() gives the stored matches for the rows of the current catalog,
+   as (idx1, reference file, reference row, sep) in the style of
+   search_around_sky
+-----------------
+*Note: run 'python incremental_match.py STORE qsos.fits --reference "sweep-*.fits" --radius 0.5 --id-column OBJID'
+   again after each change to qsos.fits; without --id-column rows are identified by their position
+'''
+
+# Name of the state file in a match store
+STATE_FILE = 'state.json'
+
+# Columns hashed to detect changed rows by default
+HASH_COLUMNS = ['RA', 'DEC']
+
+# Arrays stored for each catalog: its rows ('rows_ID.npy', ...) and its
+#   matches ('matches_ID.npy', ...)
+ROW_ARRAYS   = ['ID', 'HASH']
+MATCH_ARRAYS = ['ID', 'REF_FILE', 'REF_ROW', 'SEP']
+DTYPES = { 'ID': np.int64, 'HASH': np.uint64, 'REF_FILE': np.int16, 'REF_ROW': np.int64, 'SEP': np.float64 }
+
+
+
+def _mix( h ):
+    # splitmix64 finalizer: scrambles the bits of uint64 hashes
+    h = h ^ ( h >> np.uint64( 30 ) )
+    h = h * np.uint64( 0xbf58476d1ce4e5b9 )
+    h = h ^ ( h >> np.uint64( 27 ) )
+    h = h * np.uint64( 0x94d049bb133111eb )
+    return h ^ ( h >> np.uint64( 31 ) )
+
+
+
+def row_hashes( data, columns ):
+    # 64-bit hash of each row's values in the given columns (vectorized:
+    #   each column's bytes are read as 64-bit words and mixed in turn)
+    nrows = len( data[columns[0]] )
+    h = np.full( nrows, 0x9e3779b97f4a7c15, dtype=np.uint64 )
+    for col in columns:
+        values = np.asarray( data[col] )
+        values = values.astype( values.dtype.newbyteorder( '<' ) ).reshape( nrows, -1 )
+        raw = np.ascontiguousarray( values ).view( np.uint8 ).reshape( nrows, -1 )
+        pad = -raw.shape[1] % 8
+        if pad > 0:
+            raw = np.hstack( [ raw, np.zeros( (nrows, pad), dtype=np.uint8 ) ] )
+        for word in np.ascontiguousarray( raw ).view( np.uint64 ).T:
+            h = _mix( h ^ word )
+    return h
+
+
+
+def _files( reference ):
+    # Reference catalog file names, as a list
+    return [reference] if isinstance( reference, str ) else list( reference )
+
+
+
+def reference_version( reference ):
+    # What identifies the version of the reference file(s): path, size and
+    #   modification time of each (as for the spatial index)
+    files = []
+    for f in _files( reference ):
+        stat = os.stat( f )
+        files.append( { 'path': os.path.abspath( f ), 'size': stat.st_size, 'mtime': stat.st_mtime } )
+    return files
+
+
+
+def load_state( store ):
+    # The state of a match store (an empty one if it doesn't exist yet)
+    try:
+        with open( os.path.join( store, STATE_FILE ) ) as f:
+            return json.load( f )
+    except OSError:
+        return { 'catalogs': {} }
+
+
+
+def _catalog_dir( store, name ):
+    return os.path.join( store, name )
+
+
+
+def load_arrays( store, name, kind ):
+    # Stored 'rows' or 'matches' arrays of one catalog, as a dict (empty
+    #   arrays if there are none yet)
+    arrays = ROW_ARRAYS if kind == 'rows' else MATCH_ARRAYS
+    if name not in load_state( store )['catalogs']:
+        return { a: np.zeros( 0, dtype=DTYPES[a] ) for a in arrays }
+    return { a: np.load( os.path.join( _catalog_dir( store, name ), kind +'_' +a +'.npy' ) ) for a in arrays }
+
+
+
+def _write_state( store, state ):
+    # Replace the state file in one step
+    with open( os.path.join( store, STATE_FILE +'.tmp' ), 'w' ) as f:
+        json.dump( state, f, indent=1 )
+    os.replace( os.path.join( store, STATE_FILE +'.tmp' ), os.path.join( store, STATE_FILE ) )
+
+
+
+def _save( store, name, rows, found, entry ):
+    # Write a catalog's arrays then the state; each file is written under a
+    #   temporary name and renamed. The catalog is first dropped from the
+    #   state on disk, so while its arrays are replaced nothing claims they
+    #   are valid, and an interrupted update is redone next time
+    cdir = _catalog_dir( store, name )
+    os.makedirs( cdir, exist_ok=True )
+    state = load_state( store )
+    if state['catalogs'].pop( name, None ) is not None:
+        _write_state( store, state )
+    for kind, arrays in ( ( 'rows', rows ), ( 'matches', found ) ):
+        for a, values in arrays.items():
+            path = os.path.join( cdir, kind +'_' +a +'.npy' )
+            with open( path +'.tmp', 'wb' ) as f:
+                np.save( f, values )
+            os.replace( path +'.tmp', path )
+    state['catalogs'][name] = entry
+    _write_state( store, state )
+
+
+
+def _ids( data, id_column ):
+    # Integer IDs of the rows (hashes of RA/DEC if there is no ID column)
+    if id_column is None:
+        return row_hashes( data, HASH_COLUMNS ).view( np.int64 )
+    ids = np.asarray( data[id_column] )
+    if ids.dtype.kind not in 'iu':
+        # e.g. string IDs
+        return row_hashes( data, [id_column] ).view( np.int64 )
+    return ids.astype( np.int64 )
+
+
+
+def match_rows( reference, ras, decs, radius ):
+    # Match positions to the reference file(s): (row in ras/decs, reference
+    #   file number, reference row, separation in degrees), sorted by row
+    pieces = []
+    for k, f in enumerate( _files( reference ) ):
+        idx1, idx2, sep = query_cones( index_for_catalog( f ), ras, decs, radius )
+        pieces.append( ( idx1, np.full( len(idx1), k, dtype=np.int16 ), idx2.astype( np.int64 ), sep ) )
+    idx1, files, rows, sep = [ np.concatenate( p ) for p in zip( *pieces ) ]
+    order = np.lexsort( ( sep, idx1 ) )
+    return idx1[order], files[order], rows[order], sep[order]
+
+
+
+def update( store, name, data, reference, radius, id_column=None, hash_columns=HASH_COLUMNS ):
+    # Bring the stored matches of catalog 'name' up to date with data (a
+    #   table/dict with RA, DEC and the ID and hash columns), matching only
+    #   new and changed rows within radius (degrees) of the reference file(s)
+    # Returns counts of the rows added, removed, changed, unchanged and
+    #   matched, and the number of matches now stored
+    ids = _ids( data, id_column )
+    if len( np.unique( ids ) ) != len(ids):
+        raise ValueError( "IDs in {} are not unique (give an ID column with --id-column)".format( name ) )
+    hashes = row_hashes( data, hash_columns )
+    order  = np.argsort( ids, kind='stable' )
+    ids, hashes = ids[order], hashes[order]
+
+    state = load_state( store )
+    version = { 'reference': reference_version( reference ), 'radius': radius,
+                'id_column': id_column, 'hash_columns': list( hash_columns ) }
+    old = state['catalogs'].get( name )
+    if old is not None and all( old[k] == v for k, v in version.items() ):
+        prev = load_arrays( store, name, 'rows' )
+        found = load_arrays( store, name, 'matches' )
+    else:
+        # New catalog, or the reference/settings changed: match everything
+        prev = { a: np.zeros( 0, dtype=DTYPES[a] ) for a in ROW_ARRAYS }
+        found = { a: np.zeros( 0, dtype=DTYPES[a] ) for a in MATCH_ARRAYS }
+
+    with timer( 'incremental_match' ):
+        # Look up each current ID in the stored (sorted) IDs
+        known = np.zeros( len(ids), dtype=bool )
+        changed = np.zeros( len(ids), dtype=bool )
+        if len( prev['ID'] ) > 0:
+            pos = np.minimum( np.searchsorted( prev['ID'], ids ), len( prev['ID'] )-1 )
+            known = prev['ID'][pos] == ids
+            changed = known & ( prev['HASH'][pos] != hashes )
+        todo = ~known | changed
+        removed = ~np.isin( prev['ID'], ids, assume_unique=True )
+
+        # Drop the matches of removed and changed rows, match the new ones
+        stale = np.isin( found['ID'], np.concatenate( [ prev['ID'][removed], ids[changed] ] ) )
+        found = { a: values[~stale] for a, values in found.items() }
+        rows = order[todo]
+        ras  = np.asarray( data['RA'],  dtype=float )[rows]
+        decs = np.asarray( data['DEC'], dtype=float )[rows]
+        if len(rows) > 0:
+            idx1, files, ref_rows, sep = match_rows( reference, ras, decs, radius )
+            new = { 'ID': ids[todo][idx1], 'REF_FILE': files, 'REF_ROW': ref_rows, 'SEP': sep }
+            found = { a: np.concatenate( [ found[a], new[a] ] ) for a in MATCH_ARRAYS }
+        merged = np.lexsort( ( found['SEP'], found['ID'] ) )
+        found = { a: values[merged] for a, values in found.items() }
+    count( 'rows_rematched', int( todo.sum() ) )
+
+    summary = { 'added': int( ( ~known ).sum() ), 'removed': int( removed.sum() ),
+                'changed': int( changed.sum() ), 'unchanged': int( ( known & ~changed ).sum() ),
+                'matched': int( todo.sum() ), 'matches': len( found['ID'] ) }
+    entry = dict( version, nrows=len(ids), updated=time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                  version=( old or {} ).get( 'version', 0 ) + 1, last_update=summary )
+    _save( store, name, { 'ID': ids, 'HASH': hashes }, found, entry )
+    return summary
+
+
+
+def matches( store, name, data, id_column=None ):
+    # Stored matches for the rows of data (the catalog as last passed to
+    #   update()): idx1 (row in data), reference file number, reference row
+    #   and separation (degrees), sorted by row then separation
+    ids = _ids( data, id_column )
+    found = load_arrays( store, name, 'matches' )
+    order = np.argsort( ids, kind='stable' )
+    pos = np.searchsorted( ids[order], found['ID'] )
+    ok = pos < len(ids)
+    ok[ok] = ids[order][pos[ok]] == found['ID'][ok]
+    idx1 = order[pos[ok]]
+    resort = np.lexsort( ( found['SEP'][ok], idx1 ) )
+    return idx1[resort], found['REF_FILE'][ok][resort], found['REF_ROW'][ok][resort], found['SEP'][ok][resort]
+
+
+
+
+if __name__ == '__main__':
+    import glob
+    from argparse import ArgumentParser
+
+    ap = ArgumentParser( description='Match a catalog to reference files, redoing only new or changed rows' )
+    ap.add_argument( "store", help='Match store directory' )
+    ap.add_argument( "catalogs", nargs='+', help='FITS catalogs to match (each stored under its file name)' )
+    ap.add_argument( "--reference", nargs='+', required=True, help='Reference FITS files, or glob patterns' )
+    ap.add_argument( "--radius", type=float, default=1., help='Match radius (arcsec)' )
+    ap.add_argument( "--id-column", default=None, help='Column of unique row IDs (default: the position)' )
+    ap.add_argument( "--hash-columns", nargs='+', default=HASH_COLUMNS,
+                     help='Columns whose change means a row is matched again' )
+    ns = ap.parse_args()
+
+    reference = sorted( set( f for p in ns.reference for f in glob.glob( p ) ) )
+    if len(reference) == 0:
+        raise ValueError( "No reference files match {}".format( ns.reference ) )
+    for fname in ns.catalogs:
+        needed = list( dict.fromkeys( ['RA', 'DEC'] + ns.hash_columns + ( [ns.id_column] if ns.id_column else [] ) ) )
+        data = read_fits_columns( fname, needed )
+        summary = update( ns.store, os.path.basename( fname ), data, reference, ns.radius / 3600.,
+                          ns.id_column, ns.hash_columns )
+        print( '{}: {added:d} added, {removed:d} removed, {changed:d} changed, {unchanged:d} unchanged; '
+               '{matched:d} rows matched, {matches:d} matches stored'.format( fname, **summary ) )
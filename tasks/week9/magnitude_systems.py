@@ -3,12 +3,14 @@
 
 #import astropy
 import os
-from astropy.table import Table 
 import glob
-from astropy import units
-from astropy.coordinates import SkyCoord, search_around_sky
 import numpy as np
+from week9.spatial_index import index_for_catalog, query_radius
+from week9.photometric_transforms import colors_to_mags, apply_transforms
 import warnings
+from utils.lazy import lazy_import
+Table = lazy_import( 'astropy.table', 'Table' )
+fits = lazy_import( 'astropy.io.fits' )
 warnings.filterwarnings("ignore")
 
 '''
@@ -24,43 +26,31 @@ ASTRO5160 Week 9 Class 17: Magnitude Systems
 
 
 def convert_Colors_to_Mags( Colors ):
-    # Convert list of V, B-V, U-B, V-R, R-I into list of individual U,B,V,R,I mags
-    # Expects a list with 5 values (as shown above)
-    if len(Colors) != 5:
+    # Convert V, B-V, U-B, V-R, R-I into individual U,B,V,R,I mags
+    # Expects a list with 5 values (as shown above), or an (N, 5) array with
+    #   one star per row
+    Colors = np.asarray( Colors, dtype=float )
+    if Colors.shape[-1] != 5:
         raise Exception( "Must input all five U, B-V, U-B, V-R, R-I magnitudes/colors "\
                         +"as list to convert to individual mags" )    
-    (V, BmV, UmB, VmR, RmI) = Colors
 
-    # Convert from colors to individual magnitudes    
-    B =  BmV + V
-    U =  UmB + B
-    R = -VmR + V
-    I = -RmI + R
-
-    # Return magnitudes as list
-    Mags = [U,B,V,R,I]
+    # Convert from colors to individual magnitudes (see photometric_transforms.py)
+    (Mags, _) = colors_to_mags( Colors )
     return Mags
 
 
 def convert_Mags_to_mags( Mags ):
-    # Convert list of UBVRI Mags into list of ugriz mags
-    # Expects a list with 5 values (U,B,V,R,I)
-    if len(Mags) != 5:
+    # Convert UBVRI Mags into ugriz mags
+    # Expects a list with 5 values (U,B,V,R,I), or an (N, 5) array with one
+    #   star per row
+    Mags = np.asarray( Mags, dtype=float )
+    if Mags.shape[-1] != 5:
         raise Exception( "Must input all five UBVRI magnitudes as list to convert "\
                         +"to ugriz mags" )    
-    (U,B,V,R,I) = Mags
-
-    # Use Jester 2005 for stars with R-I<1.15 for conversion
-    r = V - 0.42*(B-V) + 0.11
-    g = V + 0.60*(B-V) - 0.12
-    z = r - 1.72*(R-I) + 0.41
-    i = r - 0.91*(R-I) + 0.20
-    u = g - 1.28*(U-B) - 1.13
-
-    # Output converted magnitudes as list
-    mags = [u,g,r,i,z]
-    return mags
 
+    # Use Jester 2005 for stars with R-I<1.15 for conversion (NaN for redder stars)
+    (mags, _, _) = apply_transforms( Mags.reshape( -1, 5 ), names=['jester05_stars'] )
+    return mags.reshape( Mags.shape )
 
 
 def decode_sweep_name(sweepname):
@@ -142,7 +132,7 @@ if __name__ == '__main__':
     print( "   r:  Conv: {:5.2f}   SDSS: {:5.2f}".format( r, rexp ) )
     print( "   i:  Conv: {:5.2f}   SDSS: {:5.2f}".format( i, iexp ) )
     print( "   z:  Conv: {:5.2f}   SDSS: {:5.2f}".format( z, zexp ) )
-    print( "The g and z channels agree very closely with the directly "\
+    print( "The u, g, i and z channels agree closely with the directly "\
           +"measured values by SDSS." ) 
         
         
@@ -172,24 +162,23 @@ if __name__ == '__main__':
             raise Exception( "No sweeps files found for given RA/Dec")
     print( "\nSweep file needed: \n" +file_needed[0] )
         
-    # Make a SkyCoord array with only the RA/Dec for the standard star
-    loc = SkyCoord( ra=[RA]*units.degree, dec=[Dec]*units.degree, frame='icrs' )
-    sweep_data = Table.read( file_needed[0] )
-    sweep_ras  = sweep_data['RA']
-    sweep_decs = sweep_data['DEC']
-    sweep_locs = SkyCoord( ra=sweep_ras, dec=sweep_decs )
-
-    # Find match to standard star, check that only 1 match found, print separation
-    (_, idx2, sep2d, _) = search_around_sky( loc, sweep_locs, seplimit=1*units.arcsec )
-    if len(sep2d) == 1:
-        print( "\nMatch found:\n  Separation = {:6f}".format(sep2d.to(units.arcsec)[0] ) )
-    elif len(sep2d) > 1:
+    # Search the sweep file's spatial index (built and saved next to the file
+    #   the first time, from just its RA/Dec columns) rather than making a
+    #   SkyCoord of the whole sweep
+    index = index_for_catalog( file_needed[0] )
+    (idx2, sep) = query_radius( index, RA, Dec, 1./3600 )
+
+    # Check that only 1 match found, print separation
+    if len(sep) == 1:
+        print( "\nMatch found:\n  Separation = {:6f} arcsec".format( sep[0]*3600 ) )
+    elif len(sep) > 1:
         raise Exception( "More than one match found for " +star )
     else:        
         raise Exception( "No matches found for " +star )
         
-    # Convert the matched fluxes to magnitudes
-    match = sweep_data[idx2]
+    # Read only the matched row of the sweep file, and convert its fluxes to magnitudes
+    with fits.open( file_needed[0], memmap=True ) as hdul:
+        match = Table( hdul[1].data[idx2] )
     g_LS  = convert_maggie( match['FLUX_G'][0]  )
     r_LS  = convert_maggie( match['FLUX_R'][0]  )
     z_LS  = convert_maggie( match['FLUX_Z'][0]  )
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+'''
+ASTRO5160 Week 9: Batch photometric transformations
+-----------------
+-Linear transformations between magnitude systems (e.g. Jester et al. 2005,
+   UBVRcIc <-> SDSS ugriz), applied to whole tables as (N, 5) arrays
+-Each transformation is registered as a list of equations, each giving one
+   output band from input bands and earlier outputs, plus its rms scatter;
+   these are folded into a single matrix, so applying one is one matrix product
+-A condition (e.g. R-I < 1.15) picks which transformation applies to each
+   row; rows with none get NaN
+-Uncertainties of the inputs and the scatter of each relation are propagated
+   through the same matrices
+-----------------
+'''
+
+BANDS_UBVRI = ['U', 'B', 'V', 'R', 'I']
+BANDS_UGRIZ = ['u', 'g', 'r', 'i', 'z']
+
+# Registered transformations, by name
+TRANSFORMS = {}
+
+# U, B, V, R, I from V, B-V, U-B, V-R, R-I
+#                            V  B-V U-B V-R R-I
+COLORS_TO_MAGS = np.array( [[1,  1,  1,  0,  0],     # U = V + (B-V) + (U-B)
+                            [1,  1,  0,  0,  0],     # B = V + (B-V)
+                            [1,  0,  0,  0,  0],     # V
+                            [1,  0,  0, -1,  0],     # R = V - (V-R)
+                            [1,  0,  0, -1, -1]] )   # I = V - (V-R) - (R-I)
+
+
+
+def register_transform( name, inputs, outputs, equations, condition=None ):
+    # Register a linear transformation from bands 'inputs' to bands 'outputs'
+    #   equations: list of (band, {term: coefficient}, constant, scatter), in
+    #              order; terms may be input bands or earlier output bands
+    #   condition: function of the (N, len(inputs)) input magnitudes giving
+    #              the rows the relations hold for (None for all rows)
+    n_in, n_eq = len(inputs), len(equations)
+    # Every quantity is kept as W.mags + c + E.errors, where errors are the
+    #   (independent) scatter terms of each equation
+    rows = { b: ( np.eye( n_in )[k], 0., np.zeros( n_eq ) ) for k, b in enumerate( inputs ) }
+    for ieq, (band, terms, const, scatter) in enumerate( equations ):
+        w, c, e = np.zeros( n_in ), const, np.eye( n_eq )[ieq]
+        for term, coeff in terms.items():
+            if term not in rows:
+                raise ValueError( "Term '{}' of '{}' in {} is not an input or earlier output".format(
+                                  term, band, name ) )
+            w = w + coeff*rows[term][0]
+            c = c + coeff*rows[term][1]
+            e = e + coeff*rows[term][2]
+        rows[band] = ( w, c, e )
+
+    missing = [ b for b in outputs if b not in rows ]
+    if len(missing) > 0:
+        raise ValueError( "Outputs {} of {} are never defined".format( missing, name ) )
+    TRANSFORMS[name] = {
+        'inputs': list( inputs ), 'outputs': list( outputs ), 'condition': condition,
+        'W': np.array( [ rows[b][0] for b in outputs ] ),
+        'c': np.array( [ rows[b][1] for b in outputs ] ),
+        'E': np.array( [ rows[b][2] for b in outputs ] ) * np.array( [ eq[3] for eq in equations ] ) }
+    return TRANSFORMS[name]
+
+
+
+def colors_to_mags( colors, sigmas=None ):
+    # Convert (N, 5) arrays of V, B-V, U-B, V-R, R-I into U, B, V, R, I
+    #   sigmas: optional matching uncertainties (assumed independent)
+    # Returns (mags, mag_cov), where mag_cov is the (N, 5, 5) covariance of the
+    #   magnitudes (correlated, as they all build on V), or None if sigmas is
+    colors = np.asarray( colors, dtype=float )
+    if colors.shape[-1] != 5:
+        raise ValueError( "Need all five V, B-V, U-B, V-R, R-I magnitudes/colors "\
+                          +"to convert to individual mags" )
+    mags = colors @ COLORS_TO_MAGS.T
+    if sigmas is None:
+        return mags, None
+    sigmas = np.broadcast_to( np.asarray( sigmas, dtype=float ), colors.shape )
+    return mags, ( COLORS_TO_MAGS * sigmas[...,None,:]**2 ) @ COLORS_TO_MAGS.T
+
+
+
+def apply_transforms( mags, sigmas=None, names=('jester05_stars',), covariance=False, jacobian=None ):
+    # Transform an (N, 5) array of magnitudes with the named transformations
+    #   Each row uses the first transformation (in the order given) whose
+    #   condition it meets; rows meeting none are NaN
+    #   sigmas: optional (N, 5) independent uncertainties of the input magnitudes
+    #   jacobian: if the magnitudes were themselves made from independent
+    #             quantities x as mags = x @ jacobian.T (e.g. from colours),
+    #             sigmas are those of x instead, and are propagated through both
+    # Returns (out, out_sigmas, which), where out_sigmas combines the input
+    #   uncertainties and relation scatter (or is the full (N, 5, 5)
+    #   covariance if covariance=True), and which is the index into names of
+    #   the transformation used for each row (-1 for none)
+    mags = np.atleast_2d( np.asarray( mags, dtype=float ) )
+    transforms = [ TRANSFORMS[n] for n in names ]
+    inputs = transforms[0]['inputs']
+    for t in transforms:
+        if t['inputs'] != inputs or t['outputs'] != transforms[0]['outputs']:
+            raise ValueError( "Transformations to combine must share input and output bands" )
+    if mags.shape[-1] != len(inputs):
+        raise ValueError( "Expected magnitudes in bands {}".format( inputs ) )
+    if jacobian is None:
+        jacobian = np.eye( len(inputs) )
+    if sigmas is not None:
+        sigmas = np.broadcast_to( np.asarray( sigmas, dtype=float ), mags.shape )
+
+    n, nout = len(mags), len( transforms[0]['outputs'] )
+    out   = np.full( (n, nout), np.nan )
+    err   = np.full( (n, nout, nout) if covariance else (n, nout), np.nan )
+    which = np.full( n, -1 )
+    todo  = np.ones( n, dtype=bool )
+    for k, t in enumerate( transforms ):
+        rows = todo.copy()
+        if t['condition'] is not None:
+            rows &= t['condition']( mags )
+        todo &= ~rows
+        which[rows] = k
+        out[rows] = mags[rows] @ t['W'].T + t['c']
+
+        # Covariance: J diag(sigma^2) J^T from the inputs (J = W.jacobian),
+        #   plus E E^T from the scatter of each relation
+        J, E = t['W'] @ jacobian, t['E']
+        if covariance:
+            err[rows] = E @ E.T
+            if sigmas is not None:
+                err[rows] += ( J * sigmas[rows][:,None,:]**2 ) @ J.T
+        else:
+            var = np.sum( E**2, axis=1 )
+            if sigmas is not None:
+                var = var + sigmas[rows]**2 @ (J**2).T
+            err[rows] = np.sqrt( var )
+    return out, err, which
+
+
+
+def transform_colors( colors, sigmas=None, names=('jester05_stars',), covariance=False ):
+    # Convenience wrapper: V, B-V, U-B, V-R, R-I (and their independent
+    #   uncertainties) straight to ugriz; see apply_transforms for the outputs
+    mags, _ = colors_to_mags( colors )
+    return apply_transforms( mags, sigmas, names=names, covariance=covariance,
+                             jacobian=COLORS_TO_MAGS )
+
+
+
+# Jester et al. (2005), Table 1: stars with Rc-Ic < 1.15
+register_transform( 'jester05_stars', BANDS_UBVRI, BANDS_UGRIZ, [
+    ( 'g', {'V': 0.40, 'B': 0.60}, -0.12, 0.02 ),                      # g = V + 0.60(B-V) - 0.12
+    ( 'r', {'V': 1.42, 'B': -0.42}, 0.11, 0.03 ),                      # r = V - 0.42(B-V) + 0.11
+    ( 'u', {'g': 1, 'U': 1.28, 'B': -1.28}, 1.13, 0.06 ),              # u-g = 1.28(U-B) + 1.13
+    ( 'i', {'r': 1, 'R': -0.91, 'I': 0.91}, 0.20, 0.03 ),              # r-i = 0.91(R-I) - 0.20
+    ( 'z', {'r': 1, 'R': -1.72, 'I': 1.72}, 0.41, 0.03 ) ],            # r-z = 1.72(R-I) - 0.41
+    condition=lambda m: m[:,3] - m[:,4] < 1.15 )
+
+# Jester et al. (2005), Table 1: quasars at z <= 2.1 (no colour condition;
+#   choose it explicitly for rows known to be quasars)
+register_transform( 'jester05_qsos', BANDS_UBVRI, BANDS_UGRIZ, [
+    ( 'g', {'V': 0.26, 'B': 0.74}, -0.07, 0.02 ),                      # g = V + 0.74(B-V) - 0.07
+    ( 'r', {'V': 1.19, 'B': -0.19}, 0.02, 0.08 ),                      # r = V - 0.19(B-V) + 0.02
+    ( 'u', {'g': 1, 'U': 1.25, 'B': -1.25}, 1.02, 0.03 ),              # u-g = 1.25(U-B) + 1.02
+    ( 'i', {'r': 1, 'R': -0.90, 'I': 0.90}, 0.20, 0.07 ),              # r-i = 0.90(R-I) - 0.20
+    ( 'z', {'r': 1, 'R': -1.20, 'I': 1.20}, 0.20, 0.18 ) ] )           # r-z = 1.20(R-I) - 0.20
+
+# Jester et al. (2005), Table 1: the reverse, ugriz to UBVRcIc for stars
+#   with Rc-Ic < 1.15 (i.e. r-i < 0.94)
+register_transform( 'jester05_stars_inverse', BANDS_UGRIZ, BANDS_UBVRI, [
+    ( 'V', {'g': 0.41, 'r': 0.59}, -0.01, 0.01 ),                      # V = g - 0.59(g-r) - 0.01
+    ( 'B', {'g': 1.39, 'r': -0.39}, 0.21, 0.03 ),                      # B = g + 0.39(g-r) + 0.21
+    ( 'U', {'B': 1, 'u': 0.78, 'g': -0.78}, -0.88, 0.05 ),             # U-B = 0.78(u-g) - 0.88
+    ( 'R', {'V': 1, 'r': -1.09, 'i': 1.09}, -0.22, 0.03 ),             # V-R = 1.09(r-i) + 0.22
+    ( 'I', {'R': 1, 'r': -1.00, 'i': 1.00}, -0.21, 0.01 ) ],           # R-I = 1.00(r-i) + 0.21
+    condition=lambda m: m[:,2] - m[:,3] < 0.94 )
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Quick conversion from the command line, e.g. for the week 9 standard star:
+    #   python photometric_transforms.py 15.256 0.873 0.320 0.505 0.511
+    ap = ArgumentParser( description='Convert UBVRcIc photometry to SDSS ugriz (Jester et al. 2005)' )
+    ap.add_argument( "values", nargs=5, type=float,
+                     help='V, B-V, U-B, V-R, R-I (or U, B, V, R, I with --mags)' )
+    ap.add_argument( "--mags", action='store_true', help='Values are U, B, V, R, I magnitudes' )
+    ap.add_argument( "--sigmas", nargs=5, type=float, default=None, help='Uncertainties of the values' )
+    ap.add_argument( "--transform", nargs='+', default=['jester05_stars'], choices=list( TRANSFORMS ),
+                     help='Transformation(s) to use, first matching one per row' )
+    ns = ap.parse_args()
+
+    if ns.mags:
+        out, err, which = apply_transforms( [ns.values], ns.sigmas, names=ns.transform )
+    else:
+        out, err, which = transform_colors( [ns.values], ns.sigmas, names=ns.transform )
+    if which[0] < 0:
+        raise ValueError( "None of the transformations {} apply to these values".format( ns.transform ) )
+    print( 'Using ' +ns.transform[ which[0] ] )
+    for band, mag, sigma in zip( TRANSFORMS[ ns.transform[ which[0] ] ]['outputs'], out[0], err[0] ):
+        print( '  {}: {:7.3f} +/- {:.3f}'.format( band, mag, sigma ) )
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import numpy as np
+from week6.cap_geometry import radec_to_xyz
+from week9.sweep_store import read_fits_columns
+from utils.instrument import timed
+from utils.lazy import lazy_import
+hp = lazy_import( 'healpy' )
+
+'''
+ASTRO5160 Week 9: Persistent spatial index for cone searches
+-----------------
+-Built once per catalog (e.g. a sweep file) and saved next to it, in
+   '<catalog>.idx/', or under INDEX_CACHE where the catalog's directory
+   can't be written to (e.g. the shared sweeps), then reused by every later
+   search; if it can't be saved anywhere it is only kept in memory
+-Positions are stored as unit vectors sorted by their (NESTED) HEALPix pixel
+   at a fine order, so each pixel at any coarser order is one contiguous
+   block of rows, found with a binary search of the sorted pixel numbers
+-All arrays are memory-mapped .npy files: a search only touches the few
+   pages around the pixels it needs, never the whole catalog
+-Radius searches, nearest-neighbour searches, and many cones at once
+   (returning idx1, idx2, sep like search_around_sky)
+-----------------
+'''
+
+# Default index order (Nside=16384, ~13 arcsec pixels)
+INDEX_ORDER = 14
+
+# Name of the metadata file in an index directory
+INDEX_FILE = 'index.json'
+
+# Directory for indexes of catalogs in directories we can't write to
+INDEX_CACHE = os.environ.get( 'ASTRO5160_INDEX_CACHE',
+                              os.path.join( os.path.expanduser( '~' ), '.cache', 'astro5160', 'index' ) )
+
+
+
+def index_dir_for( fname, cache_dir=INDEX_CACHE ):
+    # Default index directory for a catalog file: next to it if there is one
+    #   there already or its directory is writable, otherwise in cache_dir
+    #   (under a hash of the full path, as catalogs may share a name)
+    if os.path.isdir( fname + '.idx' ) or os.access( os.path.dirname( os.path.abspath( fname ) ), os.W_OK ):
+        return fname + '.idx'
+    path = os.path.abspath( fname )
+    key = hashlib.sha256( path.encode() ).hexdigest()[:16]
+    return os.path.join( cache_dir, key +'-' +os.path.basename( path ) +'.idx' )
+
+
+
+def make_index( ras, decs, order=INDEX_ORDER ):
+    # Build an index of the given RA/Dec (degrees) positions in memory, e.g.
+    #   for a chunk of rows which will only be searched once or twice
+    ras  = np.asarray( ras,  dtype=float )
+    decs = np.asarray( decs, dtype=float )
+    pix  = hp.ang2pix( hp.order2nside( order ), ras, decs, nest=True, lonlat=True )
+    rows = np.argsort( pix, kind='stable' )
+    return { 'order': order, 'nrows': len(rows), 'source': None, 'pix': pix[rows],
+             'rows': rows, 'xyz': radec_to_xyz( ras[rows], decs[rows] ) }
+
+
+
+def build_index( ras, decs, index_dir, order=INDEX_ORDER, source=None ):
+    # Build and save an index of the given RA/Dec (degrees) positions
+    #   source: optional catalog file name, recorded so a stale index can be detected
+    index = make_index( ras, decs, order )
+
+    os.makedirs( index_dir, exist_ok=True )
+    meta_path = os.path.join( index_dir, INDEX_FILE )
+    if os.path.exists( meta_path ):
+        os.remove( meta_path )
+    for name in ['pix', 'rows', 'xyz']:
+        np.save( os.path.join( index_dir, name +'.npy' ), index[name] )
+
+    meta = { 'order': order, 'nrows': index['nrows'], 'source': None }
+    if source is not None:
+        stat = os.stat( source )
+        meta['source'] = { 'path': os.path.abspath( source ), 'size': stat.st_size,
+                           'mtime': stat.st_mtime }
+    # Metadata last, so an interrupted build is never mistaken for an index
+    with open( meta_path, 'w' ) as f:
+        json.dump( meta, f, indent=2 )
+    return index_dir
+
+
+
+def open_index( index_dir ):
+    # Open a saved index; the arrays are read-only memory maps
+    with open( os.path.join( index_dir, INDEX_FILE ) ) as f:
+        index = json.load( f )
+    for name in ['pix', 'rows', 'xyz']:
+        index[name] = np.load( os.path.join( index_dir, name +'.npy' ), mmap_mode='r' )
+    return index
+
+
+
+def index_for_catalog( fname, index_dir=None, order=INDEX_ORDER ):
+    # Open the index of a FITS catalog, first building it (from only the RA
+    #   and DEC columns) if it doesn't exist or the catalog has changed since
+    if index_dir is None:
+        index_dir = index_dir_for( fname )
+    try:
+        index = open_index( index_dir )
+        stat  = os.stat( fname )
+        source = index['source']
+        if source is not None and source['size'] == stat.st_size \
+                and source['mtime'] == stat.st_mtime and index['order'] == order:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    radec = read_fits_columns( fname, ['RA', 'DEC'] )
+    try:
+        build_index( radec['RA'], radec['DEC'], index_dir, order=order, source=fname )
+    except OSError:
+        # Nowhere to save it: search it from memory this time
+        return make_index( radec['RA'], radec['DEC'], order )
+    return open_index( index_dir )
+
+
+
+def query_order( index, radius ):
+    # Order at which to look up a search of the given radius (degrees): the
+    #   finest order whose pixels are still at least a quarter of the radius,
+    #   so a cone needs a few dozen pixels at most, which fit it closely
+    resol = np.degrees( [ hp.nside2resol( hp.order2nside( k ) ) for k in range( index['order']+1 ) ] )
+    ok = np.flatnonzero( resol >= radius/4 )
+    return int( ok[-1] ) if len(ok) > 0 else 0
+
+
+
+def cone_candidates( index, ras, decs, radius ):
+    # Sorted-row ranges which may hold points within radius of each cone
+    #   Returns (cone number, first row, end row) arrays, one entry per pixel
+    order  = query_order( index, radius )
+    nside  = hp.order2nside( order )
+    shift  = 4**( index['order'] - order )
+    centers = radec_to_xyz( ras, decs )
+    cones, lo, hi = [ np.zeros( 0, int ) ], [ np.zeros( 0, int ) ], [ np.zeros( 0, int ) ]
+    for i, c in enumerate( centers ):
+        pix = hp.query_disc( nside, c, np.radians( radius ), inclusive=True, nest=True )
+        cones.append( np.full( len(pix), i ) )
+        lo.append( pix*shift )
+        hi.append( (pix+1)*shift )
+    cones = np.concatenate( cones )
+    # Each coarse pixel is one contiguous block of the sorted fine pixels
+    start = np.searchsorted( index['pix'], np.concatenate( lo ), side='left' )
+    end   = np.searchsorted( index['pix'], np.concatenate( hi ), side='left' )
+    return cones, start, end
+
+
+
+def expand_ranges( cones, start, end ):
+    # Expand (cone, start, end) ranges into one (cone, sorted row) pair per row
+    n = end - start
+    keep = n > 0
+    cones, start, n = cones[keep], start[keep], n[keep]
+    which = np.repeat( np.arange( len(n) ), n )
+    offset = np.arange( n.sum() ) - np.repeat( np.cumsum( n ) - n, n )
+    return cones[which], start[which] + offset
+
+
+
+def angular_sep( xyz1, xyz2 ):
+    # Angle (degrees) between unit vectors, accurate at small separations
+    chord = np.linalg.norm( np.atleast_2d( xyz1 ) - np.atleast_2d( xyz2 ), axis=1 )
+    return np.degrees( 2*np.arcsin( np.clip( chord/2, 0, 1 ) ) )
+
+
+
+@timed( 'query_cones' )
+def query_cones( index, ras, decs, radius ):
+    # All (cone, catalog row) pairs within radius (degrees) of many cones
+    #   Returns idx1 (cone number), idx2 (row in the original catalog) and
+    #   sep (degrees), as search_around_sky does, sorted by cone
+    ras  = np.atleast_1d( ras )
+    decs = np.atleast_1d( decs )
+    cones, start, end = cone_candidates( index, ras, decs, radius )
+    cones, srows = expand_ranges( cones, start, end )
+    # Fetch the candidate rows in sorted (disk) order
+    sep  = angular_sep( radec_to_xyz( ras, decs )[cones], index['xyz'][srows] )
+    keep = sep <= radius
+    cones, srows, sep = cones[keep], srows[keep], sep[keep]
+    order = np.lexsort( (sep, cones) )
+    return cones[order], np.asarray( index['rows'][srows[order]] ), sep[order]
+
+
+
+def query_radius( index, ra, dec, radius ):
+    # Catalog rows within radius (degrees) of a single position, and their
+    #   separations (degrees), nearest first
+    _, rows, sep = query_cones( index, ra, dec, radius )
+    return rows, sep
+
+
+
+def query_nearest( index, ras, decs, max_radius=1. ):
+    # Nearest catalog row to each position, searching out to max_radius
+    #   (degrees); rows of -1 (and sep of inf) where nothing is that close
+    # The search radius starts at about one index pixel and doubles for
+    #   positions still without a neighbour
+    ras  = np.atleast_1d( np.asarray( ras,  dtype=float ) )
+    decs = np.atleast_1d( np.asarray( decs, dtype=float ) )
+    rows = np.full( len(ras), -1, dtype=np.int64 )
+    seps = np.full( len(ras), np.inf )
+    todo = np.arange( len(ras) )
+    radius = np.degrees( hp.nside2resol( hp.order2nside( index['order'] ) ) )
+    while len(todo) > 0:
+        radius = min( radius, max_radius )
+        idx1, idx2, sep = query_cones( index, ras[todo], decs[todo], radius )
+        # Results are sorted by cone then separation: first per cone is nearest
+        first = np.r_[ True, idx1[1:] != idx1[:-1] ] if len(idx1) > 0 else np.zeros( 0, bool )
+        rows[ todo[idx1[first]] ] = idx2[first]
+        seps[ todo[idx1[first]] ] = sep[first]
+        if radius >= max_radius:
+            break
+        todo = todo[ rows[todo] < 0 ]
+        radius *= 2
+    return rows, seps
+
+
+
+
+if __name__ == '__main__':
+
+    # Compare against search_around_sky on a random catalog
+    from astropy.coordinates import SkyCoord, search_around_sky
+    from astropy import units
+    import tempfile
+    import time
+
+    num = 1000000
+    ras  = 360. * np.random.random( num )
+    decs = np.degrees( np.arcsin( 1 - 2*np.random.random( num ) ) )
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.time()
+        build_index( ras, decs, os.path.join( tmp, 'cat.idx' ) )
+        index = open_index( os.path.join( tmp, 'cat.idx' ) )
+        print( 'Built index of {:d} rows in {:.2f} s'.format( num, time.time()-t0 ) )
+
+        qras, qdecs = ras[:1000] + 1e-3, decs[:1000]
+        t0 = time.time()
+        idx1, idx2, sep = query_cones( index, qras, qdecs, 0.05 )
+        print( '1000 cones in {:.3f} s: {:d} matches'.format( time.time()-t0, len(idx1) ) )
+
+        t0 = time.time()
+        c1 = SkyCoord( qras*units.degree, qdecs*units.degree )
+        c2 = SkyCoord( ras*units.degree, decs*units.degree )
+        ref1, _, _, _ = search_around_sky( c1, c2, seplimit=0.05*units.degree )
+        print( 'search_around_sky in {:.3f} s: {:d} matches'.format( time.time()-t0, len(ref1) ) )
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import shutil
+import numpy as np
+from week6.cap_geometry import radec_to_xyz, in_polygon
+from week6.mask_randoms import candidate_pixels
+from utils.instrument import timer, count
+from utils.lazy import lazy_import
+hp = lazy_import( 'healpy' )
+fits = lazy_import( 'astropy.io.fits' )
+
+'''
+ASTRO5160 Week 9: HEALPix-partitioned sweep catalog store
+-----------------
+-Re-partitions Legacy Survey sweep files (fixed RA/Dec boxes) into a
+   catalog split by HEALPix pixel, with one .npy file per column in each
+   partition, so a query only opens the partitions and columns it needs
+-Partition order is adaptive: dense pixels are split into their four
+   children until every partition holds at most max_rows rows
+-Per-partition min/max statistics of every numeric column let range cuts
+   skip whole partitions
+-Cone, RA/Dec box and (Mangle cap) polygon queries
+-----------------
+*Note: build once with
+   'python sweep_store.py STORE_DIR /d/scratch/ASTR5160/data/legacysurvey/dr9/south/sweep/9.0/*.fits'
+'''
+
+# Name of the metadata file at the top of a store
+STORE_FILE = 'store.json'
+
+# Column holding the (NESTED) pixel of each row at the store's finest order;
+#   rows within each partition are sorted by it
+PIX_COLUMN = 'HPXPIX'
+
+# Defaults: finest partition order (Nside=256, ~0.23 deg pixels), and the
+#   most rows allowed in a partition before it is split
+MAX_ORDER = 8
+MAX_ROWS  = 2**18
+
+
+
+def read_fits_columns( fname, columns=None ):
+    # Read the named columns of the first table HDU of a FITS file into
+    #   native-byte-order arrays, without reading the other columns
+    with timer( 'read_sweep' ), fits.open( fname, memmap=True ) as hdul:
+        data = hdul[1].data
+        if columns is None:
+            columns = list( data.columns.names )
+        out = {}
+        for col in columns:
+            values = np.asarray( data[col] )
+            out[col] = values.astype( values.dtype.newbyteorder( '=' ) )
+            count( 'bytes_read', out[col].nbytes )
+        count( 'rows_read', len(data) )
+    return out
+
+
+
+def adaptive_partitions( counts, max_order, max_rows ):
+    # Choose the partitions: starting from the 12 base pixels, split any pixel
+    #   with more than max_rows rows into its 4 children, down to max_order
+    #   counts: rows in each NESTED pixel at max_order
+    # Returns a list of (order, pixel) for every non-empty partition
+    parts = []
+    pending = np.arange( 12 )
+    for order in range( max_order+1 ):
+        level = counts.reshape( -1, 4**(max_order-order) ).sum( axis=1 )
+        n = level[pending]
+        done = (n <= max_rows) | (order == max_order)
+        parts += [ (order, int(p)) for p in pending[done & (n > 0)] ]
+        pending = ( 4*pending[~done][:,None] + np.arange( 4 ) ).ravel()
+    return parts
+
+
+
+def partition_lookup( parts, max_order ):
+    # Array giving the partition index of each NESTED pixel at max_order
+    #   (-1 where no partition holds any rows)
+    lookup = np.full( hp.order2npix( max_order ), -1, dtype=np.int32 )
+    for ipart, (order, pix) in enumerate( parts ):
+        scale = 4**(max_order-order)
+        lookup[ pix*scale : (pix+1)*scale ] = ipart
+    return lookup
+
+
+
+def partition_dir( root, order, pix ):
+    # Directory holding one partition's column files
+    return os.path.join( root, 'order{:d}'.format( order ), 'pix{:d}'.format( pix ) )
+
+
+
+def column_stats( values ):
+    # [min, max] of a numeric column (ignoring NaNs), or None
+    if values.dtype.kind not in 'iuf' or values.ndim != 1 or len(values) == 0:
+        return None
+    if values.dtype.kind == 'f':
+        if np.all( np.isnan( values ) ):
+            return None
+        return [ float( np.nanmin( values ) ), float( np.nanmax( values ) ) ]
+    return [ values.min().item(), values.max().item() ]
+
+
+
+def build_store( sweep_files, root, columns=None, max_order=MAX_ORDER, max_rows=MAX_ROWS ):
+    # Convert sweep files into a HEALPix-partitioned store in directory root
+    #   columns: columns to keep (default all); RA and DEC are always kept
+    # Two passes over the files: the first counts rows per pixel to choose the
+    #   partitions, the second writes each file's rows out as per-partition
+    #   fragments, which are finally joined (so only one partition, never the
+    #   whole catalog, is held in memory)
+    nside = hp.order2nside( max_order )
+    if columns is not None:
+        columns = list( dict.fromkeys( ['RA', 'DEC'] + list( columns ) ) )
+
+    # Pass 1: rows per pixel
+    counts = np.zeros( hp.order2npix( max_order ), dtype=np.int64 )
+    for f in sweep_files:
+        radec = read_fits_columns( f, ['RA', 'DEC'] )
+        pix = hp.ang2pix( nside, radec['RA'], radec['DEC'], nest=True, lonlat=True )
+        counts += np.bincount( pix, minlength=len(counts) )
+    parts  = adaptive_partitions( counts, max_order, max_rows )
+    lookup = partition_lookup( parts, max_order )
+
+    # Pass 2: split each file into per-partition fragments
+    frag_root = os.path.join( root, '_fragments' )
+    os.makedirs( frag_root, exist_ok=True )
+    dtypes = {}
+    for ifile, f in enumerate( sweep_files ):
+        data = read_fits_columns( f, columns )
+        pix  = hp.ang2pix( nside, data['RA'], data['DEC'], nest=True, lonlat=True )
+        data[PIX_COLUMN] = pix
+        ipart = lookup[pix]
+        order = np.argsort( ipart, kind='stable' )
+        bounds = np.searchsorted( ipart[order], np.arange( len(parts)+1 ) )
+        for ip in np.flatnonzero( np.diff( bounds ) ):
+            rows = order[ bounds[ip] : bounds[ip+1] ]
+            frag_dir = os.path.join( frag_root, str(ip) )
+            os.makedirs( frag_dir, exist_ok=True )
+            for col, values in data.items():
+                np.save( os.path.join( frag_dir, '{:d}_{}.npy'.format( ifile, col ) ), values[rows] )
+        dtypes = { col: values.dtype for col, values in data.items() }
+
+    # Join fragments into partitions, sorted by pixel, and collect statistics
+    meta_parts = []
+    for ip, (order, p) in enumerate( parts ):
+        frag_dir = os.path.join( frag_root, str(ip) )
+        frags = sorted( glob.glob( os.path.join( frag_dir, '*_' +PIX_COLUMN +'.npy' ) ),
+                        key=lambda s: int( os.path.basename( s ).split( '_' )[0] ) )
+        prefixes = [ s[ : -len( PIX_COLUMN +'.npy' ) ] for s in frags ]
+        pix  = np.concatenate( [ np.load( s ) for s in frags ] )
+        sort = np.argsort( pix, kind='stable' )
+
+        out_dir = partition_dir( root, order, p )
+        os.makedirs( out_dir, exist_ok=True )
+        stats = {}
+        for col in dtypes:
+            values = np.concatenate( [ np.load( pre +col +'.npy' ) for pre in prefixes ] )[sort]
+            np.save( os.path.join( out_dir, col +'.npy' ), values )
+            stats[col] = column_stats( values )
+        meta_parts.append( { 'order': order, 'pixel': p, 'nrows': len(pix), 'stats': stats } )
+        shutil.rmtree( frag_dir )
+    shutil.rmtree( frag_root )
+
+    np.save( os.path.join( root, 'lookup.npy' ), lookup )
+    meta = { 'max_order': max_order, 'max_rows': max_rows,
+             'columns': [ { 'name': col, 'dtype': dt.str, 'shape': list( np.zeros( 0, dt ).shape[1:] ) }
+                          for col, dt in dtypes.items() ],
+             'nrows': int( counts.sum() ),
+             'sources': [ os.path.abspath( f ) for f in sweep_files ],
+             'partitions': meta_parts }
+    with open( os.path.join( root, STORE_FILE ), 'w' ) as fp:
+        json.dump( meta, fp, indent=1 )
+    return root
+
+
+
+def open_store( root ):
+    # Read a store's metadata and pixel->partition lookup (memory-mapped)
+    with open( os.path.join( root, STORE_FILE ) ) as fp:
+        store = json.load( fp )
+    store['root']   = root
+    store['lookup'] = np.load( os.path.join( root, 'lookup.npy' ), mmap_mode='r' )
+    return store
+
+
+
+def partitions_for_pixels( store, pix, ranges=None ):
+    # Indices of partitions holding any of the given pixels (at max_order)
+    #   ranges: optional {column: (lo, hi)}; partitions whose min/max
+    #   statistics show no row can be in range are skipped
+    ids = np.unique( np.asarray( store['lookup'][ np.asarray( pix ) ] ) )
+    ids = ids[ids >= 0]
+    if ranges:
+        keep = []
+        for ip in ids:
+            stats = store['partitions'][ip]['stats']
+            ok = True
+            for col, (lo, hi) in ranges.items():
+                s = stats.get( col )
+                if s is not None and ( s[1] < lo or s[0] > hi ):
+                    ok = False
+                    break
+            if ok:
+                keep.append( ip )
+        ids = np.array( keep, dtype=int )
+    return ids
+
+
+
+def read_partitions( store, ids, columns, select, ranges=None ):
+    # Read columns from the given partitions, keeping only rows for which
+    #   select(data) is True (data being a dict with at least RA and DEC) and
+    #   which satisfy the range cuts
+    # Returns {column: array} for the requested columns
+    needed = list( dict.fromkeys( ['RA', 'DEC'] + list( columns ) + list( ranges or {} ) ) )
+    pieces = { col: [] for col in columns }
+    for ip in ids:
+        part = store['partitions'][ip]
+        pdir = partition_dir( store['root'], part['order'], part['pixel'] )
+        data = { col: np.load( os.path.join( pdir, col +'.npy' ), mmap_mode='r' ) for col in needed }
+        keep = select( data )
+        for col, (lo, hi) in ( ranges or {} ).items():
+            keep &= ( data[col] >= lo ) & ( data[col] <= hi )
+        rows = np.flatnonzero( keep )
+        for col in columns:
+            pieces[col].append( np.asarray( data[col][rows] ) )
+
+    dtypes = { c['name']: np.dtype( c['dtype'] ) for c in store['columns'] }
+    shapes = { c['name']: tuple( c['shape'] ) for c in store['columns'] }
+    return { col: np.concatenate( pieces[col] ) if len(pieces[col]) > 0
+                  else np.zeros( (0,) + shapes[col], dtype=dtypes[col] )
+             for col in columns }
+
+
+
+def store_columns( store, columns ):
+    # Default to all columns, and check any requested ones exist
+    names = [ c['name'] for c in store['columns'] ]
+    if columns is None:
+        return names
+    missing = [ c for c in columns if c not in names ]
+    if len(missing) > 0:
+        raise ValueError( "Columns not in store: {}".format( missing ) )
+    return list( columns )
+
+
+
+def query_cone( store, ra, dec, radius, columns=None, ranges=None ):
+    # All rows within radius (degrees) of (ra, dec)
+    columns = store_columns( store, columns )
+    nside  = hp.order2nside( store['max_order'] )
+    center = radec_to_xyz( ra, dec )[0]
+    pix = hp.query_disc( nside, center, np.radians( radius ), inclusive=True, nest=True )
+    ids = partitions_for_pixels( store, pix, ranges )
+    cos_rad = np.cos( np.radians( radius ) )
+    select  = lambda d: radec_to_xyz( d['RA'], d['DEC'] ) @ center >= cos_rad
+    return read_partitions( store, ids, columns, select, ranges )
+
+
+
+def box_caps( radecbox ):
+    # Mangle cap polygons covering an RA/Dec box (degrees), split into RA
+    #   slices no wider than 90 degrees so each slice is a convex polygon
+    ramin, ramax, decmin, decmax = radecbox
+    edges = np.linspace( ramin, ramax, int( np.ceil( (ramax-ramin)/90. ) ) + 1 )
+    polys = []
+    for lo, hi in zip( edges[:-1], edges[1:] ):
+        caps = [ np.r_[ radec_to_xyz( lo+90., 0. )[0], 1. ],   # RA >= lo
+                 np.r_[ radec_to_xyz( hi-90., 0. )[0], 1. ] ]  # RA <= hi
+        if decmin > -90.:
+            caps.append( [ 0., 0., 1., 1. - np.sin( np.radians( decmin ) ) ] )
+        if decmax < 90.:
+            caps.append( [ 0., 0., 1., np.sin( np.radians( decmax ) ) - 1. ] )
+        polys.append( np.array( caps ) )
+    return polys
+
+
+
+def query_box( store, radecbox, columns=None, ranges=None ):
+    # All rows in an RA/Dec box [ramin, ramax, decmin, decmax] (degrees),
+    #   with the same >= min, < max convention as is_in_box
+    ramin, ramax, decmin, decmax = radecbox
+    if decmin < -90. or decmax > 90. or decmax <= decmin or ramax <= ramin:
+        msg = "Strange input: [ramin, ramax, decmin, decmax] = {}".format(radecbox)
+        raise ValueError(msg)
+    columns = store_columns( store, columns )
+    nside = hp.order2nside( store['max_order'] )
+    pix = np.unique( np.concatenate( [ candidate_pixels( caps, nside ) for caps in box_caps( radecbox ) ] ) )
+    ids = partitions_for_pixels( store, pix, ranges )
+    select = lambda d: ( (d['RA'] >= ramin) & (d['RA'] < ramax)
+                       & (d['DEC'] >= decmin) & (d['DEC'] < decmax) )
+    return read_partitions( store, ids, columns, select, ranges )
+
+
+
+def query_polygon( store, caps, columns=None, ranges=None ):
+    # All rows inside a Mangle polygon, given as an (ncaps, 4) cap array
+    columns = store_columns( store, columns )
+    nside = hp.order2nside( store['max_order'] )
+    pix = candidate_pixels( np.atleast_2d( caps ), nside )
+    ids = partitions_for_pixels( store, pix, ranges )
+    select = lambda d: in_polygon( caps, radec_to_xyz( d['RA'], d['DEC'] ) )
+    return read_partitions( store, ids, columns, select, ranges )
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    ap = ArgumentParser( description='Convert Legacy Survey sweep files into a HEALPix-partitioned store' )
+    ap.add_argument( "root", help='Output directory for the store' )
+    ap.add_argument( "sweeps", nargs='+', help='Sweep FITS files' )
+    ap.add_argument( "--columns", nargs='+', default=None, help='Columns to keep (default all)' )
+    ap.add_argument( "--max-order", type=int, default=MAX_ORDER, help='Finest HEALPix order' )
+    ap.add_argument( "--max-rows", type=int, default=MAX_ROWS, help='Most rows per partition' )
+    ns = ap.parse_args()
+
+    build_store( ns.sweeps, ns.root, columns=ns.columns, max_order=ns.max_order, max_rows=ns.max_rows )
+    store = open_store( ns.root )
+    print( '{:d} rows in {:d} partitions'.format( store['nrows'], len( store['partitions'] ) ) )
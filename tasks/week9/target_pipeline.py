@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import numpy as np
+from week9.magnitude_systems import decode_sweep_name
+from week9.color_cuts import BANDS, CHUNK_ROWS, fluxes_to_mags, make_cut, apply_cut
+from week9.spatial_index import make_index, query_cones
+from utils import instrument
+from utils.instrument import timer, timed, count
+from utils.prefetch import prefetch
+from utils.lazy import lazy_import
+ProcessPoolExecutor = lazy_import( 'concurrent.futures', 'ProcessPoolExecutor' )
+fits = lazy_import( 'astropy.io.fits' )
+Table = lazy_import( 'astropy.table', 'Table' )
+
+'''
+ASTRO5160 Week 9: Target-selection pipeline over sweep files
+-----------------
+-One command for the week 9 steps: find the sweep files overlapping a region,
+   read them, (optionally) match to a reference catalog, convert fluxes to
+   dust-corrected magnitudes, apply a color cut and write out the selection
+-Each sweep file is streamed through a chain of generators, one chunk of
+   rows at a time, so memory use is set by the chunk size, not the file size
+-Sweep files are processed in parallel on --nproc worker processes
+-Within each, the next --prefetch chunks are read on a background thread
+   while the current one is processed, so (network) disk reads overlap the
+   matching and color cuts; --prefetch-mb caps the memory this may hold
+-Output goes to FITS part files in --outdir as it is produced; a checkpoint
+   file records which sweep files are finished, so an interrupted run picks
+   up where it left off when re-run with the same arguments
+-----------------
+*Example, selecting qsos with the week 9 cut:
+   python target_pipeline.py '/d/scratch/ASTR5160/data/legacysurvey/dr9/south/sweep/9.0/*.fits' \
+       --outdir qso_targets --box 150 210 20 40 --cut g z r w1 1 -1
+'''
+
+# Name of the checkpoint file in the output directory
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# Rows of selected objects to hold before writing out a part file
+MAX_BUFFER_ROWS = 2**20
+
+# Sweep columns always carried through to the output
+BASE_COLUMNS = ['RA', 'DEC']
+
+
+
+def find_sweeps( patterns, radecbox=None ):
+    # Sweep files matching any of the glob patterns (or names), keeping only
+    #   those whose RA/Dec box (from the file name) overlaps radecbox
+    files = sorted( set( f for p in patterns for f in glob.glob( p ) ) )
+    if radecbox is None:
+        return files
+    ramin, ramax, decmin, decmax = radecbox
+    keep = []
+    for f in files:
+        (r0, r1, d0, d1) = decode_sweep_name( f )
+        if r0 < ramax and r1 > ramin and d0 < decmax and d1 > decmin:
+            keep.append( f )
+    return keep
+
+
+
+def read_chunks( sweep_file, columns, chunk_rows=CHUNK_ROWS ):
+    # Stage 1: yield the given columns of a sweep file, chunk_rows rows at a
+    #   time, as dicts of arrays (the file is memory-mapped)
+    with fits.open( sweep_file, memmap=True ) as hdul:
+        data = hdul[1].data
+        for lo in range( 0, len(data), chunk_rows ):
+            with timer( 'read_sweep' ):
+                chunk = data[lo:lo+chunk_rows]
+                chunk = { col: np.array( chunk[col] ) for col in columns }
+            count( 'rows_read', len( chunk[columns[0]] ) )
+            count( 'bytes_read', sum( v.nbytes for v in chunk.values() ) )
+            yield chunk
+
+
+
+def in_box( chunks, radecbox ):
+    # Stage 2: keep only rows inside an RA/Dec box (ramin <= RA < ramax etc.)
+    ramin, ramax, decmin, decmax = radecbox
+    for chunk in chunks:
+        keep = ( (chunk['RA'] >= ramin) & (chunk['RA'] < ramax)
+               & (chunk['DEC'] >= decmin) & (chunk['DEC'] < decmax) )
+        yield { col: values[keep] for col, values in chunk.items() }
+
+
+
+@timed( 'match_reference' )
+def match_reference( chunks, ref_ras, ref_decs, radius ):
+    # Stage 3: keep only rows within radius (degrees) of a reference object,
+    #   adding the row number of the nearest one as REF_ROW
+    # Only reference objects near each chunk are searched, against an index
+    #   of the chunk built on the fly
+    ref_ras, ref_decs = np.asarray( ref_ras ), np.asarray( ref_decs )
+    for chunk in chunks:
+        if len( chunk['RA'] ) == 0:
+            chunk['REF_ROW'] = np.zeros( 0, dtype=np.int64 )
+            yield chunk
+            continue
+        # RA range measured eastward from its lower end, so reference objects
+        #   just across RA 0/360 from the chunk are kept; within radius of a
+        #   pole any RA may be that close, so only Dec is cut on
+        lo, width = 0., 360.
+        if np.abs( chunk['DEC'] ).max() + radius < 90.:
+            pad = radius / np.cos( np.radians( np.abs( chunk['DEC'] ).max() + radius ) )
+            lo, width = chunk['RA'].min() - pad, np.ptp( chunk['RA'] ) + 2*pad
+        near = np.flatnonzero( (ref_decs >= chunk['DEC'].min() - radius)
+                             & (ref_decs <= chunk['DEC'].max() + radius)
+                             & ( ( (ref_ras - lo) % 360. <= width ) | ( width >= 360. ) ) )
+        (idx1, idx2, sep) = query_cones( make_index( chunk['RA'], chunk['DEC'] ),
+                                         ref_ras[near], ref_decs[near], radius )
+        # Keep the nearest reference object for each chunk row
+        order = np.lexsort( ( sep, idx2 ) )
+        rows, first = np.unique( idx2[order], return_index=True )
+        matched = { col: values[rows] for col, values in chunk.items() }
+        matched['REF_ROW'] = near[ idx1[order][first] ]
+        yield matched
+
+
+
+@timed( 'add_mags' )
+def add_mags( chunks, bands=BANDS ):
+    # Stage 4: add dust-corrected magnitudes (columns MAG_G, MAG_R, ...)
+    for chunk in chunks:
+        for band, mag in fluxes_to_mags( chunk, bands ).items():
+            chunk['MAG_' +band.upper()] = mag
+        yield chunk
+
+
+
+@timed( 'select' )
+def select( chunks, cut ):
+    # Stage 5: keep only rows passing the color cut
+    for chunk in chunks:
+        mags = { band: chunk['MAG_' +band.upper()] for band in set( cut['x'] ) | set( cut['y'] ) }
+        keep = apply_cut( mags, cut )
+        yield { col: values[keep] for col, values in chunk.items() }
+
+
+
+def write_parts( chunks, outdir, stem, max_rows=MAX_BUFFER_ROWS ):
+    # Stage 6: collect selected rows and write them as FITS part files
+    #   '<stem>-<n>.fits', each once max_rows rows have built up (and at the
+    #   end); parts are written under a temporary name and renamed, so a
+    #   part file on disk is always complete
+    # Returns the list of part files and the total number of rows
+    parts, buffer, nbuf, ntot = [], [], 0, 0
+
+    def flush():
+        with timer( 'write_parts' ):
+            data = { col: np.concatenate( [ b[col] for b in buffer ] ) for col in buffer[0] }
+            name = os.path.join( outdir, '{}-{:03d}.fits'.format( stem, len(parts) ) )
+            Table( data ).write( name +'.tmp', format='fits', overwrite=True )
+            os.replace( name +'.tmp', name )
+            parts.append( os.path.basename( name ) )
+
+    for chunk in chunks:
+        n = len( next( iter( chunk.values() ) ) )
+        if n == 0:
+            continue
+        buffer.append( chunk )
+        nbuf += n
+        ntot += n
+        if nbuf >= max_rows:
+            flush()
+            buffer, nbuf = [], 0
+    if nbuf > 0:
+        flush()
+    return parts, ntot
+
+
+
+def read_reference( fname ):
+    # RA and Dec arrays of the reference catalog to match to
+    ref = fits.getdata( fname, 1 )
+    return np.asarray( ref['RA'], dtype=float ), np.asarray( ref['DEC'], dtype=float )
+
+
+
+def run_sweep( sweep_file, config, depth=0, max_bytes=None, ref=None ):
+    # Run the whole chain of stages over one sweep file; returns the
+    #   (sweep file, part files, number of rows selected)
+    #   depth/max_bytes: chunks read ahead in the background (see utils/prefetch.py)
+    #   ref: (RA, Dec) arrays of config['match'], if already read
+    stem = os.path.splitext( os.path.basename( sweep_file ) )[0]
+    # Remove parts left over from an earlier, interrupted attempt at this file
+    for old in glob.glob( os.path.join( config['outdir'], stem +'-*.fits*' ) ):
+        os.remove( old )
+
+    cut = make_cut( config['cut']['x'], config['cut']['y'], config['cut']['lines'], config['cut']['above'] )
+    bands = sorted( set( cut['x'] ) | set( cut['y'] ) | set( config['bands'] ), key=BANDS.index )
+    columns = list( dict.fromkeys( BASE_COLUMNS + config['columns']
+                                   + [ 'FLUX_' +b.upper() for b in bands ]
+                                   + [ 'MW_TRANSMISSION_' +b.upper() for b in bands ] ) )
+
+    chunks = prefetch( read_chunks( sweep_file, columns, config['chunk_rows'] ), depth, max_bytes )
+    if config['box'] is not None:
+        chunks = in_box( chunks, config['box'] )
+    if config['match'] is not None:
+        if ref is None:
+            ref = read_reference( config['match'] )
+        chunks = match_reference( chunks, ref[0], ref[1], config['radius'] )
+    chunks = select( add_mags( chunks, bands ), cut )
+    (parts, nrows) = write_parts( chunks, config['outdir'], stem, config['max_buffer_rows'] )
+    return sweep_file, parts, nrows
+
+
+
+def _run_sweep( args ):
+    # Worker for run_pipeline (must be at module level to be pickled)
+    #   Also returns the worker's instrumentation for this file, if enabled
+    instrument.reset()
+    result = run_sweep( *args )
+    return result, instrument.stats() if instrument.enabled() else None
+
+
+
+def load_checkpoint( outdir, config, restart=False ):
+    # The checkpoint of an earlier run with the same configuration, or a
+    #   fresh one; a different configuration needs restart=True
+    path = os.path.join( outdir, CHECKPOINT_FILE )
+    if os.path.exists( path ) and not restart:
+        with open( path ) as f:
+            checkpoint = json.load( f )
+        if checkpoint['config'] != config:
+            raise ValueError( "Output directory " +outdir +" holds a run with different "\
+                              +"settings; use --restart to start it again" )
+        return checkpoint
+    return { 'config': config, 'done': {} }
+
+
+
+def save_checkpoint( outdir, checkpoint ):
+    # Write the checkpoint atomically
+    path = os.path.join( outdir, CHECKPOINT_FILE )
+    with open( path +'.tmp', 'w' ) as f:
+        json.dump( checkpoint, f, indent=1 )
+    os.replace( path +'.tmp', path )
+
+
+
+def run_pipeline( sweep_files, config, nproc=1, restart=False, depth=0, max_bytes=None ):
+    # Run the pipeline over a list of sweep files, skipping those already
+    #   done according to the checkpoint; returns the checkpoint
+    #   depth/max_bytes: read-ahead of each sweep file (not part of the
+    #   config, as it doesn't change the output)
+    outdir = config['outdir']
+    os.makedirs( outdir, exist_ok=True )
+    checkpoint = load_checkpoint( outdir, config, restart )
+    todo = [ f for f in sweep_files if os.path.basename( f ) not in checkpoint['done'] ]
+    print( '{:d} sweep files, {:d} already done'.format( len(sweep_files), len(sweep_files)-len(todo) ) )
+
+    def finished( result ):
+        (sweep_file, parts, nrows) = result
+        checkpoint['done'][ os.path.basename( sweep_file ) ] = { 'parts': parts, 'nrows': nrows }
+        save_checkpoint( outdir, checkpoint )
+        print( '  {}: {:d} selected'.format( os.path.basename( sweep_file ), nrows ) )
+
+    save_checkpoint( outdir, checkpoint )
+    # The reference catalog is read once here, not once per sweep file
+    ref = None
+    if config['match'] is not None and len(todo) > 0:
+        ref = read_reference( config['match'] )
+    jobs = [ (f, config, depth, max_bytes, ref) for f in todo ]
+    if nproc > 1:
+        with ProcessPoolExecutor( max_workers=nproc ) as pool:
+            for result, stats in pool.map( _run_sweep, jobs ):
+                if stats is not None:
+                    instrument.merge_stats( stats )
+                finished( result )
+    else:
+        for job in jobs:
+            finished( run_sweep( *job ) )
+    return checkpoint
+
+
+
+def merge_parts( outdir, checkpoint, fname ):
+    # Combine all part files of a finished run into a single FITS file
+    parts = [ os.path.join( outdir, p ) for done in checkpoint['done'].values() for p in done['parts'] ]
+    if len(parts) == 0:
+        raise Exception( "No objects were selected, nothing to merge" )
+    from astropy.table import vstack
+    vstack( [ Table.read( p ) for p in parts ] ).write( fname, format='fits', overwrite=True )
+
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from contextlib import nullcontext
+
+    ap = ArgumentParser( description='Select targets from Legacy Survey sweep files with a color cut' )
+    ap.add_argument( "sweeps", nargs='+', help='Sweep files, or glob patterns for them' )
+    ap.add_argument( "--outdir", required=True, help='Directory for output parts and checkpoint' )
+    ap.add_argument( "--cut", nargs=6, action='append', required=True,
+                     metavar=('X1', 'X2', 'Y1', 'Y2', 'M', 'B'),
+                     help='Select (Y1-Y2) > M*(X1-X2) + B; repeat with the same bands for a piecewise cut' )
+    ap.add_argument( "--below", action='store_true', help='Select below the line(s) instead' )
+    ap.add_argument( "--box", nargs=4, type=float, default=None,
+                     metavar=('RAMIN', 'RAMAX', 'DECMIN', 'DECMAX'), help='Only use this RA/Dec box' )
+    ap.add_argument( "--match", default=None, help='FITS file of reference objects (RA, DEC) to match to' )
+    ap.add_argument( "--radius", type=float, default=1., help='Match radius (arcsec)' )
+    ap.add_argument( "--columns", nargs='+', default=[], help='Extra sweep columns to keep' )
+    ap.add_argument( "--bands", nargs='+', default=BANDS, help='Bands to output magnitudes for' )
+    ap.add_argument( "--chunk-rows", type=int, default=CHUNK_ROWS, help='Rows read at a time' )
+    ap.add_argument( "--nproc", type=int, default=1, help='Sweep files processed in parallel' )
+    ap.add_argument( "--prefetch", type=int, default=2, help='Chunks read ahead in the background (0 for none)' )
+    ap.add_argument( "--prefetch-mb", type=float, default=None, help='Memory cap on chunks read ahead (MB)' )
+    ap.add_argument( "--restart", action='store_true', help='Ignore any checkpoint and start again' )
+    ap.add_argument( "--merge", default=None, help='Also combine the output into this FITS file' )
+    ap.add_argument( "--report", nargs='?', const='-', default=None,
+                     help='Print a per-stage timing report (and write it as JSON to this file, if given)' )
+    ap.add_argument( "--profile", default=None,
+                     help='Run under cProfile, saving the profile to this file (- to print it)' )
+    ns = ap.parse_args()
+    if ns.report is not None or ns.profile is not None:
+        # Set in the environment too, so worker processes are instrumented
+        os.environ[instrument.ENV_VAR] = '1'
+        instrument.enable()
+
+    # Everything which affects the output goes in the config, which is saved
+    #   in the checkpoint so a resumed run is known to match
+    cuts = [ ( c[:2], c[2:4], ( float(c[4]), float(c[5]) ) ) for c in ns.cut ]
+    if any( c[0] != cuts[0][0] or c[1] != cuts[0][1] for c in cuts ):
+        raise ValueError( "All lines of a piecewise cut must use the same colors" )
+    config = { 'outdir': os.path.abspath( ns.outdir ),
+               'cut': { 'x': cuts[0][0], 'y': cuts[0][1], 'lines': [ c[2] for c in cuts ],
+                        'above': not ns.below },
+               'box': ns.box, 'match': ns.match and os.path.abspath( ns.match ),
+               'radius': ns.radius / 3600., 'columns': ns.columns, 'bands': ns.bands,
+               'chunk_rows': ns.chunk_rows, 'max_buffer_rows': MAX_BUFFER_ROWS }
+    # Round-trip through JSON so the config compares equal to a saved one
+    config = json.loads( json.dumps( config ) )
+
+    with instrument.profiling( ns.profile ) if ns.profile is not None else nullcontext():
+        sweep_files = find_sweeps( ns.sweeps, ns.box )
+        max_bytes = None if ns.prefetch_mb is None else int( ns.prefetch_mb * 2**20 )
+        checkpoint = run_pipeline( sweep_files, config, nproc=ns.nproc, restart=ns.restart,
+                                   depth=ns.prefetch, max_bytes=max_bytes )
+        total = sum( done['nrows'] for done in checkpoint['done'].values() )
+        print( 'Selected {:d} objects in total'.format( total ) )
+        if ns.merge is not None:
+            merge_parts( config['outdir'], checkpoint, ns.merge )
+    if ns.report is not None:
+        instrument.report()
+        if ns.report != '-':
+            instrument.report_json( ns.report )